@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+
+import node_helpers
+
+BLOB_DIRECTORY = ".blobs"
+CHUNK_SIZE = 1024 * 1024
+
+# Blobs (and unfinished uploads) younger than this are kept by collect_garbage(), a save() may be
+# about to link them
+GARBAGE_MIN_AGE = 3600
+
+
+def link_file(source, path, exclusive=False):
+    """
+    Makes `path` a hard link (or a symlink, or a copy where links are not supported) to `source`,
+    replacing it if it exists. With `exclusive` it raises FileExistsError instead, the check and the
+    link are one step so concurrent uploads can't both take a free name.
+    """
+    temp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        try:
+            os.symlink(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)
+    try:
+        if exclusive:
+            # Reserves the name, the link then replaces the empty file
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        os.replace(temp_path, path)
+    finally:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+
+
+class ContentStore:
+    """
+    Uploads stored once per distinct content, as blobs named by their sha256 under `root`/.blobs.
+    The names users see are hard links to the blobs, so a file that was already uploaded is recognized
+    from its name or a single stat instead of reading and hashing the existing files. The digest is
+    computed while the upload is written and handed to node_helpers.file_hash(), so IS_CHANGED of
+    the loaders does not read the file again. Names must be replaced (os.replace) and never written
+    in place, that would change the blob and every other name of it. collect_garbage() deletes the
+    blobs that no name links to anymore.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def blob_path(self, digest, extension):
+        return os.path.join(self.root, BLOB_DIRECTORY, digest[:2], digest + extension.lower())
+
+    def write_blob(self, file, extension):
+        """Streams the binary file object into the store and returns (digest, blob path)."""
+        temp_directory = os.path.join(self.root, BLOB_DIRECTORY)
+        os.makedirs(temp_directory, exist_ok=True)
+        temp_path = os.path.join(temp_directory, "upload-{}.tmp".format(uuid.uuid4().hex))
+        m = hashlib.sha256()
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                    m.update(chunk)
+                    f.write(chunk)
+            digest = m.hexdigest()
+            blob = self.blob_path(digest, extension)
+            if os.path.exists(blob):
+                os.remove(temp_path)
+                # The modification time is the last use, for collect_garbage()
+                os.utime(blob)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(temp_path, blob)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        node_helpers.remember_file_hash(blob, digest)
+        return digest, blob
+
+    def save(self, file, directory, filename, overwrite=False):
+        """
+        Stores an upload and links it into `directory`. The upload gets `filename` if that name is
+        free, already holds the same content, or `overwrite` is set; otherwise the name gets the
+        start of the digest appended. Returns the name used.
+        """
+        split = os.path.splitext(filename)
+        digest, blob = self.write_blob(file, split[1])
+        path = os.path.join(directory, filename)
+        if overwrite:
+            if not os.path.exists(path) or not self.same_content(path, blob, digest):
+                link_file(blob, path)
+                node_helpers.remember_file_hash(path, digest)
+            return filename
+
+        names = [filename, "{}_{}{}".format(split[0], digest[:16], split[1])]
+        for i, name in enumerate(names):
+            path = os.path.join(directory, name)
+            try:
+                # The name with the digest can only hold this content, it is replaced if it doesn't
+                link_file(blob, path, exclusive=i == 0)
+            except FileExistsError:
+                if self.same_content(path, blob, digest):
+                    return name
+                continue
+            node_helpers.remember_file_hash(path, digest)
+            return name
+
+    def same_content(self, path, blob, digest):
+        try:
+            if os.path.samefile(path, blob):
+                return True
+        except OSError:
+            return False
+        # Uploaded before content addressing was enabled or copied, compare the (cached) hash
+        return os.path.getsize(path) == os.path.getsize(blob) and node_helpers.file_hash(path) == digest
+
+    def collect_garbage(self, min_age=GARBAGE_MIN_AGE):
+        """
+        Deletes the blobs that are not linked from any name (a link count of 1 and no symlink to
+        them) and unfinished uploads, if they were not used in the last `min_age` seconds. Returns
+        the number of bytes freed.
+        """
+        blob_directory = os.path.join(self.root, BLOB_DIRECTORY)
+        if not os.path.isdir(blob_directory):
+            return 0
+        # Names that are symlinks or copies where hard links are not supported
+        linked = set()
+        for directory, subdirectories, files in os.walk(self.root):
+            if os.path.abspath(directory) == os.path.abspath(self.root) and BLOB_DIRECTORY in subdirectories:
+                subdirectories.remove(BLOB_DIRECTORY)
+            for name in files:
+                path = os.path.join(directory, name)
+                if os.path.islink(path):
+                    linked.add(os.path.realpath(path))
+
+        freed = 0
+        cutoff = time.time() - min_age
+        for directory, _, files in os.walk(blob_directory):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime > cutoff or (stat.st_nlink > 1 and not name.endswith(".tmp")) or os.path.realpath(path) in linked:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                freed += stat.st_size
+        if freed > 0:
+            logging.info("Deleted {:.1f} MB of unused uploads from {}".format(freed / 1024 ** 2, blob_directory))
+        return freed
@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import node_helpers
+
+# Bump when transcode_image() changes its output, so old derived images are not served
+TRANSCODE_VERSION = 1
+
+EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg", "png": ".png"}
+
+
+def transcode_image(source, target, channel, image_format, quality):
+    """
+    The /view transformations: `channel` "rgb" drops the alpha channel, "a" keeps only the alpha
+    channel (as the alpha of a black image), anything else keeps the image as is. The result is
+    written to `target` in `image_format` through a temporary file, so readers never see a partial
+    image.
+    """
+    with Image.open(source) as img:
+        if channel == "a":
+            if img.mode == "RGBA":
+                a = img.getchannel("A")
+            else:
+                a = Image.new("L", img.size, 255)
+            img = Image.new("RGBA", img.size)
+            img.putalpha(a)
+        elif channel == "rgb" or image_format == "jpeg":
+            img = img.convert("RGB")
+
+        temp_path = "{}.{}.tmp".format(target, uuid.uuid4().hex)
+        try:
+            if image_format == "png":
+                img.save(temp_path, format="PNG")
+            else:
+                img.save(temp_path, format=image_format, quality=quality)
+            os.replace(temp_path, target)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class DerivedImageCache:
+    """
+    Previews and channel extracts of images served by /view, computed on a bounded thread pool and
+    kept on disk under `root`, keyed by the content hash of the image and the transformation.
+    Identical requests that arrive while an image is being derived share the work. The least
+    recently served files are deleted once the directory holds more than `max_bytes`.
+    """
+    def __init__(self, root, max_bytes, workers):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="view")
+        self.pending = {}
+        self.size = None
+        self.lock = threading.Lock()
+
+    def path_for(self, source, channel, image_format, quality):
+        digest = node_helpers.file_hash(source)
+        key = hashlib.sha256("{}:{}:{}:{}:{}".format(TRANSCODE_VERSION, digest, channel, image_format, quality).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, key[:2], key + EXTENSIONS[image_format])
+
+    def derive(self, source, channel, image_format, quality):
+        path = self.path_for(source, channel, image_format, quality)
+        try:
+            # The access time is the last use, for prune(). The modification time is part of the
+            # ETag of the response and stays.
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+            return path
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        transcode_image(source, path, channel, image_format, quality)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, _, size in self._files())
+            else:
+                self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self.prune()
+        return path
+
+    async def get(self, source, channel, image_format, quality):
+        """The path of the derived image, see transcode_image()."""
+        key = (os.path.abspath(source), channel, image_format, quality)
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(self.pool, self.derive, source, channel, image_format, quality))
+            self.pending[key] = future
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+        return await asyncio.shield(future)
+
+    def _files(self):
+        if not os.path.isdir(self.root):
+            return
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_atime, stat.st_size
+
+    def prune(self):
+        files = sorted(self._files(), key=lambda f: f[1])
+        self.size = sum(size for _, _, size in files)
+        # Down to 90% of the limit, so not every new preview triggers a scan
+        for path, _, size in files:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
@@ -0,0 +1,133 @@
+"""
+Time spent computing the output cache keys (comfy_execution.caching.CacheKeySetInputSignature) of
+large synthetic workflows, which happens for every node of every prompt before anything executes.
+
+Each workflow is a random DAG of `--nodes` nodes where every node has a few constant inputs and
+links to up to `--fan-in` earlier nodes. The keys are computed the way the executor does (one key
+set per prompt) by the current Merkle hashing and by the previous implementation, which walked the
+ancestry of every node and built nested frozensets of the whole signature.
+
+Usage (from the repository root):
+    python benchmarks/cache_key_benchmark.py --nodes 100 300 1000
+"""
+import argparse
+import itertools
+import logging
+import os
+import random
+import sys
+import time
+from typing import Mapping, Sequence
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BenchNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"seed": ("INT",), "text": ("STRING",)}, "optional": {"in0": ("*",), "in1": ("*",), "in2": ("*",), "in3": ("*",)}}
+
+    RETURN_TYPES = ("*",)
+    FUNCTION = "run"
+
+
+class NotChanged:
+    def get(self, node_id):
+        return False
+
+
+def make_prompt(count, fan_in, rng):
+    prompt = {}
+    for i in range(count):
+        inputs = {"seed": rng.randrange(1 << 32), "text": "node {} {}".format(i, "x" * 40)}
+        for j, parent in enumerate(rng.sample(range(i), min(i, rng.randint(0, fan_in)))):
+            inputs["in{}".format(j)] = [str(parent), 0]
+        prompt[str(i)] = {"class_type": "BenchNode", "inputs": inputs}
+    return prompt
+
+
+def legacy_key_set(caching, is_link):
+    """The key computation before the Merkle hashes, for comparison."""
+    def to_hashable(obj):
+        if isinstance(obj, (int, float, str, bool, type(None))):
+            return obj
+        elif isinstance(obj, Mapping):
+            return frozenset([(to_hashable(k), to_hashable(v)) for k, v in sorted(obj.items())])
+        elif isinstance(obj, Sequence):
+            return frozenset(zip(itertools.count(), [to_hashable(i) for i in obj]))
+        return float("NaN")
+
+    class LegacyKeySet(caching.CacheKeySetInputSignature):
+        def get_node_signature(self, dynprompt, node_id):
+            ancestors, order_mapping = [], {}
+            self.get_ordered_ancestry(dynprompt, node_id, ancestors, order_mapping)
+            signature = [self.get_legacy_signature(dynprompt, node_id, order_mapping)]
+            for ancestor_id in ancestors:
+                signature.append(self.get_legacy_signature(dynprompt, ancestor_id, order_mapping))
+            return to_hashable(signature)
+
+        def get_legacy_signature(self, dynprompt, node_id, order_mapping):
+            node = dynprompt.get_node(node_id)
+            signature = [node["class_type"], self.is_changed_cache.get(node_id)]
+            for key in sorted(node["inputs"].keys()):
+                value = node["inputs"][key]
+                if is_link(value):
+                    signature.append((key, ("ANCESTOR", order_mapping[value[0]], value[1])))
+                else:
+                    signature.append((key, value))
+            return signature
+
+        def get_ordered_ancestry(self, dynprompt, node_id, ancestors, order_mapping):
+            inputs = dynprompt.get_node(node_id)["inputs"]
+            for key in sorted(inputs.keys()):
+                if is_link(inputs[key]):
+                    ancestor_id = inputs[key][0]
+                    if ancestor_id not in order_mapping:
+                        ancestors.append(ancestor_id)
+                        order_mapping[ancestor_id] = len(ancestors) - 1
+                        self.get_ordered_ancestry(dynprompt, ancestor_id, ancestors, order_mapping)
+
+    return LegacyKeySet
+
+
+def time_keys(key_class, prompt, repeat):
+    from comfy_execution.graph import DynamicPrompt
+    best = float("inf")
+    for _ in range(repeat):
+        dynprompt = DynamicPrompt(prompt)
+        start = time.perf_counter()
+        key_class(dynprompt, prompt.keys(), NotChanged())
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[100, 300, 1000], help="Workflow sizes.")
+    parser.add_argument("--fan-in", type=int, default=3, help="Maximum number of linked inputs per node (at most 4).")
+    parser.add_argument("--repeat", type=int, default=5, help="Best of this many runs is reported.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    from comfy.cli_args import args as comfy_args
+    comfy_args.cpu = True
+    logging.disable(logging.ERROR)
+    import nodes
+    from comfy_execution import caching
+    from comfy_execution.graph_utils import is_link
+    nodes.NODE_CLASS_MAPPINGS["BenchNode"] = BenchNode
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * max(args.nodes)))
+
+    rng = random.Random(args.seed)
+    legacy = legacy_key_set(caching, is_link)
+    print("{:>6} {:>12} {:>12} {:>8}".format("nodes", "legacy ms", "merkle ms", "speedup"))
+    for count in args.nodes:
+        prompt = make_prompt(count, min(args.fan_in, 4), rng)
+        old = time_keys(legacy, prompt, args.repeat)
+        new = time_keys(caching.CacheKeySetInputSignature, prompt, args.repeat)
+        print("{:>6} {:>12.2f} {:>12.2f} {:>7.1f}x".format(count, old * 1000, new * 1000, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Peak memory and wall time of loading model files, with the memory mapped loading of
+comfy.utils.load_torch_file and with the files read into RAM first (--disable-mmap).
+
+Every load runs in a fresh process. The reported peak RSS is the growth of the peak resident set
+size of that process during the load, so the torch import is not counted. The files are in the page
+cache for both modes (they are loaded once before the timed runs), so the times compare the loaders,
+not the disk.
+
+Without files, synthetic diffusion models of the `--synthetic` families are written to a temporary
+directory (fp16 weights, random contents): sd15 is about 1.7 GB, sdxl about 5.1 GB.
+
+Usage (from the repository root):
+    python benchmarks/checkpoint_load_benchmark.py --synthetic sd15
+    python benchmarks/checkpoint_load_benchmark.py --checkpoints models/checkpoints/v1-5-pruned-emaonly.safetensors
+    python benchmarks/checkpoint_load_benchmark.py --diffusion-models models/unet/flux1-dev.safetensors
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# UNet configs of comfy.model_detection.unet_config_from_diffusers_unet
+FAMILIES = {
+    "sd15": {'use_checkpoint': False, 'image_size': 32, 'out_channels': 4, 'use_spatial_transformer': True, 'legacy': False, 'adm_in_channels': None,
+             'in_channels': 4, 'model_channels': 320, 'num_res_blocks': [2, 2, 2, 2], 'transformer_depth': [1, 1, 1, 1, 1, 1, 0, 0],
+             'channel_mult': [1, 2, 4, 4], 'transformer_depth_middle': 1, 'use_linear_in_transformer': False, 'context_dim': 768, 'num_heads': 8,
+             'transformer_depth_output': [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0],
+             'use_temporal_attention': False, 'use_temporal_resblock': False},
+    "sdxl": {'use_checkpoint': False, 'image_size': 32, 'out_channels': 4, 'use_spatial_transformer': True, 'legacy': False,
+             'num_classes': 'sequential', 'adm_in_channels': 2816, 'in_channels': 4, 'model_channels': 320,
+             'num_res_blocks': [2, 2, 2], 'transformer_depth': [0, 0, 2, 2, 10, 10], 'channel_mult': [1, 2, 4], 'transformer_depth_middle': 10,
+             'use_linear_in_transformer': True, 'context_dim': 2048, 'num_head_channels': 64, 'transformer_depth_output': [0, 0, 0, 2, 2, 2, 10, 10, 10],
+             'use_temporal_attention': False, 'use_temporal_resblock': False},
+}
+
+
+def write_synthetic(family, directory):
+    sys.path.insert(0, REPO_ROOT)
+    from comfy.cli_args import args as comfy_args
+    comfy_args.cpu = True
+    import torch
+    import safetensors.torch
+    import comfy.ops
+    from comfy.ldm.modules.diffusionmodules.openaimodel import UNetModel
+    model = UNetModel(**FAMILIES[family], dtype=torch.float16, device="cpu", operations=comfy.ops.disable_weight_init)
+    sd = {k: torch.randn(v.shape).to(v.dtype) if v.is_floating_point() else v for k, v in model.state_dict().items()}
+    del model
+    path = os.path.join(directory, "{}.safetensors".format(family))
+    safetensors.torch.save_file(sd, path)
+    return path
+
+
+def worker(kind, path, disable_mmap):
+    """Loads one file in this process and prints the family, time and peak RSS growth as JSON."""
+    sys.path.insert(0, REPO_ROOT)
+    from comfy.cli_args import args as comfy_args
+    comfy_args.cpu = True
+    comfy_args.disable_mmap = disable_mmap
+    logging.disable(logging.WARNING)
+    import comfy.sd
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if kind == "checkpoint":
+        model = comfy.sd.load_checkpoint_guess_config(path, output_vae=True, output_clip=True)[0]
+    else:
+        model = comfy.sd.load_diffusion_model(path)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    print(json.dumps({"family": type(model.model.model_config).__name__, "seconds": seconds, "peak_rss": (peak - before) * unit}))
+
+
+def run_worker(kind, path, disable_mmap):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", kind, path]
+    if disable_mmap:
+        command.append("--disable-mmap")
+    output = subprocess.run(command, check=True, capture_output=True, text=True, cwd=REPO_ROOT).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoints", nargs="*", default=[], help="Full checkpoints, loaded like CheckpointLoaderSimple.")
+    parser.add_argument("--diffusion-models", nargs="*", default=[], help="Diffusion model files, loaded like UNETLoader.")
+    parser.add_argument("--synthetic", nargs="*", choices=list(FAMILIES.keys()), default=None, help="Synthetic diffusion models to write and load, sd15 if no files are given.")
+    parser.add_argument("--worker", nargs=2, metavar=("KIND", "PATH"), help=argparse.SUPPRESS)
+    parser.add_argument("--write", nargs=2, metavar=("FAMILY", "DIRECTORY"), help=argparse.SUPPRESS)
+    parser.add_argument("--disable-mmap", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        worker(*args.worker, args.disable_mmap)
+        return
+    if args.write is not None:
+        print(write_synthetic(*args.write))
+        return
+
+    files = [("checkpoint", path) for path in args.checkpoints] + [("diffusion_model", path) for path in args.diffusion_models]
+    synthetic = args.synthetic if args.synthetic is not None else (["sd15"] if len(files) == 0 else [])
+    with tempfile.TemporaryDirectory(prefix="load_benchmark_") as directory:
+        for family in synthetic:
+            # In another process, so the memory used to make the file is not taken from the loads
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--write", family, directory], check=True, capture_output=True, text=True, cwd=REPO_ROOT).stdout
+            files.append(("diffusion_model", output.strip().splitlines()[-1]))
+
+        print("{:<28} {:>9} {:>10} {:>14} {:>10}".format("family", "file GB", "mode", "peak RSS GB", "seconds"))
+        for kind, path in files:
+            size = os.path.getsize(path)
+            run_worker(kind, path, disable_mmap=False) # Warm up the page cache
+            for disable_mmap in (True, False):
+                result = run_worker(kind, path, disable_mmap)
+                print("{:<28} {:>9.2f} {:>10} {:>14.2f} {:>10.2f}".format(result["family"], size / 1024 ** 3, "read" if disable_mmap else "mmap", result["peak_rss"] / 1024 ** 3, result["seconds"]))
+
+
+if __name__ == "__main__":
+    main()
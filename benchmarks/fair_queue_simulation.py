@@ -0,0 +1,128 @@
+"""
+Tail latency per tenant of execution.PromptQueue under a skewed submission mix, in simulated time.
+
+One "bulk" tenant queues `--bulk` prompts at once while `--tenants` interactive tenants submit a
+prompt every `--interval` seconds (exponentially distributed). `--workers` prompt workers execute
+them, each prompt takes `--duration` seconds on average. The same arrivals are run through the
+queue ordered by submission number (the old behaviour) and through the fair-share scheduler of
+comfy_execution/scheduling.py, and the latency (queueing + execution) of every tenant is reported.
+
+Usage (from the repository root):
+    python benchmarks/fair_queue_simulation.py --bulk 500 --tenants 4 --workers 2
+"""
+import argparse
+import heapq
+import logging
+import os
+import random
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeServer:
+    def queue_updated(self):
+        pass
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def generate_arrivals(args, rng):
+    arrivals = [(0.0, "bulk") for _ in range(args.bulk)]
+    horizon = args.bulk * args.duration / args.workers
+    for tenant in range(args.tenants):
+        t = rng.expovariate(1.0 / args.interval)
+        while t < horizon:
+            arrivals.append((t, "tenant{}".format(tenant)))
+            t += rng.expovariate(1.0 / args.interval)
+    arrivals.sort(key=lambda a: a[0])
+    return arrivals
+
+
+def simulate(arrivals, durations, args, fair):
+    import execution
+    from comfy_execution.scheduling import FairShareScheduler
+
+    class FifoScheduler(FairShareScheduler):
+        def key(self, item):
+            return item[0]
+
+    clock = SimulatedClock()
+    q = execution.PromptQueue(FakeServer())
+    q.scheduler = (FairShareScheduler if fair else FifoScheduler)(clock=clock)
+    q.worker_count = args.workers
+
+    events = [(t, 0, i) for i, (t, tenant) in enumerate(arrivals)]
+    heapq.heapify(events)
+    free_workers = args.workers
+    submitted = {}
+    latencies = {}
+
+    while len(events) > 0:
+        clock.now, kind, data = heapq.heappop(events)
+        if kind == 0:
+            tenant = arrivals[data][1]
+            prompt_id = str(data)
+            q.put((data, prompt_id, {}, {"tenant": tenant}, []))
+            submitted[prompt_id] = (clock.now, tenant)
+        else:
+            item_id, prompt_id = data
+            q.task_done(item_id, {}, None)
+            start, tenant = submitted[prompt_id]
+            latencies.setdefault(tenant, []).append(clock.now - start)
+            free_workers += 1
+
+        while free_workers > 0:
+            queue_item = q.get(timeout=0)
+            if queue_item is None:
+                break
+            item, item_id = queue_item
+            free_workers -= 1
+            heapq.heappush(events, (clock.now + durations[int(item[1])], 1, (item_id, item[1])))
+    return latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(name, latencies):
+    print(name)
+    for tenant in sorted(latencies):
+        values = latencies[tenant]
+        print("  {:10} n={:4} p50={:8.1f}s p95={:8.1f}s p99={:8.1f}s max={:8.1f}s".format(
+            tenant, len(values), percentile(values, 0.5), percentile(values, 0.95), percentile(values, 0.99), max(values)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bulk", type=int, default=500, help="Prompts the bulk tenant queues at t=0.")
+    parser.add_argument("--tenants", type=int, default=4, help="Number of interactive tenants.")
+    parser.add_argument("--interval", type=float, default=60.0, help="Mean seconds between prompts of an interactive tenant.")
+    parser.add_argument("--workers", type=int, default=2, help="Prompts executed at the same time.")
+    parser.add_argument("--duration", type=float, default=6.0, help="Mean execution time of a prompt in seconds.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    from comfy.cli_args import args as comfy_args
+    comfy_args.cpu = True
+    logging.disable(logging.ERROR)
+
+    rng = random.Random(args.seed)
+    arrivals = generate_arrivals(args, rng)
+    durations = [rng.expovariate(1.0 / args.duration) for _ in arrivals]
+
+    report("submission order", simulate(arrivals, durations, args, fair=False))
+    report("fair share", simulate(arrivals, durations, args, fair=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Load test for the Flask front end (flask_server.FlaskServer) against a stub ComfyUI backend.
+
+The stub replaces ComfyApiWrapper: uploads are accepted immediately and every generation holds one
+of `--gpu-slots` slots for `--latency` seconds, which models the single prompt worker of a real
+ComfyUI instance. The Flask app is served by a WSGI server with a fixed number of request threads
+(`--http-workers`) like a production deployment, and N concurrent clients submit generations either
+synchronously or through the asynchronous job API while a prober measures /healthCheck latency.
+
+Usage (from the repository root):
+    python benchmarks/flask_load_test.py --clients 16 --requests 4 --mode both
+"""
+import argparse
+import base64
+import csv
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import urllib.error
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StubComfyApi:
+    def __init__(self, latency, gpu_slots):
+        self.latency = latency
+        self.slots = threading.Semaphore(gpu_slots)
+        self.generated = 0
+        self.lock = threading.Lock()
+
+    def upload_image(self, filename, subfolder="default_upload_folder"):
+        with open(filename, "rb") as f:
+            f.read()
+        return {"name": os.path.basename(filename), "subfolder": subfolder, "type": "input"}
+
+    def queue_and_wait_images(self, prompt, output_node_title):
+        with self.slots:
+            time.sleep(self.latency)
+        with self.lock:
+            self.generated += 1
+            index = self.generated
+        return {"stub_{:05}".format(index): b"\xff\xd8stub-image\xff\xd9"}
+
+
+class PooledWSGIServer(ThreadingMixIn, WSGIServer):
+    """A WSGI server with a bounded number of request threads, like gunicorn's sync/gthread workers."""
+    daemon_threads = True
+    request_queue_size = 1024
+    http_workers = 4
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(max_workers=self.http_workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write("--{}\r\nContent-Disposition: form-data; name=\"{}\"\r\n\r\n{}\r\n".format(boundary, name, value).encode())
+    for name, (filename, data) in files.items():
+        body.write("--{}\r\nContent-Disposition: form-data; name=\"{}\"; filename=\"{}\"\r\nContent-Type: image/jpeg\r\n\r\n".format(boundary, name, filename).encode())
+        body.write(data)
+        body.write(b"\r\n")
+    body.write("--{}--\r\n".format(boundary).encode())
+    return body.getvalue(), "multipart/form-data; boundary={}".format(boundary)
+
+
+class Client:
+    def __init__(self, base_url, user, password, mode, upload_size, poll_interval):
+        self.base_url = base_url
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.upload = os.urandom(upload_size)
+        token = base64.b64encode("{}:{}".format(user, password).encode()).decode()
+        self.headers = {"Authorization": "Basic {}".format(token)}
+
+    def request(self, method, path, body=None, content_type=None, timeout=600):
+        headers = dict(self.headers)
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def generate(self):
+        fields = {"imagetype": "Exterior", "buildingtype": "random", "subregion": "random",
+                  "architect": "random", "atmosphere": "Clear", "ratio": "1:1 (Square)"}
+        path = "/generateImage"
+        if self.mode == "async":
+            path += "?async=1"
+        body, content_type = encode_multipart(fields, {"sketch": ("sketch.jpg", self.upload)})
+        status, data = self.request("POST", path, body, content_type)
+        if self.mode == "async" and status == 202:
+            job_id = json.loads(data)["job_id"]
+            while status == 202:
+                # Plain polling: a long-poll (?wait=N) would pin one of the few WSGI threads.
+                time.sleep(self.poll_interval)
+                status, data = self.request("GET", "/jobs/{}".format(job_id))
+        return status
+
+
+def run_mode(mode, args, credentials_path):
+    import flask_server
+    flask_server.FlaskServer.USER_COOLDOWN = -1
+    flask_server.FlaskServer.JOB_WORKERS = args.job_workers
+
+    stub = StubComfyApi(args.latency, args.gpu_slots)
+    server = flask_server.FlaskServer(credentials_path, api=stub)
+    PooledWSGIServer.http_workers = args.http_workers
+    httpd = make_server("127.0.0.1", 0, server.app, server_class=PooledWSGIServer, handler_class=QuietHandler)
+    base_url = "http://127.0.0.1:{}".format(httpd.server_port)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    probe_latencies = []
+    stop_probe = threading.Event()
+
+    def probe():
+        while not stop_probe.is_set():
+            start = time.perf_counter()
+            try:
+                urllib.request.urlopen(base_url + "/healthCheck", timeout=600).read()
+                probe_latencies.append(time.perf_counter() - start)
+            except Exception:
+                pass
+            stop_probe.wait(0.05)
+
+    def client_loop(index):
+        client = Client(base_url, "user{}".format(index), "password", mode, args.upload_kb * 1024, args.poll_interval)
+        statuses = []
+        for _ in range(args.requests):
+            statuses.append(client.generate())
+        return statuses
+
+    prober = threading.Thread(target=probe, daemon=True)
+    prober.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        results = list(pool.map(client_loop, range(args.clients)))
+    elapsed = time.perf_counter() - start
+    stop_probe.set()
+    prober.join()
+    httpd.shutdown()
+    server.jobExecutor.shutdown(wait=True)
+
+    statuses = [s for r in results for s in r]
+    ok = sum(1 for s in statuses if s == 200)
+    print("mode={:5} clients={} ok={}/{} elapsed={:.2f}s throughput={:.2f} img/s".format(
+        mode, args.clients, ok, len(statuses), elapsed, ok / elapsed))
+    if len(probe_latencies) > 0:
+        probe_latencies.sort()
+        p95 = probe_latencies[min(len(probe_latencies) - 1, int(len(probe_latencies) * 0.95))]
+        print("           healthCheck latency p50={:.1f}ms p95={:.1f}ms max={:.1f}ms".format(
+            statistics.median(probe_latencies) * 1000, p95 * 1000, probe_latencies[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=16, help="Number of concurrent clients.")
+    parser.add_argument("--requests", type=int, default=4, help="Generations submitted by each client.")
+    parser.add_argument("--latency", type=float, default=0.25, help="Seconds one stub generation holds a GPU slot.")
+    parser.add_argument("--gpu-slots", type=int, default=4, help="Generations the stub backend runs at the same time.")
+    parser.add_argument("--http-workers", type=int, default=4, help="Request threads of the WSGI server.")
+    parser.add_argument("--job-workers", type=int, default=4, help="FlaskServer.JOB_WORKERS.")
+    parser.add_argument("--upload-kb", type=int, default=256, help="Size of the uploaded sketch.")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="Seconds between /jobs/<id> polls in async mode.")
+    parser.add_argument("--mode", choices=["sync", "async", "both"], default="both")
+    args = parser.parse_args()
+
+    # flask_server imports main, which parses the ComfyUI command line. The stub never touches
+    # a device, so keep model_management from probing for a GPU.
+    sys.argv = sys.argv[:1] + ["--cpu"]
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        credentials_path = os.path.join(tmp, "credentials.csv")
+        with open(credentials_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            for i in range(args.clients):
+                writer.writerow(["user{}".format(i), "password"])
+
+        modes = ["sync", "async"] if args.mode == "both" else [args.mode]
+        for mode in modes:
+            run_mode(mode, args, credentials_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Per-frame cost of turning IMAGE tensors into uint8 arrays for the encoders, which every output node
+and every latent preview does.
+
+The previous code converted one frame at a time: a host copy of the float frame, then scale, clip
+and cast in numpy. comfy_execution.image_writer.images_to_uint8 scales, clamps and casts the whole
+batch on the device of the images and copies the uint8 batch to the host at once, into pinned memory
+on CUDA. Both are timed on random `--size`² batches; on a CPU-only machine only the numpy and
+device arithmetic differ.
+
+Usage (from the repository root):
+    python benchmarks/image_conversion_benchmark.py --batch-sizes 1 4 16
+    python benchmarks/image_conversion_benchmark.py --device cpu
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy_convert(images):
+    import numpy as np
+    return [np.clip(255. * image.cpu().numpy(), 0, 255).astype(np.uint8) for image in images]
+
+
+def time_conversion(function, images, repeat, synchronize):
+    best = float("inf")
+    for _ in range(repeat):
+        synchronize()
+        start = time.perf_counter()
+        function(images)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16], help="Frames per batch.")
+    parser.add_argument("--size", type=int, default=1024, help="Width and height of the frames.")
+    parser.add_argument("--device", default=None, help="Device of the images, the first GPU if there is one.")
+    parser.add_argument("--repeat", type=int, default=5, help="Best of this many runs is reported.")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    import torch
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    from comfy.cli_args import args as comfy_args
+    comfy_args.cpu = device.type == "cpu"
+    logging.disable(logging.ERROR)
+    from comfy_execution import image_writer
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    print("device: {}, frames: {}x{}".format(device, args.size, args.size))
+    print("{:>6} {:>18} {:>18} {:>8}".format("batch", "per frame ms", "batched ms/frame", "speedup"))
+    for batch_size in args.batch_sizes:
+        images = torch.rand((batch_size, args.size, args.size, 3), device=device)
+        # Warm up, the first pinned allocation and kernel launches are not representative
+        image_writer.images_to_uint8(images)
+        old = time_conversion(legacy_convert, images, args.repeat, synchronize) / batch_size
+        new = time_conversion(image_writer.images_to_uint8, images, args.repeat, synchronize) / batch_size
+        print("{:>6} {:>18.2f} {:>18.2f} {:>7.1f}x".format(batch_size, old * 1000, new * 1000, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Time to load an SD1.5 UNet with a LoRA applied, again and again, as a workflow that keeps using the
+same LoRA does: every prompt clones the model, adds the LoRA patches, loads it (patch_model) and
+unloads it afterwards (unpatch_model).
+
+Without --patched-weight-cache every load calculates the patched weights again with
+comfy.lora.calculate_weight. With it, the loads after the first copy the patched weights from the
+cache. The UNet (fp16 by default) and the LoRA (rank `--rank` on every linear weight of the
+transformer blocks) have random weights.
+
+Usage (from the repository root):
+    python benchmarks/lora_patch_benchmark.py
+    python benchmarks/lora_patch_benchmark.py --loads 5 --rank 64
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# comfy.model_detection.unet_config_from_diffusers_unet config of SD1.5
+SD15_UNET_CONFIG = {'use_checkpoint': False, 'image_size': 32, 'out_channels': 4, 'use_spatial_transformer': True, 'legacy': False, 'adm_in_channels': None,
+                    'in_channels': 4, 'model_channels': 320, 'num_res_blocks': [2, 2, 2, 2], 'transformer_depth': [1, 1, 1, 1, 1, 1, 0, 0],
+                    'channel_mult': [1, 2, 4, 4], 'transformer_depth_middle': 1, 'use_linear_in_transformer': False, 'context_dim': 768, 'num_heads': 8,
+                    'transformer_depth_output': [1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0],
+                    'use_temporal_attention': False, 'use_temporal_resblock': False}
+
+
+def make_lora(model, rank):
+    import torch
+    patches = {}
+    for key, weight in model.state_dict().items():
+        if ".transformer_blocks." in key and key.endswith(".weight") and weight.ndim == 2:
+            up = torch.randn(weight.shape[0], rank) * 0.01
+            down = torch.randn(rank, weight.shape[1]) * 0.01
+            patches[key] = ("lora", (up, down, float(rank), None, None, None))
+    return patches
+
+
+def time_loads(patcher, lora, loads, device):
+    times = []
+    for _ in range(loads):
+        model = patcher.clone()
+        model.add_patches(lora, 1.0)
+        start = time.perf_counter()
+        model.patch_model(device_to=device)
+        times.append(time.perf_counter() - start)
+        model.unpatch_model(device_to=patcher.offload_device)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--loads", type=int, default=4, help="Loads of the patched model per mode.")
+    parser.add_argument("--rank", type=int, default=32, help="Rank of the LoRA.")
+    parser.add_argument("--dtype", choices=["fp16", "bf16", "fp32"], default="fp16", help="Weight dtype of the UNet.")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    import torch
+    from comfy.cli_args import args as comfy_args
+    comfy_args.cpu = True
+    logging.disable(logging.WARNING)
+    import comfy.model_detection
+    import comfy.model_patcher
+
+    device = torch.device("cpu")
+    model_config = comfy.model_detection.model_config_from_unet_config(SD15_UNET_CONFIG)
+    model_config.set_inference_dtype({"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}[args.dtype], None)
+    model = model_config.get_model({}, device=device)
+    with torch.no_grad():
+        for p in model.parameters():
+            p.normal_(0, 0.02)
+    patcher = comfy.model_patcher.ModelPatcher(model, load_device=device, offload_device=device)
+    lora = make_lora(model, args.rank)
+    patched_bytes = sum(model.state_dict()[k].nbytes for k in lora)
+    print("UNet {:.2f} GB {}, LoRA rank {} on {} weights ({:.2f} GB of patched weights)".format(
+        patcher.model_size() / 1024 ** 3, model.get_dtype(), args.rank, len(lora), patched_bytes / 1024 ** 3))
+
+    print("{:<10} {:>12} {:>16}".format("cache", "first load s", "later loads s"))
+    for cache in (False, True):
+        comfy.model_patcher._patched_weight_cache = comfy.model_patcher.PatchedWeightCache(2 * patched_bytes) if cache else None
+        times = time_loads(patcher, lora, args.loads, device)
+        print("{:<10} {:>12.2f} {:>16.2f}".format("on" if cache else "off", times[0], sum(times[1:]) / max(len(times) - 1, 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Per-request validation cost of a 50 node workflow: full execution.validate_prompt versus a
+registered execution.PromptTemplate that only re-validates the nodes whose inputs change.
+
+The workflow is SD1.5 shaped (checkpoint, a LoRA chain, prompt encoders, image preprocessing,
+sampler, decoder, save) and every request overrides 8 inputs, like the Flask front end does. Model
+folders and the input directory are temporary directories filled with empty files, so no models are
+needed; `--input-files` controls how many files LoadImage.INPUT_TYPES has to list.
+
+Usage (from the repository root):
+    python benchmarks/prompt_validation.py --requests 200 --input-files 2000
+"""
+import argparse
+import copy
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def build_workflow(image_name):
+    prompt = {}
+
+    def add(class_type, **inputs):
+        node_id = str(len(prompt) + 1)
+        prompt[node_id] = {"class_type": class_type, "inputs": inputs}
+        return node_id
+
+    ckpt = add("CheckpointLoaderSimple", ckpt_name="model.safetensors")
+    model, clip = [ckpt, 0], [ckpt, 1]
+    for i in range(10):
+        lora = add("LoraLoader", model=model, clip=clip, lora_name="lora_{}.safetensors".format(i), strength_model=0.5, strength_clip=0.5)
+        model, clip = [lora, 0], [lora, 1]
+    vae = add("VAELoader", vae_name="vae.safetensors")
+
+    image = [add("LoadImage", image=image_name), 0]
+    for i in range(11):
+        image = [add("ImageScale", image=image, upscale_method="bilinear", width=512, height=512, crop="disabled"), 0]
+    latent = add("VAEEncode", pixels=image, vae=[vae, 0])
+
+    conditioning = {}
+    for sign in ("positive", "negative"):
+        encoded = [[add("CLIPTextEncode", text="{} prompt {}".format(sign, i), clip=clip), 0] for i in range(6)]
+        combined = encoded[0]
+        for other in encoded[1:]:
+            combined = [add("ConditioningCombine", conditioning_1=combined, conditioning_2=other), 0]
+        conditioning[sign] = combined
+
+    sampler = add("KSampler", model=model, seed=0, steps=20, cfg=7.0, sampler_name="euler", scheduler="normal",
+                  positive=conditioning["positive"], negative=conditioning["negative"], latent_image=[latent, 0], denoise=1.0)
+    decoded = add("VAEDecode", samples=[sampler, 0], vae=[vae, 0])
+    add("SaveImage", images=[decoded, 0], filename_prefix="benchmark")
+    return prompt
+
+
+def request_overrides(prompt, image_name):
+    by_class = {}
+    for node_id, node in prompt.items():
+        by_class.setdefault(node["class_type"], []).append(node_id)
+    texts = by_class["CLIPTextEncode"]
+    size = random.choice([512, 640, 768])
+    return {
+        by_class["LoadImage"][0]: {"image": image_name},
+        texts[0]: {"text": "architect {}".format(random.random())},
+        texts[1]: {"text": "region {}".format(random.random())},
+        texts[2]: {"text": "building {}".format(random.random())},
+        texts[3]: {"text": "atmosphere {}".format(random.random())},
+        texts[4]: {"text": "exterior {}".format(random.random())},
+        by_class["ImageScale"][-1]: {"width": size, "height": size},
+        by_class["KSampler"][0]: {"seed": random.randint(0, 0xFFFFFFFFFFFFFFFF)},
+    }
+
+
+def apply_overrides(prompt, overrides):
+    prompt = copy.deepcopy(prompt)
+    for node_id, values in overrides.items():
+        prompt[node_id]["inputs"].update(values)
+    return prompt
+
+
+def setup_folders(tmp, input_files):
+    import folder_paths
+
+    input_dir = os.path.join(tmp, "input")
+    os.makedirs(input_dir)
+    for i in range(input_files):
+        open(os.path.join(input_dir, "sketch_{:05}.png".format(i)), "wb").close()
+    folder_paths.set_input_directory(input_dir)
+
+    for folder_name, files in (("checkpoints", ["model.safetensors"]),
+                               ("loras", ["lora_{}.safetensors".format(i) for i in range(10)]),
+                               ("vae", ["vae.safetensors"])):
+        path = os.path.join(tmp, folder_name)
+        os.makedirs(path)
+        for name in files:
+            open(os.path.join(path, name), "wb").close()
+        folder_paths.folder_names_and_paths[folder_name] = ([path], folder_paths.supported_pt_extensions)
+    return ["sketch_{:05}.png".format(i) for i in range(input_files)]
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print("{:10} mean={:8.3f}ms p50={:8.3f}ms p95={:8.3f}ms".format(
+        name, statistics.mean(timings) * 1000, statistics.median(timings) * 1000, p95 * 1000))
+    return statistics.mean(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Validated requests per mode.")
+    parser.add_argument("--input-files", type=int, default=2000, help="Files in the input directory.")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    from comfy.cli_args import args as comfy_args
+    comfy_args.cpu = True
+    logging.disable(logging.ERROR)
+    import execution
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = setup_folders(tmp, args.input_files)
+        workflow = build_workflow(images[0])
+        assert len(workflow) == 50
+        assert execution.validate_prompt(copy.deepcopy(workflow))[0]
+
+        requests = [request_overrides(workflow, random.choice(images)) for _ in range(args.requests)]
+
+        timings = []
+        for overrides in requests:
+            prompt = apply_overrides(workflow, overrides)
+            start = time.perf_counter()
+            valid = execution.validate_prompt(prompt)
+            timings.append(time.perf_counter() - start)
+            assert valid[0]
+        full = report("full", timings)
+
+        start = time.perf_counter()
+        template = execution.PromptTemplate(workflow)
+        print("{:10} {:8.3f}ms once".format("register", (time.perf_counter() - start) * 1000))
+        timings = []
+        for overrides in requests:
+            start = time.perf_counter()
+            valid, prompt = template.validate(overrides)
+            timings.append(time.perf_counter() - start)
+            assert valid[0]
+        cached = report("template", timings)
+        print("speedup    {:.1f}x".format(full / cached))
+
+
+if __name__ == "__main__":
+    main()
@@ -97,6 +97,21 @@ parser.add_argument("--preview-size", type=int, default=512, help="Sets the maxi
 cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument("--cache-classic", action="store_true", help="Use the old style (aggressive) caching.")
 cache_group.add_argument("--cache-lru", type=int, default=0, help="Use LRU caching with a maximum of N node results cached. May use more RAM/VRAM.")
+parser.add_argument("--cache-ram-budget", type=float, default=None, metavar="GB", help="Use LRU caching and keep at most this many GB of cached node results in RAM. The results that took the least time to compute per byte are dropped first.")
+parser.add_argument("--cache-vram-budget", type=float, default=None, metavar="GB", help="Use LRU caching and keep at most this many GB of cached node results in VRAM.")
+parser.add_argument("--cache-disk", type=str, default=None, metavar="PATH", help="Also keep node results (text and image encoder outputs, and the nodes that opt in with DISK_CACHEABLE) in this directory, so they survive restarts and are shared by the servers using the same directory.")
+parser.add_argument("--cache-disk-size", type=float, default=20.0, metavar="GB", help="Size limit of the --cache-disk directory, the least recently used results are deleted first.")
+
+parser.add_argument("--model-cache-ram", type=float, default=None, metavar="GB", help="Keep up to this many GB of loaded models (checkpoints, LoRAs, ControlNets, VAEs...) in RAM across prompts, so going back to a model doesn't load it from disk again. The least recently used are dropped first.")
+parser.add_argument("--patched-weight-cache", type=float, default=None, metavar="GB", help="Keep up to this many GB of model weights with LoRAs and other weight patches applied in RAM (counting the LoRA tensors they keep loaded), so loading a model with the same patches again copies them instead of calculating them again.")
+
+parser.add_argument("--batch-prompts", type=int, default=1, metavar="N", help="Run up to N queued prompts that only differ in seeds, prompt text or input images as one batched sampler call. Samplers that add noise while sampling (ancestral, SDE, ddpm, lcm) are not batched.")
+parser.add_argument("--concurrent-nodes", type=int, default=0, metavar="N", help="Run up to N ready nodes that support it (loaders, image loading and preprocessing) on a thread pool while another node of the prompt is executing.")
+parser.add_argument("--worker-count", type=int, default=1, metavar="N", help="Execute prompts in N worker processes, each pinned to its own CUDA device (round robin over the visible devices) or, on CPU, to its own share of the CPU threads.")
+parser.add_argument("--max-queued-per-client", type=int, default=None, metavar="N", help="Reject prompts (HTTP 429) of a client that already has N prompts queued. Clients are identified by the client_id of /prompt, or the user of the embedded executor.")
+parser.add_argument("--allow-prompt-priority", action="store_true", help="Let /prompt requests choose a priority other than \"normal\" (\"high\" or \"low\"). Without it they are rejected.")
+parser.add_argument("--max-running-per-client", type=int, default=None, metavar="N", help="Execute at most N prompts of the same client at the same time.")
+parser.add_argument("--history-db", type=str, default=None, metavar="PATH", help="Keep the prompt history in this SQLite database so it survives restarts. By default it is only kept in memory.")
 
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
@@ -121,9 +136,15 @@ vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for e
 parser.add_argument("--reserve-vram", type=float, default=None, help="Set the amount of vram in GB you want to reserve for use by your OS/other software. By default some amount is reverved depending on your OS.")
 
 
+parser.add_argument("--content-addressed-uploads", action="store_true", help="Store each distinct uploaded image once, by its hash, and give uploads links to it. Uploading a file that is already there is recognized without reading the existing files, and an upload whose name is taken by other content gets the start of its hash appended to the name instead of a number.")
+parser.add_argument("--file-hash-db", type=str, default=None, metavar="PATH", help="Keep the content hashes of input files (used to tell whether a loaded image or audio file changed) in this SQLite database so they survive restarts.")
 parser.add_argument("--default-hashing-function", type=str, choices=['md5', 'sha1', 'sha256', 'sha512'], default='sha256', help="Allows you to choose the hash function to use for duplicate filename / contents comparison. Default is sha256.")
 
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
+parser.add_argument("--disable-mmap", action="store_true", help="Read model files into memory when loading them instead of memory mapping them. May help on network file systems, uses more RAM.")
+parser.add_argument("--conversion-cache", type=str, default=None, metavar="PATH", help="Convert pickled model files (.ckpt, .pt, .pth, .bin) to .safetensors in this directory the first time they are loaded and load the converted files after that.")
+parser.add_argument("--conversion-cache-dtype", type=str, default="keep", choices=["keep", "fp16", "bf16"], help="Convert the floating point weights of the converted files to this dtype.")
+parser.add_argument("--detection-cache", type=str, default=None, metavar="PATH", help="Keep the detected model types of loaded models in this SQLite database, so loading the same model again in this or another process skips the detection. By default they are only kept in memory.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 parser.add_argument("--fast", action="store_true", help="Enable some untested and potentially quality deteriorating optimizations.")
 
@@ -421,7 +421,7 @@ def controlnet_config(sd, model_options={}):
     return model_config, operations, load_device, unet_dtype, manual_cast_dtype, offload_device
 
 def controlnet_load_state_dict(control_model, sd):
-    missing, unexpected = control_model.load_state_dict(sd, strict=False)
+    missing, unexpected = comfy.utils.load_state_dict(control_model, sd, strict=False)
 
     if len(missing) > 0:
         logging.warning("missing controlnet keys: {}".format(missing))
@@ -648,13 +648,15 @@ def load_controlnet_state_dict(state_dict, model=None, model_options={}):
     control = ControlNet(control_model, global_average_pooling=global_average_pooling, load_device=load_device, manual_cast_dtype=manual_cast_dtype)
     return control
 
-def load_controlnet(ckpt_path, model=None, model_options={}):
+def load_controlnet(ckpt_path, model=None, model_options={}, state_dict=None):
     if "global_average_pooling" not in model_options:
         filename = os.path.splitext(ckpt_path)[0]
         if filename.endswith("_shuffle") or filename.endswith("_shuffle_fp16"): #TODO: smarter way of enabling global_average_pooling
             model_options["global_average_pooling"] = True
 
-    cnet = load_controlnet_state_dict(comfy.utils.load_torch_file(ckpt_path, safe_load=True), model=model, model_options=model_options)
+    if state_dict is None:
+        state_dict = comfy.utils.load_torch_file(ckpt_path, safe_load=True)
+    cnet = load_controlnet_state_dict(state_dict, model=model, model_options=model_options)
     if cnet is None:
         logging.error("error checkpoint does not contain controlnet or t2i adapter data {}".format(ckpt_path))
     return cnet
@@ -764,3 +766,67 @@ def load_t2i_adapter(t2i_data, model_options={}): #TODO: model_options
         logging.debug("t2i unexpected {}".format(unexpected))
 
     return T2IAdapter(model_ad, model_ad.input_channels, compression_ratio, upscale_algorithm)
+
+def batch_controls(controls, latent_shape, memo):
+    """
+    Merges the per-prompt copies of a control (and the chain of previous controls) into one control
+    whose hint has one entry per prompt, for sampling several prompts as one batch. Returns None if
+    the controls can't be merged. memo maps the ids of already merged controls to the result so the
+    positive and negative conditioning of a batch keep sharing one control object.
+    """
+    key = tuple(id(c) for c in controls)
+    if key not in memo:
+        first = controls[0]
+        if all(c is first for c in controls):
+            memo[key] = first
+        else:
+            memo[key] = _batch_controls(controls, latent_shape, memo)
+    return memo[key]
+
+def _batch_controls(controls, latent_shape, memo):
+    first = controls[0]
+    for c in controls[1:]:
+        if type(c) is not type(first):
+            return None
+        for model_attr in ("control_model", "control_weights", "t2i_model"):
+            if getattr(c, model_attr, None) is not getattr(first, model_attr, None):
+                return None
+        if c.strength != first.strength or c.timestep_percent_range != first.timestep_percent_range or c.strength_type != first.strength_type:
+            return None
+        if c.vae is not first.vae or c.extra_args != first.extra_args or len(c.extra_concat_orig) != len(first.extra_concat_orig):
+            return None
+        if (c.previous_controlnet is None) != (first.previous_controlnet is None):
+            return None
+
+    previous_controlnet = None
+    if first.previous_controlnet is not None:
+        previous_controlnet = batch_controls([c.previous_controlnet for c in controls], latent_shape, memo)
+        if previous_controlnet is None:
+            return None
+
+    hints = [c.cond_hint_original for c in controls]
+    if any(h.shape[0] != 1 for h in hints):
+        return None
+    if any(h.shape != hints[0].shape for h in hints):
+        if isinstance(first, T2IAdapter):
+            return None
+        # Same resize get_control() does for every prompt on its own, so the hints can be stacked.
+        compression_ratio = first.compression_ratio
+        if first.vae is not None:
+            compression_ratio *= first.vae.downscale_ratio
+        hints = [comfy.utils.common_upscale(h, latent_shape[-1] * compression_ratio, latent_shape[-2] * compression_ratio, first.upscale_algorithm, "center") for h in hints]
+
+    extra_concat = []
+    for values in zip(*[c.extra_concat_orig for c in controls]):
+        if all(v is values[0] for v in values):
+            extra_concat.append(values[0])
+        elif all(v.shape[0] == 1 and v.shape == values[0].shape for v in values):
+            extra_concat.append(torch.cat(values))
+        else:
+            return None
+
+    c = first.copy()
+    c.cond_hint_original = torch.cat(hints)
+    c.extra_concat_orig = extra_concat
+    c.set_previous_controlnet(previous_controlnet)
+    return c
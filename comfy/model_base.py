@@ -219,7 +219,7 @@ class BaseModel(torch.nn.Module):
                 to_load[k[len(unet_prefix):]] = sd.pop(k)
 
         to_load = self.model_config.process_unet_state_dict(to_load)
-        m, u = self.diffusion_model.load_state_dict(to_load, strict=False)
+        m, u = utils.load_state_dict(self.diffusion_model, to_load, strict=False)
         if len(m) > 0:
             logging.warning("unet missing: {}".format(m))
 
@@ -1,8 +1,17 @@
 import comfy.supported_models
 import comfy.supported_models_base
 import comfy.utils
+from comfy.cli_args import args
+import collections
+import copy
+import hashlib
+import json
 import math
 import logging
+import os
+import sqlite3
+import sys
+import threading
 import torch
 
 def count_blocks(state_dict_keys, prefix_string):
@@ -280,15 +289,132 @@ def model_config_from_unet_config(unet_config, state_dict=None):
     logging.error("no match {}".format(unet_config))
     return None
 
+# Modules with the detection code, a change to them invalidates the entries of the detection cache
+DETECTION_MODULES = (__name__, "comfy.supported_models", "comfy.supported_models_base")
+
+_detection_code_hash = None
+
+def detection_code_hash():
+    """sha256 of the source of the detection code."""
+    global _detection_code_hash
+    if _detection_code_hash is None:
+        m = hashlib.sha256()
+        for name in DETECTION_MODULES:
+            with open(sys.modules[name].__file__, "rb") as f:
+                m.update(f.read())
+        _detection_code_hash = m.hexdigest()
+    return _detection_code_hash
+
+def state_dict_layout_hash(state_dict, *extra):
+    """
+    sha256 of the key names and shapes of a state dict, which is all the detection functions look at,
+    of the supported model list they match against and of the detection code. The same content as
+    a safetensors header without the data offsets, but it also works for state dicts that weren't
+    loaded from one.
+    """
+    m = hashlib.sha256()
+    m.update(detection_code_hash().encode())
+    for model_config in comfy.supported_models.models:
+        m.update("{}:{}:{};".format(model_config.__name__, sorted(model_config.unet_config.items(), key=str), sorted(model_config.required_keys)).encode())
+    for e in extra:
+        m.update("{};".format(e).encode())
+    for k in sorted(state_dict.keys()):
+        m.update("{}:{};".format(k, tuple(getattr(state_dict[k], "shape", ()))).encode())
+    return m.hexdigest()
+
+class DetectionCache:
+    """
+    Detected unet configs and the name of the model config class they matched, by
+    state_dict_layout_hash, so loading the same model again skips the detection. With a `db_path`
+    they are also kept in a SQLite database, shared with the other processes using it and kept
+    across restarts. At most `max_entries` are kept in memory.
+    """
+    def __init__(self, db_path=None, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS model_detection (key TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+
+    def get(self, key):
+        """The (unet_config, model config class name) stored for the key, None if there is none."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.db is not None:
+                row = self.db.execute("SELECT entry FROM model_detection WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = tuple(json.loads(row[0]))
+            if entry is None:
+                return None
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            return copy.deepcopy(entry)
+
+    def put(self, key, unet_config, model_name):
+        entry = (copy.deepcopy(unet_config), model_name)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.db is not None:
+                try:
+                    serialized = json.dumps(entry)
+                except TypeError:
+                    return
+                # Only if it comes back the same, tuples would come back as lists
+                if tuple(json.loads(serialized)) == entry:
+                    self.db.execute("INSERT OR REPLACE INTO model_detection (key, entry) VALUES (?, ?)", (key, serialized))
+
+_detection_cache = None
+
+def detection_cache():
+    global _detection_cache
+    if _detection_cache is None:
+        _detection_cache = DetectionCache(args.detection_cache)
+    return _detection_cache
+
+def cached_model_config(key, detect, use_base_if_no_match=False):
+    """
+    The model config for the unet config returned by `detect()`, which is only called when there is
+    no entry for the key in the detection cache.
+    """
+    cache = detection_cache()
+    entry = cache.get(key)
+    if entry is not None:
+        unet_config, model_name = entry
+        if unet_config is None:
+            return None
+        if model_name is None:
+            logging.error("no match {}".format(unet_config))
+            return None
+        if model_name == comfy.supported_models_base.BASE.__name__ and use_base_if_no_match:
+            return comfy.supported_models_base.BASE(unet_config)
+        for model_config in comfy.supported_models.models:
+            if model_config.__name__ == model_name:
+                return model_config(unet_config)
+
+    unet_config, model_config = detect()
+    model_name = None if model_config is None else type(model_config).__name__
+    cache.put(key, unet_config, model_name)
+    return model_config
+
 def model_config_from_unet(state_dict, unet_key_prefix, use_base_if_no_match=False):
-    unet_config = detect_unet_config(state_dict, unet_key_prefix)
-    if unet_config is None:
-        return None
-    model_config = model_config_from_unet_config(unet_config, state_dict)
-    if model_config is None and use_base_if_no_match:
-        return comfy.supported_models_base.BASE(unet_config)
-    else:
-        return model_config
+    def detect():
+        unet_config = detect_unet_config(state_dict, unet_key_prefix)
+        if unet_config is None:
+            return None, None
+        model_config = model_config_from_unet_config(unet_config, state_dict)
+        if model_config is None and use_base_if_no_match:
+            model_config = comfy.supported_models_base.BASE(unet_config)
+        return unet_config, model_config
+
+    key = state_dict_layout_hash(state_dict, "unet", unet_key_prefix, use_base_if_no_match)
+    return cached_model_config(key, detect, use_base_if_no_match)
 
 def unet_prefix_from_state_dict(state_dict):
     candidates = ["model.diffusion_model.", #ldm/sgm models
@@ -493,10 +619,13 @@ def unet_config_from_diffusers_unet(state_dict, dtype=None):
     return None
 
 def model_config_from_diffusers_unet(state_dict):
-    unet_config = unet_config_from_diffusers_unet(state_dict)
-    if unet_config is not None:
-        return model_config_from_unet_config(unet_config)
-    return None
+    def detect():
+        unet_config = unet_config_from_diffusers_unet(state_dict)
+        if unet_config is None:
+            return None, None
+        return unet_config, model_config_from_unet_config(unet_config)
+
+    return cached_model_config(state_dict_layout_hash(state_dict, "diffusers_unet"), detect)
 
 def convert_diffusers_mmdit(state_dict, output_prefix=""):
     out_sd = {}
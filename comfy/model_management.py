@@ -23,6 +23,7 @@ from comfy.cli_args import args
 import torch
 import sys
 import platform
+import threading
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -277,6 +278,18 @@ except:
 
 current_loaded_models = []
 
+# Set on the threads of the executor's node pool, see execution.run_concurrent_node(). The nodes
+# there run next to the node the prompt worker executes, which may be sampling with the loaded
+# models, so they must not load or unload models on the GPU.
+node_pool_thread = threading.local()
+
+class ModelLoadOnNodePool(Exception):
+    """Raised by load_models_gpu() and free_memory() on a node pool thread, the node is run again by the prompt worker."""
+    pass
+
+def on_node_pool():
+    return getattr(node_pool_thread, "active", False)
+
 def module_size(module):
     module_mem = 0
     sd = module.state_dict()
@@ -418,6 +431,8 @@ def unload_model_clones(model, unload_weights_only=True, force_unload=True):
     return unload_weight
 
 def free_memory(memory_required, device, keep_loaded=[]):
+    if on_node_pool():
+        raise ModelLoadOnNodePool()
     unloaded_model = []
     can_unload = []
     unloaded_models = []
@@ -455,6 +470,8 @@ def free_memory(memory_required, device, keep_loaded=[]):
 
 def load_models_gpu(models, memory_required=0, force_patch_weights=False, minimum_memory_required=None, force_full_load=False):
     global vram_state
+    if on_node_pool():
+        raise ModelLoadOnNodePool()
 
     inference_memory = minimum_inference_memory()
     extra_mem = max(inference_memory, memory_required + extra_reserved_memory())
@@ -605,6 +622,8 @@ def unet_offload_device():
         return torch.device("cpu")
 
 def unet_inital_load_device(parameters, dtype):
+    if on_node_pool():
+        return torch.device("cpu")
     torch_dev = get_torch_device()
     if vram_state == VRAMState.HIGH_VRAM:
         return torch_dev
@@ -709,7 +728,7 @@ def text_encoder_device():
         return torch.device("cpu")
 
 def text_encoder_initial_device(load_device, offload_device, model_size=0):
-    if load_device == offload_device or model_size <= 1024 * 1024 * 1024:
+    if load_device == offload_device or model_size <= 1024 * 1024 * 1024 or on_node_pool():
         return offload_device
 
     if is_device_mps(load_device):
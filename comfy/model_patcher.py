@@ -23,11 +23,14 @@ import logging
 import uuid
 import collections
 import math
+import threading
+import weakref
 
 import comfy.utils
 import comfy.float
 import comfy.model_management
 import comfy.lora
+from comfy.cli_args import args
 from comfy.comfy_types import UnetWrapperFunction
 
 def string_to_seed(data):
@@ -83,6 +86,123 @@ def wipe_lowvram_weight(m):
     m.weight_function = None
     m.bias_function = None
 
+def patches_key(value):
+    """
+    Hashable description of the patches of a weight: strengths, offsets and structure as they are,
+    tensors and functions by identity.
+    """
+    if isinstance(value, torch.Tensor):
+        return ("tensor", value.data_ptr(), tuple(value.shape), value.dtype, value.device)
+    if isinstance(value, (list, tuple)):
+        return tuple(patches_key(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, patches_key(v)) for k, v in sorted(value.items()))
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return ("object", id(value))
+
+def patch_tensors(value, out=None):
+    """The CPU tensors in the patches of a weight, by (data_ptr, shape, dtype) with their bytes."""
+    if out is None:
+        out = {}
+    if isinstance(value, torch.Tensor):
+        if value.device.type == "cpu":
+            out[(value.data_ptr(), tuple(value.shape), value.dtype)] = value.nelement() * value.element_size()
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            patch_tensors(v, out)
+    elif isinstance(value, dict):
+        for v in value.values():
+            patch_tensors(v, out)
+    return out
+
+class PatchedWeightCache:
+    """
+    Weights with their patches (LoRAs...) applied, kept in RAM so loading a model with the same
+    patches again copies them instead of calculating them again. Keyed by the model, the weight key,
+    the base weight and patches_key() of the patches. Entries keep their patches alive, so the
+    tensors in the key can't be freed and their memory reused while the entry exists. At most
+    `max_bytes` of patched weights and of the patch tensors the entries keep alive (each counted
+    once) are kept, the least recently used are dropped first.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        # Entries that keep each patch tensor alive, and its bytes
+        self.patch_refs = {}
+        self.ram_bytes = 0
+        self.patch_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "entries": len(self.entries), "ram_bytes": self.ram_bytes, "patch_bytes": self.patch_bytes, "max_ram": self.max_bytes}
+
+    @staticmethod
+    def key(model, key, weight, patches):
+        return (id(model), key, weight.data_ptr(), tuple(weight.shape), weight.dtype, weight.device, patches_key(patches))
+
+    def get(self, cache_key, model):
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is not None and entry[0]() is not model:
+                # A model that was freed and had the same id
+                self._remove(cache_key)
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(cache_key)
+            self.stats["hits"] += 1
+            return entry[2]
+
+    def put(self, cache_key, model, patches, weight):
+        size = weight.nelement() * weight.element_size()
+        tensors = patch_tensors(patches)
+        with self.lock:
+            if cache_key in self.entries:
+                self._remove(cache_key)
+            pinned = sum(n for k, n in tensors.items() if k not in self.patch_refs)
+            if size + pinned > self.max_bytes:
+                return
+            # A copy, add_patches() appends to the lists of the patcher
+            self.entries[cache_key] = (weakref.ref(model), list(patches), weight.to("cpu", copy=True), tensors)
+            self.ram_bytes += size + pinned
+            self.patch_bytes += pinned
+            for k, n in tensors.items():
+                self.patch_refs[k] = (self.patch_refs.get(k, (0, n))[0] + 1, n)
+            while self.ram_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def _remove(self, cache_key):
+        _, _, weight, tensors = self.entries.pop(cache_key)
+        self.ram_bytes -= weight.nelement() * weight.element_size()
+        for k in tensors:
+            count, n = self.patch_refs.pop(k)
+            if count > 1:
+                self.patch_refs[k] = (count - 1, n)
+            else:
+                self.ram_bytes -= n
+                self.patch_bytes -= n
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.patch_refs.clear()
+            self.ram_bytes = 0
+            self.patch_bytes = 0
+
+_patched_weight_cache = None
+
+def patched_weight_cache():
+    """The cache with the --patched-weight-cache budget, None if it is disabled."""
+    global _patched_weight_cache
+    if _patched_weight_cache is None and args.patched_weight_cache is not None and args.patched_weight_cache > 0:
+        _patched_weight_cache = PatchedWeightCache(int(args.patched_weight_cache * 1024 ** 3))
+    return _patched_weight_cache
+
 class LowVramPatch:
     def __init__(self, key, patches):
         self.key = key
@@ -324,12 +444,24 @@ class ModelPatcher:
         if key not in self.backup:
             self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
 
-        if device_to is not None:
-            temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
-        else:
-            temp_weight = weight.to(torch.float32, copy=True)
-        out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
-        out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
+        cache = patched_weight_cache()
+        out_weight = None
+        if cache is not None:
+            cache_key = cache.key(self.model, key, weight, self.patches[key])
+            out_weight = cache.get(cache_key, self.model)
+            if out_weight is not None:
+                out_weight = out_weight.to(device_to if device_to is not None else weight.device, copy=True)
+
+        if out_weight is None:
+            if device_to is not None:
+                temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+            else:
+                temp_weight = weight.to(torch.float32, copy=True)
+            out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
+            out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
+            if cache is not None:
+                cache.put(cache_key, self.model, self.patches[key], out_weight)
+
         if inplace_update:
             comfy.utils.copy_to_param(self.model, key, out_weight)
         else:
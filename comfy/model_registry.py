@@ -0,0 +1,177 @@
+"""
+Loaded models (checkpoints, LoRAs, ControlNets, VAEs and the other loader outputs) kept in RAM
+across prompts, so a model is not read from disk again when a workflow goes back to it after the
+node output cache dropped it.
+
+Entries are keyed by the paths of the loaded files with their mtime and size, and the load options.
+With --model-cache-ram GB the least recently used entries are dropped once the estimated RAM size
+of the entries is over that many GB. Without it nothing is kept, loads are only counted.
+"""
+import collections
+import logging
+import os
+import threading
+from collections.abc import Mapping
+
+import torch
+
+from comfy.cli_args import args
+
+# How deep value_size() looks into the attributes of other objects
+SIZE_DEPTH = 3
+
+
+def value_size(value, seen=None, depth=0):
+    """
+    Estimated RAM bytes held by a loaded model: its CPU tensors, found in containers, modules, models
+    (ModelPatcher, or objects with a `patcher` like CLIP and VAE) and the attributes of other objects.
+    Weights loaded to another device don't count. Tensors that appear several times in the value are
+    only counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    if isinstance(value, torch.Tensor):
+        if value.device.type != "cpu" or value.data_ptr() in seen:
+            return 0
+        seen.add(value.data_ptr())
+        return value.nelement() * value.element_size()
+    seen.add(id(value))
+    if isinstance(value, (list, tuple)):
+        items = value
+    elif isinstance(value, Mapping):
+        items = value.values()
+    elif hasattr(value, "model_size") and hasattr(value, "loaded_size"):
+        # ModelPatcher, by the weights of its model that are in RAM
+        return value_size(value.model, seen, depth)
+    elif hasattr(value, "patcher"):
+        return value_size(value.patcher, seen, depth)
+    elif isinstance(value, torch.nn.Module):
+        return sum(value_size(t, seen, depth) for t in list(value.parameters()) + list(value.buffers()))
+    elif depth < SIZE_DEPTH and hasattr(value, "__dict__"):
+        # ControlNet, spandrel model descriptors, style models...
+        items = vars(value).values()
+        depth += 1
+    else:
+        return 0
+    return sum(value_size(item, seen, depth) for item in items)
+
+
+def file_fingerprint(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+
+class ModelRegistry:
+    """
+    Least recently used loaded models, at most `max_bytes` of them by value_size() (None for no
+    limit). A model that is loaded by several threads at the same time is only loaded once.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.loading = {}
+        self.ram_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "evicted_bytes": 0}
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                **self.stats,
+                "entries": len(self.entries),
+                "ram_bytes": self.ram_bytes,
+                "max_ram": self.max_bytes,
+            }
+
+    def _remove(self, key):
+        del self.entries[key]
+        size = self.sizes.pop(key)
+        self.ram_bytes -= size
+        self.stats["evictions"] += 1
+        self.stats["evicted_bytes"] += size
+
+    def _store(self, key, value):
+        # Older versions of the same files
+        for old_key in [k for k in self.entries if [f[0] for f in k[0]] == [f[0] for f in key[0]] and k[0] != key[0]]:
+            self._remove(old_key)
+        size = value_size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Storing it would drop every other entry before it drops the model itself
+            return
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.ram_bytes += size
+        while self.max_bytes is not None and self.ram_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def load(self, paths, load, **options):
+        """
+        The value returned by `load()` for the files at `paths` (a path or a list of them), loaded with
+        `options`, from the registry if it was loaded before and the files didn't change since.
+        """
+        if isinstance(paths, (str, os.PathLike)):
+            paths = [paths]
+        key = (tuple(file_fingerprint(path) for path in paths), repr(sorted(options.items())))
+        if self.max_bytes == 0:
+            with self.lock:
+                self.stats["misses"] += 1
+            return load()
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return self.entries[key]
+                loading = self.loading.get(key)
+                if loading is None:
+                    self.stats["misses"] += 1
+                    loading = self.loading[key] = threading.Event()
+                    break
+            loading.wait()
+            with self.lock:
+                loaded = key in self.entries
+                if not loaded:
+                    self.stats["misses"] += 1
+            if not loaded:
+                # The load failed or the model didn't fit, load it here
+                return load()
+
+        try:
+            value = load()
+            if value is not None:
+                with self.lock:
+                    self._store(key, value)
+            return value
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loading.set()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+
+
+_registry = None
+
+def registry():
+    """The registry of this process, with the --model-cache-ram budget."""
+    global _registry
+    if _registry is None:
+        max_bytes = 0 if args.model_cache_ram is None else int(args.model_cache_ram * 1024 ** 3)
+        _registry = ModelRegistry(max_bytes)
+        if max_bytes > 0:
+            logging.info("Keeping up to {:.1f} GB of loaded models in RAM.".format(args.model_cache_ram))
+    return _registry
+
+def load(paths, load, **options):
+    """ModelRegistry.load on the registry of this process."""
+    return registry().load(paths, load, **options)
+
+def stats():
+    return registry().get_stats()
@@ -2,8 +2,10 @@ import torch
 import comfy.model_management
 import comfy.samplers
 import comfy.utils
+import comfy.controlnet
 import numpy as np
 import logging
+import math
 
 def prepare_noise(latent_image, seed, noise_inds=None):
     """
@@ -48,3 +50,127 @@ def sample_custom(model, noise, cfg, sampler, sigmas, positive, negative, latent
     samples = comfy.samplers.sample(model, noise, positive, negative, cfg, model.load_device, sampler, sigmas, model_options=model.model_options, latent_image=latent_image, denoise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed)
     samples = samples.to(comfy.model_management.intermediate_device())
     return samples
+
+class CannotBatch(Exception):
+    pass
+
+def _same(a, b):
+    if a is b:
+        return True
+    if isinstance(a, (int, float, str, bool)) and type(a) is type(b):
+        return a == b
+    return False
+
+def batch_shared(values):
+    """Returns the value of a sampler input that every prompt of a batch has to share."""
+    for v in values[1:]:
+        if not _same(v, values[0]):
+            raise CannotBatch("inputs differ between prompts")
+    return values[0]
+
+# Sampler functions that add no noise after the initial noise with their default options. The
+# others (ancestral, SDE, ddpm, lcm...) draw more noise from the seed of the sampling call, a batch
+# would draw it from the seed of its first prompt for all of them.
+DETERMINISTIC_SAMPLER_FUNCTIONS = {"sample_euler", "sample_euler_cfg_pp", "sample_heun", "sample_heunpp2", "sample_dpm_2", "sample_lms",
+                                   "dpm_fast_function", "dpm_adaptive_function", "sample_dpmpp_2m", "sample_dpmpp_2m_cfg_pp",
+                                   "sample_ipndm", "sample_ipndm_v", "sample_deis", "sample_unipc", "sample_unipc_bh2"}
+
+def batch_sampler(sampler, noise_mask=None):
+    """
+    Raises CannotBatch if the sampler (a KSampler sampler name or a SAMPLER) adds noise while sampling,
+    the noise of each prompt would then depend on the prompts it is batched with.
+    """
+    if isinstance(sampler, str):
+        sampler = comfy.samplers.sampler_object(sampler)
+    name = getattr(getattr(sampler, "sampler_function", None), "__name__", None)
+    options = getattr(sampler, "extra_options", {})
+    if name not in DETERMINISTIC_SAMPLER_FUNCTIONS or options.get("eta", 0) or options.get("s_churn", 0) or options.get("noise_sampler") is not None:
+        raise CannotBatch("the sampler adds noise while sampling")
+    if noise_mask is not None and getattr(sampler, "inpaint_options", {}).get("random", False):
+        raise CannotBatch("the sampler adds seeded noise to the masked latent")
+    return sampler
+
+def batch_expand(values, batch_size):
+    """Per-prompt values of an input; a single value is shared by the whole batch."""
+    if len(values) == batch_size:
+        return list(values)
+    if len(values) == 1:
+        return list(values) * batch_size
+    raise CannotBatch("got {} values for a batch of {}".format(len(values), batch_size))
+
+def batch_tensors(tensors, pad_tokens=False):
+    if all(t is tensors[0] for t in tensors):
+        return tensors[0]
+    if any(t.shape[0] != 1 for t in tensors):
+        raise CannotBatch("only prompts with a batch size of 1 can be batched")
+    if pad_tokens and all(t.ndim == 3 and t.shape[2] == tensors[0].shape[2] for t in tensors):
+        #same padding with repeat as comfy.conds.CONDCrossAttn.concat, which doesn't change the result
+        max_len = 1
+        for t in tensors:
+            max_len = max_len * t.shape[1] // math.gcd(max_len, t.shape[1])
+        tensors = [t.repeat(1, max_len // t.shape[1], 1) for t in tensors]
+    if any(t.shape != tensors[0].shape for t in tensors):
+        raise CannotBatch("tensor shapes differ between prompts")
+    return torch.cat(tensors)
+
+def batch_latents(model, latents):
+    """Concatenates the per-prompt latents, returns (samples, noise_mask)."""
+    for latent in latents:
+        if "batch_index" in latent:
+            raise CannotBatch("latents with a batch_index can't be batched")
+        if latent["samples"].shape[0] != 1:
+            raise CannotBatch("only prompts with a batch size of 1 can be batched")
+    samples = [fix_empty_latent_channels(model, latent["samples"]) for latent in latents]
+    if any(x.shape != samples[0].shape for x in samples):
+        raise CannotBatch("latent sizes differ between prompts")
+    samples = torch.cat(samples)
+
+    noise_mask = None
+    masks = [latent.get("noise_mask", None) for latent in latents]
+    if any(m is not None for m in masks):
+        if any(m is None for m in masks):
+            raise CannotBatch("only some latents have a noise mask")
+        masks = [m.reshape((-1,) + tuple(m.shape[-2:])) for m in masks]
+        if any(m.shape != masks[0].shape or m.shape[0] != 1 for m in masks):
+            raise CannotBatch("noise masks differ in size between prompts")
+        noise_mask = torch.cat(masks)
+    return samples, noise_mask
+
+def batch_conditioning(conditionings, latent_shape, memo):
+    """
+    Merges the per-prompt conditionings of a batch: the tensors of every entry are concatenated along
+    the batch dimension (cross attention is padded to a common length) and controlnets get one hint per
+    prompt. Values that differ in any other way raise CannotBatch.
+    """
+    first = conditionings[0]
+    if all(c is first for c in conditionings):
+        return first
+    if any(len(c) != len(first) for c in conditionings):
+        raise CannotBatch("conditioning lengths differ between prompts")
+
+    out = []
+    for entries in zip(*conditionings):
+        cond = batch_tensors([e[0] for e in entries], pad_tokens=True)
+        options = {}
+        for k, v in entries[0][1].items():
+            values = [e[1].get(k, None) for e in entries]
+            if any(k not in e[1] for e in entries):
+                raise CannotBatch("conditioning options differ between prompts")
+            if all(x is v for x in values):
+                options[k] = v
+            elif all(isinstance(x, torch.Tensor) for x in values):
+                options[k] = batch_tensors(values)
+            elif all(isinstance(x, comfy.controlnet.ControlBase) for x in values):
+                options[k] = comfy.controlnet.batch_controls(values, latent_shape, memo)
+                if options[k] is None:
+                    raise CannotBatch("controlnets can't be merged")
+            else:
+                options[k] = batch_shared(values)
+        if any(len(e[1]) != len(options) for e in entries):
+            raise CannotBatch("conditioning options differ between prompts")
+        out.append([cond, options])
+    return out
+
+def prepare_noise_batch(latent_image, seeds):
+    """Noise for a batch of prompts, identical to what each prompt would get when sampled on its own."""
+    return torch.cat([prepare_noise(latent_image[i:i + 1], seed) for i, seed in enumerate(seeds)])
@@ -7,6 +7,7 @@ import traceback
 import zipfile
 from . import model_management
 import comfy.clip_model
+import comfy.utils
 import json
 import logging
 import numbers
@@ -229,7 +230,7 @@ class SDClipModel(torch.nn.Module, ClipTokenWeightEncoder):
         return self(tokens)
 
     def load_sd(self, sd):
-        return self.transformer.load_state_dict(sd, strict=False)
+        return comfy.utils.load_state_dict(self.transformer, sd, strict=False)
 
 def parse_parentheses(string):
     result = []
@@ -20,27 +20,154 @@
 import torch
 import math
 import struct
+import json
+import mmap
+import sys
+import threading
+import weakref
 import comfy.checkpoint_pickle
 import safetensors.torch
 import numpy as np
 from PIL import Image
 import logging
 import itertools
+from comfy.cli_args import args
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+    "F8_E4M3": torch.float8_e4m3fn, "F8_E5M2": torch.float8_e5m2,
+}
+
+# Not defined by every Python build, the value is the same on all Linux architectures.
+MADV_PAGEOUT = getattr(mmap, "MADV_PAGEOUT", 21 if sys.platform.startswith("linux") else None)
+
+# Bytes of memory mapped weights load_state_dict() copies into a module before it releases their pages.
+LOAD_CHUNK_BYTES = 256 * 1024 * 1024
+
+# The memory maps of load_safetensors_mmap() that still have tensors, with their base addresses.
+mapped_files = weakref.WeakKeyDictionary()
+
+def load_safetensors_mmap(path):
+    """
+    The tensors of a .safetensors file as views of a private (copy on write) memory map of the file.
+    Nothing is read until a tensor is used, renaming or slicing the tensors keeps them on the same
+    pages, and the pages are shared with the page cache instead of being a second copy of the file.
+    The map is closed once the last tensor is gone, see also release_pages().
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    mapped_files[mapping] = torch.frombuffer(mapping, dtype=torch.uint8, count=1).data_ptr()
+    data_start = 8 + header_size
+    sd = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if end == begin:
+            sd[name] = torch.empty(info["shape"], dtype=dtype)
+        else:
+            sd[name] = torch.frombuffer(mapping, dtype=dtype, count=(end - begin) // dtype.itemsize, offset=data_start + begin).view(info["shape"])
+    return sd
+
+def release_pages(tensors):
+    """
+    Hands the memory pages of tensors from load_safetensors_mmap() back to the OS, once they were
+    copied to the model weights. The contents are kept: pages are read from the file again (or swapped
+    back in, if they were written to) when the tensors are used later.
+    """
+    if MADV_PAGEOUT is None:
+        return
+    ranges = {}
+    for t in tensors:
+        storage = t.untyped_storage()
+        ptr = storage.data_ptr()
+        for mapping, base in list(mapped_files.items()):
+            if base <= ptr < base + len(mapping):
+                ranges.setdefault(mapping, []).append((ptr - base, ptr - base + storage.nbytes()))
+                break
+
+    for mapping, spans in ranges.items():
+        spans.sort()
+        merged = [list(spans[0])]
+        for begin, end in spans[1:]:
+            if begin <= merged[-1][1] + mmap.PAGESIZE:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([begin, end])
+        for begin, end in merged:
+            start = begin - begin % mmap.PAGESIZE
+            try:
+                mapping.madvise(MADV_PAGEOUT, start, end - start)
+            except (OSError, ValueError):
+                return # Not supported by the kernel
+
+def is_mapped(t):
+    ptr = t.untyped_storage().data_ptr()
+    return any(base <= ptr < base + len(mapping) for mapping, base in list(mapped_files.items()))
+
+def load_state_dict(module, sd, strict=False):
+    """
+    module.load_state_dict(sd, strict), but memory mapped weights (see load_safetensors_mmap) are
+    copied about LOAD_CHUNK_BYTES at a time and their pages are released after every chunk, so the
+    file is never resident next to the whole model. Returns (missing keys, unexpected keys).
+    """
+    if len(mapped_files) == 0 or not any(is_mapped(v) for v in sd.values() if isinstance(v, torch.Tensor)):
+        return module.load_state_dict(sd, strict=strict)
+
+    # The tensors of one module stay in the same chunk
+    chunks = [{}]
+    size = 0
+    module_prefix = None
+    for k, v in sd.items():
+        prefix = k.rsplit(".", 1)[0]
+        if size >= LOAD_CHUNK_BYTES and prefix != module_prefix:
+            chunks.append({})
+            size = 0
+        chunks[-1][k] = v
+        module_prefix = prefix
+        if isinstance(v, torch.Tensor):
+            size += v.nbytes
+
+    unexpected = []
+    for chunk in chunks:
+        unexpected += module.load_state_dict(chunk, strict=False).unexpected_keys
+        release_pages(v for v in chunk.values() if isinstance(v, torch.Tensor))
+    missing = [k for k in module.state_dict().keys() if k not in sd]
+    if strict and (len(missing) > 0 or len(unexpected) > 0):
+        raise RuntimeError("Error(s) in loading state_dict for {}: missing keys {}, unexpected keys {}".format(module.__class__.__name__, missing, unexpected))
+    return missing, unexpected
 
 def load_torch_file(ckpt, safe_load=False, device=None):
     if device is None:
         device = torch.device("cpu")
     if ckpt.lower().endswith(".safetensors") or ckpt.lower().endswith(".sft"):
-        sd = safetensors.torch.load_file(ckpt, device=device.type)
+        sd = None
+        if device.type == "cpu" and not args.disable_mmap:
+            try:
+                sd = load_safetensors_mmap(ckpt)
+            except (KeyError, ValueError, OSError):
+                logging.debug("Could not memory map {}, reading it instead.".format(ckpt))
+        if sd is None:
+            sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
             if not 'weights_only' in torch.load.__code__.co_varnames:
                 logging.warning("Warning torch.load doesn't support weights_only on this pytorch version, loading unsafely.")
                 safe_load = False
-        if safe_load:
-            pl_sd = torch.load(ckpt, map_location=device, weights_only=True)
-        else:
-            pl_sd = torch.load(ckpt, map_location=device, pickle_module=comfy.checkpoint_pickle)
+        load_args = {"weights_only": True} if safe_load else {"pickle_module": comfy.checkpoint_pickle}
+        pl_sd = None
+        if not args.disable_mmap and 'mmap' in torch.load.__code__.co_varnames:
+            try:
+                pl_sd = torch.load(ckpt, map_location=device, mmap=True, **load_args)
+            except RuntimeError:
+                pass # Only files in the zip format can be memory mapped
+        if pl_sd is None:
+            pl_sd = torch.load(ckpt, map_location=device, **load_args)
         if "global_step" in pl_sd:
             logging.debug(f"Global Step: {pl_sd['global_step']}")
         if "state_dict" in pl_sd:
@@ -785,12 +912,17 @@ def set_progress_bar_global_hook(function):
     global PROGRESS_BAR_HOOK
     PROGRESS_BAR_HOOK = function
 
+# The node that progress bars created on this thread belong to. Set for the nodes that run on the
+# node thread pool of the executor, the hook is then called with node_id.
+PROGRESS_BAR_NODE = threading.local()
+
 class ProgressBar:
-    def __init__(self, total):
+    def __init__(self, total, node_id=None):
         global PROGRESS_BAR_HOOK
         self.total = total
         self.current = 0
         self.hook = PROGRESS_BAR_HOOK
+        self.node_id = node_id if node_id is not None else getattr(PROGRESS_BAR_NODE, "node_id", None)
 
     def update_absolute(self, value, total=None, preview=None):
         if total is not None:
@@ -799,7 +931,10 @@ class ProgressBar:
             value = self.total
         self.current = value
         if self.hook is not None:
-            self.hook(self.current, self.total, preview)
+            if self.node_id is None:
+                self.hook(self.current, self.total, preview)
+            else:
+                self.hook(self.current, self.total, preview, node_id=self.node_id)
 
     def update(self, value):
         self.update_absolute(self.current + value)
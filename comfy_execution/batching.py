@@ -0,0 +1,120 @@
+import copy
+import json
+
+import nodes
+from comfy_execution.graph_utils import is_link
+
+class BatchedInput(tuple):
+    """
+    The per-prompt values of a constant input in a merged prompt. get_input_data() hands them to the
+    node as an input list, so the node (and everything downstream of it) runs once per prompt, except
+    for nodes with a BATCH_FUNCTION, which get all of them in one call.
+    """
+    pass
+
+def batchable_inputs(class_type):
+    class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+    return getattr(class_def, "BATCHABLE_INPUTS", ())
+
+def batch_key(prompt, outputs):
+    """
+    Prompts with the same key have the same graph and only differ in constant inputs that their nodes
+    list in BATCHABLE_INPUTS (seeds, prompt text, input images), so they can be merged.
+    """
+    key = {}
+    for node_id, node in prompt.items():
+        batchable = batchable_inputs(node["class_type"])
+        inputs = {}
+        for name, value in node["inputs"].items():
+            if name in batchable and not is_link(value):
+                value = None
+            inputs[name] = value
+        key[node_id] = [node["class_type"], inputs]
+    return json.dumps([key, sorted(outputs)], sort_keys=True, default=str)
+
+def merge_prompts(prompts):
+    """Merges prompts with the same batch_key(), inputs that differ become BatchedInputs."""
+    merged = {}
+    for node_id, node in prompts[0].items():
+        inputs = {}
+        for name, value in node["inputs"].items():
+            values = [prompt[node_id]["inputs"][name] for prompt in prompts]
+            if is_link(value) or all(v == value for v in values):
+                inputs[name] = value
+            else:
+                inputs[name] = BatchedInput(values)
+        merged[node_id] = {**node, "inputs": inputs}
+    return merged
+
+def merge_extra_data(extra_datas, prompts):
+    # Messages go to the first client. Nodes that embed the prompt or workflow (SaveImage) get the
+    # values of their own prompt.
+    extra_data = copy.copy(extra_datas[0])
+    extra_data["batch_prompts"] = list(prompts)
+    extra_data["batch_extra_pnginfo"] = [e.get("extra_pnginfo", None) for e in extra_datas]
+    return extra_data
+
+def per_prompt_nodes(merged):
+    """The nodes of a merged prompt that run once per prompt."""
+    to_visit = []
+    for node_id, node in merged.items():
+        if any(isinstance(value, BatchedInput) for value in node["inputs"].values()):
+            to_visit.append(node_id)
+            continue
+        class_def = nodes.NODE_CLASS_MAPPINGS[node["class_type"]]
+        hidden = class_def.INPUT_TYPES().get("hidden", {})
+        if any(h in ("PROMPT", "EXTRA_PNGINFO") for h in hidden.values()):
+            to_visit.append(node_id)
+
+    consumers = {}
+    for node_id, node in merged.items():
+        for value in node["inputs"].values():
+            if is_link(value):
+                consumers.setdefault(value[0], []).append(node_id)
+
+    result = set()
+    while len(to_visit) > 0:
+        node_id = to_visit.pop()
+        if node_id in result:
+            continue
+        result.add(node_id)
+        to_visit += consumers.get(node_id, [])
+    return result
+
+def _split_list(values, batch_size, index):
+    if isinstance(values, list) and len(values) % batch_size == 0:
+        size = len(values) // batch_size
+        return values[index * size:(index + 1) * size]
+    return values
+
+def split_results(merged, batch_size, history_result, output_data):
+    """
+    Splits the history result and raw outputs of a merged prompt into one (history_result, output_data)
+    per prompt. Nodes that ran once per prompt are divided evenly, shared nodes are copied.
+    """
+    split_nodes = per_prompt_nodes(merged)
+    results = []
+    for i in range(batch_size):
+        prompt_history = {}
+        for key, node_results in history_result.items():
+            prompt_history[key] = {}
+            for node_id, ui in node_results.items():
+                if node_id in split_nodes and isinstance(ui, dict):
+                    ui = {k: _split_list(v, batch_size, i) for k, v in ui.items()}
+                prompt_history[key][node_id] = ui
+
+        prompt_outputs = {}
+        for node_id, outputs in (output_data or {}).items():
+            if node_id in split_nodes and outputs is not None:
+                outputs = [_split_list(o, batch_size, i) for o in outputs]
+            prompt_outputs[node_id] = outputs
+        results.append((prompt_history, prompt_outputs))
+    return results
+
+def split_status_messages(messages, prompt_id):
+    out = []
+    for event, data in messages:
+        if isinstance(data, dict) and "prompt_id" in data:
+            data = {**data, "prompt_id": prompt_id}
+        out.append((event, data))
+    return out
@@ -1,7 +1,16 @@
-import itertools
-from typing import Sequence, Mapping, Dict
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+import weakref
+from typing import Mapping, Dict
 from comfy_execution.graph import DynamicPrompt
 
+import torch
+import safetensors.torch
 import nodes
 
 from comfy_execution.graph_utils import is_link
@@ -39,23 +48,6 @@ class CacheKeySet:
     def get_subcache_key(self, node_id):
         return self.subcache_keys.get(node_id, None)
 
-class Unhashable:
-    def __init__(self):
-        self.value = float("NaN")
-
-def to_hashable(obj):
-    # So that we don't infinitely recurse since frozenset and tuples
-    # are Sequences.
-    if isinstance(obj, (int, float, str, bool, type(None))):
-        return obj
-    elif isinstance(obj, Mapping):
-        return frozenset([(to_hashable(k), to_hashable(v)) for k, v in sorted(obj.items())])
-    elif isinstance(obj, Sequence):
-        return frozenset(zip(itertools.count(), [to_hashable(i) for i in obj]))
-    else:
-        # TODO - Support other objects like tensors?
-        return Unhashable()
-
 class CacheKeySetID(CacheKeySet):
     def __init__(self, dynprompt, node_ids, is_changed_cache):
         super().__init__(dynprompt, node_ids, is_changed_cache)
@@ -72,11 +64,34 @@ class CacheKeySetID(CacheKeySet):
             self.keys[node_id] = (node_id, node["class_type"])
             self.subcache_keys[node_id] = (node_id, node["class_type"])
 
+# Prefix of the keys of nodes that cannot be cached, see CacheKeySetInputSignature
+UNCACHEABLE_PREFIX = "uncacheable:"
+
+def signature_digest(signature):
+    """
+    A hex digest of a node signature that is the same in every process, or None if the signature
+    holds a NaN (nodes that always change) or values that are not plain data.
+    """
+    try:
+        data = json.dumps(signature, sort_keys=True, allow_nan=False, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
 class CacheKeySetInputSignature(CacheKeySet):
+    """
+    Keys nodes by a Merkle hash: the digest of the class, IS_CHANGED result and constant inputs of
+    the node together with the hashes of the nodes linked to its inputs. Each hash is computed once
+    per prompt, and a node gets the same key in every prompt where nothing upstream of it changed.
+    Nodes that cannot be cached, and everything downstream of them, get a key that is unique to
+    the prompt.
+    """
     def __init__(self, dynprompt, node_ids, is_changed_cache):
         super().__init__(dynprompt, node_ids, is_changed_cache)
         self.dynprompt = dynprompt
         self.is_changed_cache = is_changed_cache
+        # Hashes of the nodes in `keys` and of their ancestors
+        self.hashes = {}
         self.add_keys(node_ids)
 
     def include_node_id_in_input(self) -> bool:
@@ -92,18 +107,37 @@ class CacheKeySetInputSignature(CacheKeySet):
             self.keys[node_id] = self.get_node_signature(self.dynprompt, node_id)
             self.subcache_keys[node_id] = (node_id, node["class_type"])
 
+    def get_digest(self, node_id):
+        key = self.keys.get(node_id)
+        if key is None or key.startswith(UNCACHEABLE_PREFIX):
+            return None
+        return key
+
     def get_node_signature(self, dynprompt, node_id):
-        signature = []
-        ancestors, order_mapping = self.get_ordered_ancestry(dynprompt, node_id)
-        signature.append(self.get_immediate_node_signature(dynprompt, node_id, order_mapping))
-        for ancestor_id in ancestors:
-            signature.append(self.get_immediate_node_signature(dynprompt, ancestor_id, order_mapping))
-        return to_hashable(signature)
-
-    def get_immediate_node_signature(self, dynprompt, node_id, ancestor_order_mapping):
+        # Post-order walk over the ancestors without a hash yet. Not recursive, workflows can be
+        # deeper than the recursion limit. `expanded` are the nodes waiting for their inputs, an
+        # input that is already expanded is a cycle.
+        expanded = set()
+        stack = [node_id]
+        while len(stack) > 0:
+            current = stack[-1]
+            if current in self.hashes:
+                stack.pop()
+                continue
+            if current not in expanded and dynprompt.has_node(current):
+                expanded.add(current)
+                for value in dynprompt.get_node(current)["inputs"].values():
+                    if is_link(value) and value[0] not in self.hashes and value[0] not in expanded:
+                        stack.append(value[0])
+                continue
+            stack.pop()
+            self.hashes[current] = self.get_immediate_node_signature(dynprompt, current)
+        return self.hashes[node_id]
+
+    def get_immediate_node_signature(self, dynprompt, node_id):
         if not dynprompt.has_node(node_id):
             # This node doesn't exist -- we can't cache it.
-            return [float("NaN")]
+            return UNCACHEABLE_PREFIX + uuid.uuid4().hex
         node = dynprompt.get_node(node_id)
         class_type = node["class_type"]
         class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
@@ -111,35 +145,227 @@ class CacheKeySetInputSignature(CacheKeySet):
         if self.include_node_id_in_input() or (hasattr(class_def, "NOT_IDEMPOTENT") and class_def.NOT_IDEMPOTENT) or include_unique_id_in_input(class_type):
             signature.append(node_id)
         inputs = node["inputs"]
+        cacheable = True
         for key in sorted(inputs.keys()):
             if is_link(inputs[key]):
                 (ancestor_id, ancestor_socket) = inputs[key]
-                ancestor_index = ancestor_order_mapping[ancestor_id]
-                signature.append((key,("ANCESTOR", ancestor_index, ancestor_socket)))
+                if ancestor_id not in self.hashes:
+                    # Part of a cycle
+                    return UNCACHEABLE_PREFIX + uuid.uuid4().hex
+                cacheable = cacheable and not self.hashes[ancestor_id].startswith(UNCACHEABLE_PREFIX)
+                signature.append((key, ("ANCESTOR", self.hashes[ancestor_id], ancestor_socket)))
             else:
                 signature.append((key, inputs[key]))
-        return signature
-
-    # This function returns a list of all ancestors of the given node. The order of the list is
-    # deterministic based on which specific inputs the ancestor is connected by.
-    def get_ordered_ancestry(self, dynprompt, node_id):
-        ancestors = []
-        order_mapping = {}
-        self.get_ordered_ancestry_internal(dynprompt, node_id, ancestors, order_mapping)
-        return ancestors, order_mapping
-
-    def get_ordered_ancestry_internal(self, dynprompt, node_id, ancestors, order_mapping):
-        if not dynprompt.has_node(node_id):
-            return
-        inputs = dynprompt.get_node(node_id)["inputs"]
-        input_keys = sorted(inputs.keys())
-        for key in input_keys:
-            if is_link(inputs[key]):
-                ancestor_id = inputs[key][0]
-                if ancestor_id not in order_mapping:
-                    ancestors.append(ancestor_id)
-                    order_mapping[ancestor_id] = len(ancestors) - 1
-                    self.get_ordered_ancestry_internal(dynprompt, ancestor_id, ancestors, order_mapping)
+        digest = signature_digest(signature)
+        if digest is None:
+            return UNCACHEABLE_PREFIX + uuid.uuid4().hex
+        # Unique anyway, the hash of the uncacheable ancestor is random
+        return digest if cacheable else UNCACHEABLE_PREFIX + digest
+
+def output_size(value, seen=None):
+    """
+    Estimated (RAM bytes, VRAM bytes) held by a node output: tensors by their device, models
+    (ModelPatcher, or objects with a `patcher` like CLIP and VAE) by their weights. Tensors and
+    models that appear several times in the value are only counted once.
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(value, torch.Tensor):
+        if value.device.type == "meta" or (value.data_ptr(), value.device) in seen:
+            return 0, 0
+        seen.add((value.data_ptr(), value.device))
+        size = value.nelement() * value.element_size()
+        return (size, 0) if value.device.type == "cpu" else (0, size)
+    if isinstance(value, (list, tuple)):
+        items = value
+    elif isinstance(value, Mapping):
+        items = value.values()
+    elif hasattr(value, "model_size") and hasattr(value, "loaded_size"):
+        if id(value.model) in seen:
+            return 0, 0
+        seen.add(id(value.model))
+        size = value.model_size()
+        vram = value.loaded_size() if value.load_device != value.offload_device else 0
+        return max(size - vram, 0), vram
+    elif hasattr(value, "patcher"):
+        return output_size(value.patcher, seen)
+    else:
+        return 0, 0
+    ram, vram = 0, 0
+    for item in items:
+        item_ram, item_vram = output_size(item, seen)
+        ram += item_ram
+        vram += item_vram
+    return ram, vram
+
+# Every LRUCache with a name, for cache_stats()
+LRU_CACHES = weakref.WeakSet()
+
+def cache_stats():
+    """Counters of the live named LRU caches, summed per name."""
+    out = {}
+    for cache in list(LRU_CACHES):
+        stats = out.setdefault(cache.name, {})
+        for k, v in cache.get_stats().items():
+            stats[k] = v if stats.get(k) is None else stats[k] + (v or 0)
+    return out
+
+# Output types that are written to the disk cache by default, see disk_cacheable(). Encoder outputs
+# are small next to the time they take. Images and latents of samplers and decoders are large and
+# rarely computed twice with the same inputs, those nodes can opt in with DISK_CACHEABLE.
+DISK_CACHEABLE_TYPES = {"CONDITIONING"}
+DISK_CACHEABLE_PLAIN_TYPES = {"INT", "FLOAT", "STRING", "BOOLEAN"}
+
+# Results that took less time than this to compute are not worth a disk write
+DISK_CACHE_MIN_TIME = 0.1
+
+def disk_cacheable(class_def, execution_time):
+    """
+    Whether the result of a node should be written to the disk cache. Nodes opt in or out with
+    the DISK_CACHEABLE class attribute, otherwise results of nodes that return conditioning (and
+    maybe plain data) and took at least DISK_CACHE_MIN_TIME to compute are written.
+    """
+    cacheable = getattr(class_def, "DISK_CACHEABLE", None)
+    if cacheable is not None:
+        return cacheable
+    if getattr(class_def, "OUTPUT_NODE", False) or getattr(class_def, "NOT_IDEMPOTENT", False):
+        return False
+    types = set(class_def.RETURN_TYPES)
+    return execution_time >= DISK_CACHE_MIN_TIME and len(types & DISK_CACHEABLE_TYPES) > 0 and types <= DISK_CACHEABLE_TYPES | DISK_CACHEABLE_PLAIN_TYPES
+
+class NotDiskCacheable(Exception):
+    pass
+
+def _encode_value(value, tensors, memo):
+    if isinstance(value, torch.Tensor):
+        if id(value) not in memo:
+            memo[id(value)] = str(len(tensors))
+            tensors[memo[id(value)]] = value.detach().to("cpu", copy=True).contiguous()
+        return {"__tensor__": memo[id(value)]}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [_encode_value(v, tensors, memo) for v in value]
+    if isinstance(value, tuple):
+        return {"__tuple__": [_encode_value(v, tensors, memo) for v in value]}
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {"__dict__": {k: _encode_value(v, tensors, memo) for k, v in value.items()}}
+    raise NotDiskCacheable(type(value).__name__)
+
+def _decode_value(value, tensors):
+    if isinstance(value, list):
+        return [_decode_value(v, tensors) for v in value]
+    if isinstance(value, dict):
+        if "__tensor__" in value:
+            return tensors[value["__tensor__"]]
+        if "__tuple__" in value:
+            return tuple(_decode_value(v, tensors) for v in value["__tuple__"])
+        return {k: _decode_value(v, tensors) for k, v in value["__dict__"].items()}
+    return value
+
+class DiskCache:
+    """
+    Node results in safetensors files under `path`, named by the digest of their input signature,
+    so they survive restarts and are shared by all the server processes using the same directory.
+    Only tensors and plain data (lists, tuples, dicts with string keys) can be stored. Files are
+    written to a temporary name and renamed, read with a memory map, and the least recently read
+    are deleted once the directory holds more than `max_bytes`. put_async() copies the tensors and
+    leaves the write to a background thread, so the prompt doesn't wait for the disk.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk_cache")
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, _, size in self._files())
+
+    def _file(self, digest):
+        return os.path.join(self.path, digest[:2], digest + ".safetensors")
+
+    def _files(self):
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if not entry.name.endswith(".safetensors"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def get(self, digest):
+        path = self._file(digest)
+        try:
+            with safetensors.safe_open(path, framework="pt") as f:
+                structure = json.loads(f.metadata()["structure"])
+                tensors = {k: f.get_tensor(k) for k in f.keys()}
+            # The modification time is the last use, for prune()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning("Ignoring unreadable disk cache entry {}: {}".format(path, e))
+            return None
+        return _decode_value(structure, tensors)
+
+    def _encode(self, digest, value):
+        tensors = {}
+        try:
+            return _encode_value(value, tensors, {}), tensors
+        except NotDiskCacheable as e:
+            logging.debug("Not writing {} to the disk cache, it holds a {}".format(digest, e))
+            return None, None
+
+    def put(self, digest, value):
+        structure, tensors = self._encode(digest, value)
+        if tensors is None:
+            return False
+        return self._write(digest, structure, tensors)
+
+    def put_async(self, digest, value):
+        """put() on the background writer, the tensors are copied before it returns."""
+        structure, tensors = self._encode(digest, value)
+        if tensors is None:
+            return None
+        return self.writer.submit(self._write, digest, structure, tensors)
+
+    def flush(self):
+        """Waits for the writes of put_async()."""
+        self.writer.submit(lambda: None).result()
+
+    def _write(self, digest, structure, tensors):
+        path = self._file(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        try:
+            safetensors.torch.save_file(tensors, temp_path, metadata={"structure": json.dumps(structure)})
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning("Could not write to the disk cache: {}".format(e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        with self.lock:
+            self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self.prune()
+        return True
+
+    def prune(self):
+        # Other processes write to the same directory, so the size is counted again
+        files = sorted(self._files(), key=lambda f: f[1])
+        self.size = sum(size for _, _, size in files)
+        for path, _, size in files:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
 
 class BasicCache:
     def __init__(self, key_class):
@@ -149,6 +375,8 @@ class BasicCache:
         self.cache_key_set: CacheKeySet
         self.cache = {}
         self.subcaches = {}
+        # Second tier for results that are not in memory, see DiskCache
+        self.disk_cache = None
 
     def set_prompt(self, dynprompt, node_ids, is_changed_cache):
         self.dynprompt = dynprompt
@@ -201,6 +429,24 @@ class BasicCache:
         else:
             return None
 
+    def _get_from_disk(self, node_id):
+        if self.disk_cache is None or not hasattr(self.cache_key_set, "get_digest"):
+            return None
+        digest = self.cache_key_set.get_digest(node_id)
+        if digest is None:
+            return None
+        return self.disk_cache.get(digest)
+
+    def _put_on_disk(self, node_id, value, execution_time):
+        if self.disk_cache is None or execution_time is None or not hasattr(self.cache_key_set, "get_digest"):
+            return
+        class_def = nodes.NODE_CLASS_MAPPINGS[self.dynprompt.get_node(node_id)["class_type"]]
+        if not disk_cacheable(class_def, execution_time):
+            return
+        digest = self.cache_key_set.get_digest(node_id)
+        if digest is not None:
+            self.disk_cache.put_async(digest, value)
+
     def _ensure_subcache(self, node_id, children_ids):
         subcache_key = self.cache_key_set.get_subcache_key(node_id)
         subcache = self.subcaches.get(subcache_key, None)
@@ -252,12 +498,19 @@ class HierarchicalCache(BasicCache):
         cache = self._get_cache_for(node_id)
         if cache is None:
             return None
-        return cache._get_immediate(node_id)
-
-    def set(self, node_id, value):
+        value = cache._get_immediate(node_id)
+        if value is None and cache.initialized:
+            value = cache._get_from_disk(node_id)
+            if value is not None:
+                cache._set_immediate(node_id, value)
+        return value
+
+    def set(self, node_id, value, execution_time=None):
+        # execution_time is only used by LRUCache
         cache = self._get_cache_for(node_id)
         assert cache is not None
         cache._set_immediate(node_id, value)
+        cache._put_on_disk(node_id, value, execution_time)
 
     def ensure_subcache_for(self, node_id, children_ids):
         cache = self._get_cache_for(node_id)
@@ -265,13 +518,43 @@ class HierarchicalCache(BasicCache):
         return cache._ensure_subcache(node_id, children_ids)
 
 class LRUCache(BasicCache):
-    def __init__(self, key_class, max_size=100):
+    """
+    Keeps results of earlier prompts until there are more than `max_size` of them (None for no
+    limit), the least recently used are dropped first. `max_ram` and `max_vram` bound the bytes of
+    the cached values as estimated by output_size() whenever values are added. Over budget, the values of earlier prompts
+    that are worth the least per byte, by execution time times the times they were reused, are
+    dropped first.
+    """
+    def __init__(self, key_class, max_size=100, max_ram=None, max_vram=None, name=None):
         super().__init__(key_class)
         self.max_size = max_size
+        self.max_ram = max_ram
+        self.max_vram = max_vram
         self.min_generation = 0
         self.generation = 0
         self.used_generation = {}
         self.children = {}
+        self.sizes = {}
+        self.execution_times = {}
+        self.hits = {}
+        self.counted_generation = {}
+        self.ram_bytes = 0
+        self.vram_bytes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "evicted_bytes": 0}
+        self.name = name
+        if name is not None:
+            LRU_CACHES.add(self)
+
+    def get_stats(self):
+        self._measure()
+        return {
+            **self.stats,
+            "entries": len(self.cache),
+            "ram_bytes": self.ram_bytes,
+            "vram_bytes": self.vram_bytes,
+            "max_ram": self.max_ram,
+            "max_vram": self.max_vram,
+        }
 
     def set_prompt(self, dynprompt, node_ids, is_changed_cache):
         super().set_prompt(dynprompt, node_ids, is_changed_cache)
@@ -279,29 +562,96 @@ class LRUCache(BasicCache):
         for node_id in node_ids:
             self._mark_used(node_id)
 
+    def _measure(self):
+        """
+        Sizes of the values as they are now: models move between RAM and VRAM after they were cached.
+        Models and tensors that several values share (clones of a ModelPatcher with different LoRAs
+        share the model) are counted once, for the most recently used value.
+        """
+        seen = set()
+        self.sizes = {}
+        for key in sorted(self.cache, key=lambda k: self.used_generation.get(k, 0), reverse=True):
+            self.sizes[key] = output_size(self.cache[key], seen)
+        self.ram_bytes = sum(ram for ram, _ in self.sizes.values())
+        self.vram_bytes = sum(vram for _, vram in self.sizes.values())
+
+    def _remove(self, key):
+        ram, vram = self.sizes.pop(key, (0, 0))
+        self.ram_bytes -= ram
+        self.vram_bytes -= vram
+        del self.cache[key]
+        del self.used_generation[key]
+        self.children.pop(key, None)
+        self.execution_times.pop(key, None)
+        self.hits.pop(key, None)
+        self.counted_generation.pop(key, None)
+        self.stats["evictions"] += 1
+        self.stats["evicted_bytes"] += ram + vram
+
+    def _benefit(self, key):
+        ram, vram = self.sizes[key]
+        return self.execution_times.get(key, 0.0) * (self.hits.get(key, 0) + 1) / max(ram + vram, 1)
+
+    def _evict_over_budget(self):
+        if self.max_ram is None and self.max_vram is None:
+            return
+        while True:
+            self._measure()
+            over_ram = self.max_ram is not None and self.ram_bytes > self.max_ram
+            over_vram = self.max_vram is not None and self.vram_bytes > self.max_vram
+            if not (over_ram or over_vram):
+                return
+            # Values used by the current prompt are kept
+            candidates = [key for key in self.cache if self.used_generation[key] < self.generation and
+                          ((over_ram and self.sizes[key][0] > 0) or (over_vram and self.sizes[key][1] > 0))]
+            if len(candidates) == 0:
+                return
+            self._remove(min(candidates, key=self._benefit))
+
     def clean_unused(self):
-        while len(self.cache) > self.max_size and self.min_generation < self.generation:
+        while self.max_size is not None and len(self.cache) > self.max_size and self.min_generation < self.generation:
             self.min_generation += 1
             to_remove = [key for key in self.cache if self.used_generation[key] < self.min_generation]
             for key in to_remove:
-                del self.cache[key]
-                del self.used_generation[key]
-                if key in self.children:
-                    del self.children[key]
+                self._remove(key)
+        self._evict_over_budget()
         self._clean_subcaches()
 
     def get(self, node_id):
         self._mark_used(node_id)
-        return self._get_immediate(node_id)
+        value = self._get_immediate(node_id)
+        if value is None and self.initialized:
+            value = self._get_from_disk(node_id)
+            if value is not None:
+                self.stats["disk_hits"] += 1
+                self._store(node_id, value)
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        # The executor looks a value up several times per prompt, count it once per prompt
+        if cache_key is not None and self.counted_generation.get(cache_key) != self.generation:
+            self.counted_generation[cache_key] = self.generation
+            if value is not None:
+                self.hits[cache_key] = self.hits.get(cache_key, 0) + 1
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+        return value
 
     def _mark_used(self, node_id):
         cache_key = self.cache_key_set.get_data_key(node_id)
         if cache_key is not None:
             self.used_generation[cache_key] = self.generation
 
-    def set(self, node_id, value):
+    def _store(self, node_id, value):
+        self._set_immediate(node_id, value)
+        return self.cache_key_set.get_data_key(node_id)
+
+    def set(self, node_id, value, execution_time=None):
         self._mark_used(node_id)
-        return self._set_immediate(node_id, value)
+        cache_key = self._store(node_id, value)
+        if execution_time is not None:
+            self.execution_times[cache_key] = execution_time
+        self._put_on_disk(node_id, value, execution_time)
+        self._evict_over_budget()
 
     def ensure_subcache_for(self, node_id, children_ids):
         # Just uses subcaches for tracking 'live' nodes
@@ -0,0 +1,149 @@
+import json
+import threading
+import uuid
+import torch
+
+import execution
+from comfy_execution import image_writer
+from comfy_execution.graph_utils import is_link
+
+class WorkflowTemplateError(Exception):
+    pass
+
+class WorkflowExecutionError(Exception):
+    pass
+
+class WorkflowTemplate:
+    """
+    A workflow in API format that is parsed and validated once and then instantiated for every request
+    with a small set of parameter overrides. Nodes are addressed by their "_meta" title, the same way
+    the frontend and comfy_api_simplified name them.
+
+    For every title in `output_titles` the template remembers which node feeds that output node's
+    "images" input. Running the template executes up to those nodes and hands back their tensors, so
+    the output nodes themselves (and their PNG writes) are skipped.
+    """
+    def __init__(self, prompt, output_titles):
+        self.prompt = prompt
+        self.node_ids_by_title = {}
+        for node_id, node in prompt.items():
+            title = node.get("_meta", {}).get("title", node["class_type"])
+            self.node_ids_by_title.setdefault(title, []).append(node_id)
+
+        self.prompt_template = execution.PromptTemplate(prompt)
+        valid = self.prompt_template.valid
+        if not valid[0]:
+            raise WorkflowTemplateError("Invalid workflow template: {}: {}".format(valid[1]["message"], valid[1]["details"]))
+
+        self.captures = {}
+        for title in output_titles:
+            node_id = self.get_node_ids(title)[0]
+            images = prompt[node_id]["inputs"].get("images")
+            if not is_link(images):
+                raise WorkflowTemplateError("Output node '{}' has no linked images input".format(title))
+            self.captures[title] = (images[0], images[1])
+
+    @classmethod
+    def from_file(cls, path, output_titles):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f), output_titles)
+
+    def get_node_ids(self, title):
+        if title not in self.node_ids_by_title:
+            raise WorkflowTemplateError("Node '{}' not found in workflow template".format(title))
+        return self.node_ids_by_title[title]
+
+    def node_overrides(self, overrides=None):
+        # Overrides are addressed by title, execution.PromptTemplate works with node ids.
+        node_overrides = {}
+        if overrides is not None:
+            for title, params in overrides.items():
+                for node_id in self.get_node_ids(title):
+                    node_overrides.setdefault(node_id, {}).update(params)
+        return node_overrides
+
+    def instantiate(self, overrides=None):
+        return self.prompt_template.instantiate(self.node_overrides(overrides))
+
+    def validate(self, overrides=None):
+        """Validates only the overridden nodes, see execution.PromptTemplate."""
+        return self.prompt_template.validate(self.node_overrides(overrides))
+
+    def execute_outputs(self):
+        return sorted(set(node_id for node_id, _ in self.captures.values()))
+
+class EmbeddedPrompt:
+    def __init__(self, prompt_id, template):
+        self.prompt_id = prompt_id
+        self.template = template
+        self.done = threading.Event()
+        self.status = None
+        self.output_data = None
+
+    def set_result(self, status, output_data):
+        self.status = status
+        self.output_data = output_data
+        self.done.set()
+
+    def result(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError("Prompt {} did not finish in time".format(self.prompt_id))
+        if self.status is None or not self.status.completed:
+            raise WorkflowExecutionError(self.error_message())
+
+        images = {}
+        for title, (node_id, socket) in self.template.captures.items():
+            node_output = (self.output_data or {}).get(node_id)
+            if node_output is None or socket >= len(node_output):
+                raise WorkflowExecutionError("Node {} produced no output for '{}'".format(node_id, title))
+            images[title] = torch.cat(node_output[socket], dim=0)
+        return images
+
+    def error_message(self):
+        if self.status is None:
+            return "Prompt {} was removed from the queue".format(self.prompt_id)
+        for event, data in self.status.messages:
+            if event == "execution_error":
+                return "{}: {}".format(data["exception_type"], data["exception_message"])
+            if event == "execution_interrupted":
+                return "Prompt {} was interrupted".format(self.prompt_id)
+        return "Prompt {} failed".format(self.prompt_id)
+
+def encode_images(images, image_format="JPEG", quality=95, effort="default"):
+    """Encodes in memory with the encoders of SaveImage, see comfy_execution/image_writer.py."""
+    return image_writer.encode_images(images, image_format.lower(), quality, effort)
+
+class EmbeddedExecutor:
+    """
+    Submits workflow templates straight into a PromptQueue of the running process. The prompt is
+    executed by the regular prompt worker, so it is scheduled together with prompts from the HTTP API,
+    but there is no JSON, multipart upload or PNG round trip over the loopback socket: the caller gets
+    the image tensors (or encoded bytes) back from the executor's output cache.
+    """
+    def __init__(self, prompt_queue):
+        self.prompt_queue = prompt_queue
+
+    def queue(self, template, overrides=None, tenant=None, priority=None):
+        """`tenant` and `priority` are used for fair-share scheduling, see comfy_execution/scheduling.py."""
+        valid, prompt = template.validate(overrides)
+        if not valid[0]:
+            raise WorkflowTemplateError("{}: {}".format(valid[1]["message"], valid[1]["details"]))
+
+        number = self.prompt_queue.server.next_prompt_number()
+
+        extra_data = {}
+        if tenant is not None:
+            extra_data["tenant"] = tenant
+        if priority is not None:
+            extra_data["priority"] = priority
+
+        pending = EmbeddedPrompt(str(uuid.uuid4()), template)
+        self.prompt_queue.put((number, pending.prompt_id, prompt, extra_data, template.execute_outputs()), on_done=pending.set_result)
+        return pending
+
+    def run(self, template, overrides=None, timeout=None, tenant=None, priority=None):
+        return self.queue(template, overrides, tenant, priority).result(timeout)
+
+    def run_encoded(self, template, overrides=None, image_format="JPEG", quality=95, timeout=None, tenant=None, priority=None, effort="default"):
+        images = self.run(template, overrides, timeout, tenant, priority)
+        return {title: encode_images(image, image_format, quality, effort) for title, image in images.items()}
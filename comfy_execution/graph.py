@@ -54,8 +54,9 @@ class DynamicPrompt:
     def get_original_prompt(self):
         return self.original_prompt
 
-def get_input_info(class_def, input_name):
-    valid_inputs = class_def.INPUT_TYPES()
+def get_input_info(class_def, input_name, valid_inputs=None):
+    if valid_inputs is None:
+        valid_inputs = class_def.INPUT_TYPES()
     input_info = None
     input_category = None
     if "required" in valid_inputs and input_name in valid_inputs["required"]:
@@ -163,7 +164,8 @@ class ExecutionList(TopologicalSort):
     def is_cached(self, node_id):
         return self.output_cache.get(node_id) is not None
 
-    def stage_node_execution(self):
+    def stage_node_execution(self, deferred=()):
+        """Nodes in `deferred` (already running on another thread) are only picked when no other node is ready."""
         assert self.staged_node_id is None
         if self.is_empty():
             return None, None, None
@@ -188,6 +190,9 @@ class ExecutionList(TopologicalSort):
             }
             return None, error_details, ex
 
+        not_deferred = [node_id for node_id in available if node_id not in deferred]
+        if len(not_deferred) > 0:
+            available = not_deferred
         self.staged_node_id = self.ux_friendly_pick_node(available)
         return self.staged_node_id, None, None
 
@@ -0,0 +1,213 @@
+import collections
+import copy
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import time
+
+# Entries the SQLite store keeps decoded in memory, the most recent ones are polled the most.
+HOT_ENTRIES = 32
+
+# Entries over the limit that are allowed to pile up before the oldest ones are deleted in one go.
+PRUNE_BATCH = 100
+
+class MemoryHistoryStore:
+    """
+    The prompt history of a PromptQueue in a dict, lost on restart. Entries are the dicts that
+    PromptQueue.task_done() builds: the queue item under "prompt", "outputs", "status" and "meta".
+    Like the other stores it is only used under the PromptQueue mutex.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = {}
+        self.times = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, prompt_id, entry):
+        if len(self.entries) > self.max_size:
+            oldest = next(iter(self.entries))
+            self.entries.pop(oldest)
+            self.times.pop(oldest)
+        self.entries[prompt_id] = entry
+        self.times[prompt_id] = time.time()
+
+    def get(self, prompt_id):
+        if prompt_id not in self.entries:
+            return None
+        return copy.deepcopy(self.entries[prompt_id])
+
+    def page(self, max_items=None, offset=-1, since=None):
+        """
+        Entries in the order they were added, from position `offset` on, or the last `max_items`
+        entries if offset is negative. `since` only counts entries added at or after that unix time.
+        """
+        prompt_ids = iter(self.entries)
+        count = len(self.entries)
+        if since is not None:
+            prompt_ids = (p for p in prompt_ids if self.times[p] >= since)
+            count = sum(1 for t in self.times.values() if t >= since)
+        if offset < 0:
+            offset = 0 if max_items is None else max(count - max_items, 0)
+        stop = None if max_items is None else offset + max_items
+        return {p: self.entries[p] for p in itertools.islice(prompt_ids, offset, stop)}
+
+    def delete(self, prompt_id):
+        self.entries.pop(prompt_id, None)
+        self.times.pop(prompt_id, None)
+
+    def wipe(self):
+        self.entries = {}
+        self.times = {}
+
+def _encode(value):
+    return json.dumps(value, separators=(",", ":"), sort_keys=True, default=str)
+
+class SQLiteHistoryStore:
+    """
+    The prompt history in a SQLite database, so it survives restarts. Entries are indexed by
+    prompt_id and by the time they were added, pages are index range scans. The prompt and the
+    extra_data (which holds the UI workflow) of the queue item are stored once per distinct body,
+    keyed by their hash, because most prompts of a server are instances of a few workflows. The
+    last HOT_ENTRIES entries are also kept decoded in memory.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.hot = collections.OrderedDict()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                prompt_id TEXT NOT NULL UNIQUE,
+                created REAL NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                extra_hash TEXT NOT NULL,
+                entry TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_created ON history (created);
+            CREATE INDEX IF NOT EXISTS history_prompt_hash ON history (prompt_hash);
+            CREATE INDEX IF NOT EXISTS history_extra_hash ON history (extra_hash);
+            CREATE TABLE IF NOT EXISTS bodies (
+                hash TEXT PRIMARY KEY,
+                body TEXT NOT NULL
+            );
+        """)
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def _put_body(self, value):
+        body = _encode(value)
+        body_hash = hashlib.sha256(body.encode("utf-8")).hexdigest()
+        self.db.execute("INSERT OR IGNORE INTO bodies (hash, body) VALUES (?, ?)", (body_hash, body))
+        return body_hash
+
+    def _get_body(self, body_hash, bodies):
+        if body_hash not in bodies:
+            row = self.db.execute("SELECT body FROM bodies WHERE hash = ?", (body_hash,)).fetchone()
+            bodies[body_hash] = json.loads(row[0]) if row is not None else None
+        return bodies[body_hash]
+
+    def add(self, prompt_id, entry):
+        item = entry["prompt"]
+        stored = dict(entry)
+        stored["prompt"] = [item[0], item[1], None, None] + list(item[4:])
+        with self.db:
+            self.db.execute("BEGIN")
+            prompt_hash = self._put_body(item[2])
+            extra_hash = self._put_body(item[3])
+            self.db.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+            self.db.execute("INSERT INTO history (prompt_id, created, prompt_hash, extra_hash, entry) VALUES (?, ?, ?, ?, ?)",
+                            (prompt_id, time.time(), prompt_hash, extra_hash, _encode(stored)))
+
+        self.hot[prompt_id] = entry
+        self.hot.move_to_end(prompt_id)
+        while len(self.hot) > HOT_ENTRIES:
+            self.hot.popitem(last=False)
+
+        if len(self) > self.max_size + PRUNE_BATCH:
+            self.prune()
+
+    def _decode(self, rows):
+        out = {}
+        bodies = {}
+        for prompt_id, prompt_hash, extra_hash, entry in rows:
+            if prompt_id in self.hot:
+                out[prompt_id] = self.hot[prompt_id]
+                continue
+            entry = json.loads(entry)
+            prompt = entry["prompt"]
+            prompt[2] = self._get_body(prompt_hash, bodies)
+            prompt[3] = self._get_body(extra_hash, bodies)
+            out[prompt_id] = entry
+        return out
+
+    def get(self, prompt_id):
+        if prompt_id in self.hot:
+            return copy.deepcopy(self.hot[prompt_id])
+        rows = self.db.execute("SELECT prompt_id, prompt_hash, extra_hash, entry FROM history WHERE prompt_id = ?", (prompt_id,)).fetchall()
+        return self._decode(rows).get(prompt_id)
+
+    def page(self, max_items=None, offset=-1, since=None):
+        """See MemoryHistoryStore.page()."""
+        where = ""
+        params = []
+        if since is not None:
+            where = "WHERE created >= ?"
+            params.append(since)
+        columns = "SELECT prompt_id, prompt_hash, extra_hash, entry FROM history {}".format(where)
+
+        if offset < 0 and max_items is not None:
+            rows = self.db.execute(columns + " ORDER BY seq DESC LIMIT ?", params + [max_items]).fetchall()
+            rows.reverse()
+        else:
+            limit = -1 if max_items is None else max_items
+            rows = self.db.execute(columns + " ORDER BY seq LIMIT ? OFFSET ?", params + [limit, max(offset, 0)]).fetchall()
+        return self._decode(rows)
+
+    def _delete_unused_bodies(self, hashes=None):
+        query = "DELETE FROM bodies WHERE hash NOT IN (SELECT prompt_hash FROM history) AND hash NOT IN (SELECT extra_hash FROM history)"
+        if hashes is None:
+            self.db.execute(query)
+        else:
+            for body_hash in hashes:
+                self.db.execute(query + " AND hash = ?", (body_hash,))
+
+    def prune(self):
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM history WHERE seq <= (SELECT seq FROM history ORDER BY seq DESC LIMIT 1 OFFSET ?)", (self.max_size,))
+            self._delete_unused_bodies()
+        for prompt_id in list(self.hot):
+            if self.db.execute("SELECT 1 FROM history WHERE prompt_id = ?", (prompt_id,)).fetchone() is None:
+                self.hot.pop(prompt_id)
+
+    def delete(self, prompt_id):
+        self.hot.pop(prompt_id, None)
+        with self.db:
+            self.db.execute("BEGIN")
+            row = self.db.execute("SELECT prompt_hash, extra_hash FROM history WHERE prompt_id = ?", (prompt_id,)).fetchone()
+            if row is not None:
+                self.db.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+                self._delete_unused_bodies(row)
+
+    def wipe(self):
+        self.hot.clear()
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM history")
+            self.db.execute("DELETE FROM bodies")
+
+def history_store(path, max_size):
+    if path is None:
+        return MemoryHistoryStore(max_size)
+    return SQLiteHistoryStore(path, max_size)
@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from xml.sax.saxutils import quoteattr
+
+import torch
+from PIL import Image
+
+import comfy.model_management
+from PIL.PngImagePlugin import PngInfo
+
+# Threads that encode and write images, shared by all the save nodes of the process.
+WRITER_THREADS = min(4, os.cpu_count() or 1)
+
+# Elements images_to_uint8 converts at a time on the CPU
+CPU_CHUNK_ELEMENTS = 1 << 18
+
+# Output formats of the save nodes: PIL format name and file extension
+IMAGE_FORMATS = {"png": ("PNG", "png"), "jpeg": ("JPEG", "jpg"), "webp": ("WEBP", "webp")}
+
+# How hard the encoder tries to make the file small, "default" PNG uses the compress level of the node
+EFFORTS = ["default", "fastest", "slowest"]
+PNG_COMPRESS_LEVELS = {"fastest": 1, "slowest": 9}
+WEBP_METHODS = {"default": 4, "fastest": 0, "slowest": 6}
+
+# Largest EXIF or XMP payload of a JPEG, they have to fit into one APP1 segment
+JPEG_SEGMENT_LIMIT = 65000
+
+XMP_TEMPLATE = (
+    '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+    '<rdf:Description rdf:about="" xmlns:comfy="https://comfy.org/ns/1.0/"{}/>'
+    '</rdf:RDF></x:xmpmeta><?xpacket end="r"?>'
+)
+
+
+def images_to_uint8(images, value_range=(0.0, 1.0)):
+    """
+    A batch of float images as one uint8 numpy array (batch, height, width, channels), with
+    `value_range` mapped to 0..255. Scaling, clamping and the cast run on the device of the images
+    for the whole batch, which is then copied to the host at once (see to_host). Indexing the result
+    gives views, not copies, of the frames.
+    """
+    if not isinstance(images, torch.Tensor):
+        images = torch.stack(list(images))
+    low, high = value_range
+    scale = 255.0 / (high - low)
+    if comfy.model_management.is_device_cpu(images.device):
+        return cpu_to_uint8(images, low, scale).numpy()
+    if low != 0.0:
+        images = images - low
+    images = (images * scale).clamp_(0, 255).to(torch.uint8)
+    return to_host(images).numpy()
+
+
+def cpu_to_uint8(images, low, scale):
+    # In chunks, whole batch temporaries don't fit into the CPU caches and make the conversion memory bound
+    out = torch.empty(images.shape, dtype=torch.uint8)
+    source = images.reshape(-1)
+    target = out.reshape(-1)
+    scratch = torch.empty(min(CPU_CHUNK_ELEMENTS, source.numel()), dtype=torch.float32)
+    for start in range(0, source.numel(), CPU_CHUNK_ELEMENTS):
+        chunk = source[start:start + CPU_CHUNK_ELEMENTS]
+        values = scratch[:chunk.numel()]
+        if low != 0.0:
+            torch.sub(chunk, low, out=values)
+            values.mul_(scale)
+        else:
+            torch.mul(chunk, scale, out=values)
+        target[start:start + CPU_CHUNK_ELEMENTS].copy_(values.clamp_(0, 255))
+    return out
+
+
+def to_host(tensor):
+    """
+    Copies a tensor to the CPU. From CUDA devices the copy goes into pinned memory without blocking
+    and only waits for the copy itself, not a synchronous copy through pageable memory.
+    """
+    if comfy.model_management.is_device_cpu(tensor.device):
+        return tensor
+    if not comfy.model_management.is_device_cuda(tensor.device) or not comfy.model_management.device_supports_non_blocking(tensor.device):
+        return tensor.cpu()
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    host.copy_(tensor, non_blocking=True)
+    done = torch.cuda.Event()
+    done.record(torch.cuda.current_stream(tensor.device))
+    done.synchronize()
+    return host
+
+
+def image_metadata(prompt=None, extra_pnginfo=None):
+    """The metadata the save nodes embed: the prompt and the extra_pnginfo entries (the workflow)."""
+    metadata = {}
+    if prompt is not None:
+        metadata["prompt"] = prompt
+    if extra_pnginfo is not None:
+        metadata.update(extra_pnginfo)
+    return metadata
+
+
+def exif_metadata(metadata):
+    """The EXIF layout of SaveAnimatedWEBP, which the frontend reads: "name:json" strings from tag 0x0110 down."""
+    exif = Image.Exif()
+    tag = 0x0110
+    for name, value in metadata.items():
+        exif[tag] = "{}:{}".format(name, json.dumps(value))
+        tag -= 1
+    return exif
+
+
+def xmp_metadata(metadata):
+    attributes = "".join(" comfy:{}={}".format(name, quoteattr(json.dumps(value))) for name, value in metadata.items() if name.isidentifier())
+    return XMP_TEMPLATE.format(attributes).encode("utf-8")
+
+
+def encode_image(image, fp, image_format="png", quality=90, effort="default", metadata=None, compress_level=4):
+    """
+    Encodes a uint8 image (height, width, channels) into the file or file object `fp`. `quality`
+    applies to JPEG and WebP, WebP is lossless at 100. `metadata` (see image_metadata()) is stored
+    as PNG text chunks, or as EXIF and XMP for JPEG and WebP.
+    """
+    pil_format, _ = IMAGE_FORMATS[image_format]
+    img = Image.fromarray(image)
+    if image_format == "png":
+        pnginfo = None
+        if metadata:
+            pnginfo = PngInfo()
+            for name, value in metadata.items():
+                pnginfo.add_text(name, json.dumps(value))
+        img.save(fp, format=pil_format, pnginfo=pnginfo, compress_level=PNG_COMPRESS_LEVELS.get(effort, compress_level))
+        return
+
+    options = {}
+    if metadata:
+        exif = exif_metadata(metadata).tobytes()
+        xmp = xmp_metadata(metadata)
+        if image_format == "jpeg" and len(exif) > JPEG_SEGMENT_LIMIT:
+            logging.warning("Image metadata does not fit into the EXIF segment of a JPEG and is only stored as XMP.")
+            exif = None
+        if image_format == "jpeg" and len(xmp) > JPEG_SEGMENT_LIMIT:
+            logging.warning("Image metadata does not fit into the XMP segment of a JPEG and is not stored as XMP.")
+            xmp = None
+        if exif is not None:
+            options["exif"] = exif
+        if xmp is not None:
+            options["xmp"] = xmp
+
+    if image_format == "jpeg":
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(fp, format=pil_format, quality=quality, optimize=effort == "slowest", **options)
+    else:
+        img.save(fp, format=pil_format, quality=quality, lossless=quality >= 100, method=WEBP_METHODS[effort], **options)
+
+
+def encode_images(images, image_format="png", quality=90, effort="default", metadata=None, compress_level=4):
+    """Encodes a batch of images (see images_to_uint8) in memory on the writer threads and returns the bytes of each."""
+    def encode(image):
+        buffer = BytesIO()
+        encode_image(image, buffer, image_format, quality, effort, metadata, compress_level)
+        return buffer.getvalue()
+    return list(writer.pool.map(encode, images_to_uint8(images)))
+
+
+class ImageWriter:
+    """
+    Runs image encoding and writing on a thread pool so save nodes return as soon as their writes
+    are queued. The prompt executor waits for the writes with wait() before it reports the prompt
+    as done, and reports failed writes as errors of the node that queued them (see set_node).
+    """
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="image_writer")
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.context = threading.local()
+
+    def set_node(self, node_id):
+        """The node executing on this thread, writes it queues are attributed to it."""
+        self.context.node_id = node_id
+
+    def submit(self, path, function, *args, **kwargs):
+        """
+        Queues function(*args, **kwargs), which writes `path`. The file is created empty right away,
+        so the file name counters of later saves (folder_paths.get_save_image_path) count it. /view
+        waits for the pending write of a file before serving it.
+        """
+        path = os.path.abspath(path)
+        open(path, "wb").close()
+        node_id = getattr(self.context, "node_id", None)
+        future = self.pool.submit(self._write, path, function, args, kwargs)
+        with self.lock:
+            self.pending[path] = (future, node_id)
+        return future
+
+    def _write(self, path, function, args, kwargs):
+        function(*args, **kwargs)
+        # On disk before the prompt is reported as done
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def pending_write(self, path):
+        """The future of the queued write of `path`, or None."""
+        with self.lock:
+            entry = self.pending.get(os.path.abspath(path))
+        return entry[0] if entry is not None else None
+
+    def wait(self):
+        """Waits for all queued writes and returns the failed ones as (node id, exception) pairs."""
+        with self.lock:
+            entries = list(self.pending.items())
+        failures = []
+        for path, (future, node_id) in entries:
+            exception = future.exception()
+            if exception is not None:
+                failures.append((node_id, exception))
+            with self.lock:
+                if path in self.pending and self.pending[path][0] is future:
+                    del self.pending[path]
+        return failures
+
+
+writer = ImageWriter(WRITER_THREADS)
@@ -0,0 +1,112 @@
+import heapq
+import time
+
+# Share of the workers a priority class gets relative to "normal" while other classes have prompts queued.
+PRIORITY_WEIGHTS = {
+    "high": 4.0,
+    "normal": 1.0,
+    "low": 0.25,
+}
+
+# Weight of the last prompt in the moving average of the execution time.
+DURATION_SMOOTHING = 0.2
+
+class QueueFull(Exception):
+    pass
+
+def prompt_tenant(item):
+    extra_data = item[3]
+    return extra_data.get("tenant", extra_data.get("client_id", None))
+
+def prompt_priority(item):
+    priority = item[3].get("priority", "normal")
+    if not isinstance(priority, str) or priority not in PRIORITY_WEIGHTS:
+        return "normal"
+    return priority
+
+class FairShareScheduler:
+    """
+    Decides which queued prompt of a PromptQueue runs next. Every tenant (extra_data "tenant", set by
+    the embedded executor, or the client_id) and priority class is a flow of a self-clocked weighted
+    fair queue: a prompt gets the finish tag max(virtual time, last finish tag of its flow) + 1 / weight,
+    and the prompt with the lowest tag runs first. One tenant with hundreds of queued prompts only gets its share of the
+    workers while others have prompts queued. Prompts queued with front=true (a negative number) run
+    before all others, and prompts of one flow run in the order they were queued.
+
+    Tenants can be limited to `max_queued` queued and `max_running` running prompts. The moving
+    average of the execution time gives the estimated waits that /prompt and /queue report.
+    """
+    def __init__(self, max_queued=None, max_running=None, clock=time.perf_counter):
+        self.max_queued = max_queued
+        self.max_running = max_running
+        self.clock = clock
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+        self.last_finish = {}
+        self.queued = {}
+        self.running = {}
+        self.started_at = {}
+        self.average_duration = None
+
+    def add(self, item):
+        tenant = prompt_tenant(item)
+        if self.max_queued is not None and self.queued.get(tenant, 0) >= self.max_queued:
+            raise QueueFull("{} prompts of this client are already queued".format(self.queued[tenant]))
+
+        flow = (tenant, prompt_priority(item))
+        start = max(self.virtual_time, self.last_finish.get(flow, 0.0))
+        finish = start + 1.0 / PRIORITY_WEIGHTS[flow[1]]
+        self.last_finish[flow] = finish
+        self.finish_tags[item[1]] = finish
+        self.queued[tenant] = self.queued.get(tenant, 0) + 1
+
+    def remove(self, item):
+        # A queued prompt that was deleted.
+        self.finish_tags.pop(item[1], None)
+        self._decrement(self.queued, prompt_tenant(item))
+
+    def key(self, item):
+        return (item[0] >= 0, self.finish_tags.get(item[1], self.virtual_time), item[0])
+
+    def can_start(self, item):
+        return self.max_running is None or self.running.get(prompt_tenant(item), 0) < self.max_running
+
+    def next_items(self, queue, count=1):
+        """The first `count` queued items in scheduling order that can start now."""
+        return heapq.nsmallest(count, (item for item in queue if self.can_start(item)), key=self.key)
+
+    def start(self, item):
+        tenant = prompt_tenant(item)
+        self.virtual_time = max(self.virtual_time, self.finish_tags.pop(item[1], self.virtual_time))
+        self._decrement(self.queued, tenant)
+        self.running[tenant] = self.running.get(tenant, 0) + 1
+        self.started_at[item[1]] = self.clock()
+
+    def finish(self, item):
+        self._decrement(self.running, prompt_tenant(item))
+        started = self.started_at.pop(item[1], None)
+        if started is not None:
+            duration = self.clock() - started
+            if self.average_duration is None:
+                self.average_duration = duration
+            else:
+                self.average_duration += DURATION_SMOOTHING * (duration - self.average_duration)
+
+    def estimated_waits(self, queue, workers=1):
+        """Seconds until each queued prompt starts, by prompt_id. None until a prompt has finished."""
+        if self.average_duration is None:
+            return {item[1]: None for item in queue}
+
+        now = self.clock()
+        busy = sum(max(self.average_duration - (now - started), 0.0) for started in self.started_at.values())
+        waits = {}
+        for position, item in enumerate(sorted(queue, key=self.key)):
+            waits[item[1]] = (busy + position * self.average_duration) / max(workers, 1)
+        return waits
+
+    def _decrement(self, counts, tenant):
+        count = counts.get(tenant, 0) - 1
+        if count > 0:
+            counts[tenant] = count
+        else:
+            counts.pop(tenant, None)
@@ -0,0 +1,298 @@
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+
+import folder_paths
+from comfy.cli_args import args
+
+# Model files of recently executed prompts that a worker is assumed to still have loaded.
+MAX_WORKER_MODELS = 8
+
+# Spawned processes copy os.environ when they start, see WorkerProcess.start().
+_environ_lock = threading.Lock()
+
+def prompt_models(prompt):
+    """The model files (checkpoints, LoRAs, VAEs, ...) that the loader nodes of a prompt load."""
+    models = set()
+    for node in prompt.values():
+        for name, value in node.get("inputs", {}).items():
+            if name.endswith("_name") and isinstance(value, str) and os.path.splitext(value)[1] in folder_paths.supported_pt_extensions:
+                models.add(value)
+    return models
+
+def worker_devices(count):
+    """
+    Returns (environment, num_threads) for every worker: one visible CUDA device each (round robin
+    over the devices visible to this process) or, on CPU, an equal share of the CPU cores.
+    """
+    import torch
+
+    if not args.cpu and torch.cuda.is_available():
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES", None)
+        if visible is not None:
+            devices = [d.strip() for d in visible.split(",") if len(d.strip()) > 0]
+        else:
+            devices = [str(i) for i in range(torch.cuda.device_count())]
+        if count > len(devices):
+            logging.warning("{} workers share {} CUDA devices".format(count, len(devices)))
+        return [({"CUDA_VISIBLE_DEVICES": devices[i % len(devices)]}, None) for i in range(count)]
+
+    num_threads = max(1, (os.cpu_count() or 1) // count)
+    env = {"OMP_NUM_THREADS": str(num_threads), "MKL_NUM_THREADS": str(num_threads)}
+    return [(env, num_threads) for i in range(count)]
+
+class WorkerConnection:
+    """The worker side of the pipe to the pool. Replies are matched to requests in order."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.replies = queue.Queue()
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+    def request(self, message):
+        self.send(message)
+        return self.replies.get()
+
+    def receive(self):
+        import nodes
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                # The server process is gone.
+                os._exit(0)
+            if message[0] == "interrupt":
+                nodes.interrupt_processing()
+            else:
+                self.replies.put(message[1])
+
+class WorkerQueue:
+    """The part of execution.PromptQueue that main.prompt_worker uses, served by the pool."""
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get(self, timeout=None):
+        items = self.get_batch(1, timeout=timeout)
+        if items is None:
+            return None
+        return items[0]
+
+    def get_batch(self, max_size, timeout=None):
+        return self.connection.request(("get", max_size, timeout))
+
+    def task_done(self, item_id, history_result, status, output_data=None):
+        self.connection.send(("task_done", item_id, history_result, status, output_data))
+
+    def get_flags(self, reset=True):
+        return self.connection.request(("get_flags",))
+
+class WorkerServer:
+    """Stands in for the PromptServer in a worker process, messages are sent by the real one."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+
+    def send_sync(self, event, data, sid=None):
+        self.connection.send(("send_sync", event, data, sid))
+
+def worker_main(conn, index, settings, target):
+    # Runs in the worker process. The server's args and folder paths are applied before any model
+    # code is imported, which matters when this module is the first thing the process imports.
+    vars(args).update(settings["args"])
+    folder_paths.folder_names_and_paths.update(settings["folder_names_and_paths"])
+    folder_paths.set_output_directory(settings["output_directory"])
+    folder_paths.set_input_directory(settings["input_directory"])
+    folder_paths.set_temp_directory(settings["temp_directory"])
+    folder_paths.set_user_directory(settings["user_directory"])
+
+    import torch
+    if settings["num_threads"] is not None:
+        torch.set_num_threads(settings["num_threads"])
+
+    import nodes
+    nodes.init_extra_nodes(init_custom_nodes=not args.disable_all_custom_nodes)
+
+    connection = WorkerConnection(conn)
+    connection.send(("ready", os.getpid()))
+    logging.info("Worker {} started (pid {})".format(index, os.getpid()))
+    target(WorkerQueue(connection), WorkerServer(connection))
+
+class WorkerProcess:
+    def __init__(self, pool, index, env, num_threads):
+        self.pool = pool
+        self.index = index
+        self.env = env
+        self.num_threads = num_threads
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.pid = None
+        self.ready = threading.Event()
+        self.running = set()
+        self.models = collections.OrderedDict()
+        self.pending_flags = {}
+
+    def start(self):
+        self.ready.clear()
+        self.conn, child_conn = self.pool.context.Pipe()
+        self.process = self.pool.context.Process(target=worker_main, daemon=True,
+                                                 args=(child_conn, self.index, self.pool.settings(self.num_threads), self.pool.target))
+        with _environ_lock:
+            saved = {name: os.environ.get(name, None) for name in self.env}
+            os.environ.update(self.env)
+            try:
+                self.process.start()
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+        child_conn.close()
+        threading.Thread(target=self.run, args=(self.conn,), daemon=True).start()
+
+    def has_models(self, item):
+        models = prompt_models(item[2])
+        return len(models) > 0 and all(m in self.models for m in models)
+
+    def add_models(self, item):
+        for model in prompt_models(item[2]):
+            self.models[model] = True
+            self.models.move_to_end(model)
+        while len(self.models) > MAX_WORKER_MODELS:
+            self.models.popitem(last=False)
+
+    def run(self, conn):
+        q = self.pool.prompt_queue
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            kind = message[0]
+            if kind == "get":
+                max_size, timeout = message[1:]
+                if max_size > 1:
+                    items = q.get_batch(max_size, timeout=timeout, affinity=self.has_models)
+                else:
+                    item = q.get(timeout=timeout, affinity=self.has_models)
+                    items = [item] if item is not None else None
+                for item, item_id in items or []:
+                    self.running.add(item_id)
+                    self.add_models(item)
+                self.send(("items", items))
+            elif kind == "task_done":
+                item_id = message[1]
+                self.running.discard(item_id)
+                q.task_done(*message[1:])
+            elif kind == "send_sync":
+                self.pool.server.send_sync(*message[1:])
+            elif kind == "get_flags":
+                self.send(("flags", self.pool.get_flags(self)))
+            elif kind == "ready":
+                self.pid = message[1]
+                self.ready.set()
+
+        self.worker_exited()
+
+    def worker_exited(self):
+        if self.pool.stopped:
+            return
+        self.process.join(timeout=10)
+        logging.error("Worker {} (pid {}) exited with code {}".format(self.index, self.pid, self.process.exitcode))
+        q = self.pool.prompt_queue
+        for item_id in list(self.running):
+            messages = [("execution_error", {"exception_type": "RuntimeError",
+                                             "exception_message": "Worker process exited during execution",
+                                             "traceback": []})]
+            q.task_done(item_id, {}, status=q.ExecutionStatus(status_str='error', completed=False, messages=messages))
+        self.running.clear()
+        self.models.clear()
+        if self.ready.is_set():
+            self.start()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def interrupt(self):
+        try:
+            self.send(("interrupt",))
+        except (OSError, ValueError) as e:
+            logging.warning("Could not interrupt worker {}: {}".format(self.index, e))
+
+class WorkerPool:
+    """
+    Runs `count` prompt workers in their own spawned processes instead of one thread, each with its
+    own device and model_management state, see worker_devices(). `target(q, server)` is the worker
+    loop (main.prompt_worker): it gets a WorkerQueue and a WorkerServer that forward to the real
+    PromptQueue and PromptServer of this process, so the queue, the history and the websocket
+    messages work as with a single worker. A free worker takes the next queued prompt, preferring
+    prompts whose models it loaded for an earlier prompt (see PromptQueue.get()).
+    """
+    def __init__(self, prompt_queue, server, count, target):
+        self.prompt_queue = prompt_queue
+        self.server = server
+        self.target = target
+        self.context = multiprocessing.get_context("spawn")
+        self.flags_lock = threading.Lock()
+        self.stopped = False
+        prompt_queue.worker_count = count
+        self.workers = [WorkerProcess(self, i, env, num_threads) for i, (env, num_threads) in enumerate(worker_devices(count))]
+        server.worker_pool = self
+
+    def settings(self, num_threads):
+        return {
+            "args": vars(args),
+            "folder_names_and_paths": folder_paths.folder_names_and_paths,
+            "output_directory": folder_paths.get_output_directory(),
+            "input_directory": folder_paths.get_input_directory(),
+            "temp_directory": folder_paths.get_temp_directory(),
+            "user_directory": folder_paths.get_user_directory(),
+            "num_threads": num_threads,
+        }
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def wait_ready(self, timeout=None):
+        return all(worker.ready.wait(timeout) for worker in self.workers)
+
+    def get_flags(self, worker):
+        # Flags such as unload_models are meant for every worker: whoever asks first takes them from
+        # the queue and hands them out to all workers.
+        with self.flags_lock:
+            flags = self.prompt_queue.get_flags()
+            if len(flags) > 0:
+                for w in self.workers:
+                    w.pending_flags.update(flags)
+                    if flags.get("unload_models", flags.get("free_memory", False)):
+                        w.models.clear()
+            flags = worker.pending_flags
+            worker.pending_flags = {}
+            return flags
+
+    def interrupt(self):
+        for worker in self.workers:
+            if len(worker.running) > 0:
+                worker.interrupt()
+
+    def stop(self):
+        self.stopped = True
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join()
@@ -7,8 +7,8 @@ import io
 import json
 import struct
 import random
-import hashlib
 from comfy.cli_args import args
+import node_helpers
 
 class EmptyLatentAudio:
     def __init__(self):
@@ -207,10 +207,7 @@ class LoadAudio:
     @classmethod
     def IS_CHANGED(s, audio):
         image_path = folder_paths.get_annotated_filepath(audio)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return node_helpers.file_hash(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, audio):
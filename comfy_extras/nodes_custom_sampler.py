@@ -3,6 +3,7 @@ import comfy.sample
 from comfy.k_diffusion import sampling as k_diffusion_sampling
 import latent_preview
 import torch
+import logging
 import comfy.utils
 import node_helpers
 
@@ -450,6 +451,8 @@ class SamplerCustom:
     RETURN_NAMES = ("output", "denoised_output")
 
     FUNCTION = "sample"
+    BATCHABLE_INPUTS = ("noise_seed",)
+    BATCH_FUNCTION = "sample_batch"
 
     CATEGORY = "sampling/custom_sampling"
 
@@ -484,6 +487,49 @@ class SamplerCustom:
             out_denoised = out
         return (out, out_denoised)
 
+    def sample_batch(self, model, add_noise, noise_seed, cfg, positive, negative, sampler, sigmas, latent_image):
+        #every argument is the list of per prompt values, see BATCH_FUNCTION in comfy_execution/batching.py
+        try:
+            model, add_noise, cfg, sampler, sigmas = [comfy.sample.batch_shared(x) for x in (model, add_noise, cfg, sampler, sigmas)]
+            batch_size = max(len(noise_seed), len(positive), len(negative), len(latent_image))
+            noise_seed = comfy.sample.batch_expand(noise_seed, batch_size)
+            latents = comfy.sample.batch_expand(latent_image, batch_size)
+            latent_image, noise_mask = comfy.sample.batch_latents(model, latents)
+            comfy.sample.batch_sampler(sampler, noise_mask)
+            memo = {}
+            positive = comfy.sample.batch_conditioning(comfy.sample.batch_expand(positive, batch_size), latent_image.shape, memo)
+            negative = comfy.sample.batch_conditioning(comfy.sample.batch_expand(negative, batch_size), latent_image.shape, memo)
+        except comfy.sample.CannotBatch as e:
+            logging.info("Sampling prompts one at a time: {}".format(e))
+            return None
+
+        if not add_noise:
+            noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
+        else:
+            noise = comfy.sample.prepare_noise_batch(latent_image, noise_seed)
+
+        x0_output = {}
+        callback = latent_preview.prepare_callback(model, sigmas.shape[-1] - 1, x0_output)
+
+        disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
+        samples = comfy.sample.sample_custom(model, noise, cfg, sampler, sigmas, positive, negative, latent_image, noise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=noise_seed[0])
+
+        denoised = samples
+        if "x0" in x0_output:
+            denoised = model.model.process_latent_out(x0_output["x0"].cpu())
+
+        results = []
+        for i in range(batch_size):
+            out = latents[i].copy()
+            out["samples"] = samples[i:i + 1]
+            if "x0" in x0_output:
+                out_denoised = latents[i].copy()
+                out_denoised["samples"] = denoised[i:i + 1]
+            else:
+                out_denoised = out
+            results.append((out, out_denoised))
+        return results
+
 class Guider_Basic(comfy.samplers.CFGGuider):
     def set_conds(self, positive):
         self.inner_set_conds({"positive": positive})
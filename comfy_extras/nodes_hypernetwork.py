@@ -1,4 +1,5 @@
 import comfy.utils
+import comfy.model_registry
 import folder_paths
 import torch
 import logging
@@ -109,7 +110,7 @@ class HypernetworkLoader:
     def load_hypernetwork(self, model, hypernetwork_name, strength):
         hypernetwork_path = folder_paths.get_full_path_or_raise("hypernetworks", hypernetwork_name)
         model_hypernetwork = model.clone()
-        patch = load_hypernetwork_patch(hypernetwork_path, strength)
+        patch = comfy.model_registry.load(hypernetwork_path, lambda: load_hypernetwork_patch(hypernetwork_path, strength), loader="hypernetwork", strength=strength)
         if patch is not None:
             model_hypernetwork.set_model_attn1_patch(patch)
             model_hypernetwork.set_model_attn2_patch(patch)
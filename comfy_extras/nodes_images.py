@@ -1,11 +1,11 @@
 import nodes
 import folder_paths
 from comfy.cli_args import args
+from comfy_execution import image_writer
 
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 
-import numpy as np
 import json
 import os
 
@@ -100,11 +100,7 @@ class SaveAnimatedWEBP:
         filename_prefix += self.prefix_append
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
         results = list()
-        pil_images = []
-        for image in images:
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            pil_images.append(img)
+        pil_images = [Image.fromarray(image) for image in image_writer.images_to_uint8(images)]
 
         metadata = pil_images[0].getexif()
         if not args.disable_metadata:
@@ -161,11 +157,7 @@ class SaveAnimatedPNG:
         filename_prefix += self.prefix_append
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
         results = list()
-        pil_images = []
-        for image in images:
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            pil_images.append(img)
+        pil_images = [Image.fromarray(image) for image in image_writer.images_to_uint8(images)]
 
         metadata = None
         if not args.disable_metadata:
@@ -4,6 +4,7 @@ import folder_paths
 import comfy.clip_model
 import comfy.clip_vision
 import comfy.ops
+import comfy.model_registry
 
 # code for model from: https://github.com/TencentARC/PhotoMaker/blob/main/photomaker/model.py under Apache License Version 2.0
 VISION_CONFIG_DICT = {
@@ -127,12 +128,15 @@ class PhotoMakerLoader:
 
     def load_photomaker_model(self, photomaker_model_name):
         photomaker_model_path = folder_paths.get_full_path_or_raise("photomaker", photomaker_model_name)
+        return (comfy.model_registry.load(photomaker_model_path, lambda: self.load_photomaker_file(photomaker_model_path), loader="photomaker"),)
+
+    def load_photomaker_file(self, photomaker_model_path):
         photomaker_model = PhotoMakerIDEncoder()
         data = comfy.utils.load_torch_file(photomaker_model_path, safe_load=True)
         if "id_encoder" in data:
             data = data["id_encoder"]
         photomaker_model.load_state_dict(data)
-        return (photomaker_model,)
+        return photomaker_model
 
 
 class PhotoMakerEncode:
@@ -1,6 +1,7 @@
 import folder_paths
 import comfy.sd
 import comfy.model_management
+import comfy.model_registry
 import nodes
 import torch
 
@@ -18,7 +19,8 @@ class TripleCLIPLoader:
         clip_path1 = folder_paths.get_full_path_or_raise("clip", clip_name1)
         clip_path2 = folder_paths.get_full_path_or_raise("clip", clip_name2)
         clip_path3 = folder_paths.get_full_path_or_raise("clip", clip_name3)
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2, clip_path3], embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        clip_paths = [clip_path1, clip_path2, clip_path3]
+        clip = comfy.model_registry.load(clip_paths, lambda: comfy.sd.load_clip(ckpt_paths=clip_paths, embedding_directory=folder_paths.get_folder_paths("embeddings")), loader="clip")
         return (clip,)
 
 class EmptySD3LatentImage:
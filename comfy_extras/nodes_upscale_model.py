@@ -4,6 +4,7 @@ from spandrel import ModelLoader, ImageModelDescriptor
 from comfy import model_management
 import torch
 import comfy.utils
+import comfy.model_registry
 import folder_paths
 
 try:
@@ -26,6 +27,9 @@ class UpscaleModelLoader:
 
     def load_model(self, model_name):
         model_path = folder_paths.get_full_path_or_raise("upscale_models", model_name)
+        return (comfy.model_registry.load(model_path, lambda: self.load_model_file(model_path), loader="upscale_model"), )
+
+    def load_model_file(self, model_path):
         sd = comfy.utils.load_torch_file(model_path, safe_load=True)
         if "module.layers.0.residual_group.blocks.0.norm1.weight" in sd:
             sd = comfy.utils.state_dict_prefix_replace(sd, {"module.":""})
@@ -34,7 +38,7 @@ class UpscaleModelLoader:
         if not isinstance(out, ImageModelDescriptor):
             raise Exception("Upscale model must be a single-image model.")
 
-        return (out, )
+        return out
 
 
 class ImageUpscaleWithModel:
@@ -2,6 +2,7 @@ import nodes
 import torch
 import comfy.utils
 import comfy.sd
+import comfy.model_registry
 import folder_paths
 import comfy_extras.nodes_model_merging
 
@@ -18,7 +19,7 @@ class ImageOnlyCheckpointLoader:
 
     def load_checkpoint(self, ckpt_name, output_vae=True, output_clip=True):
         ckpt_path = folder_paths.get_full_path_or_raise("checkpoints", ckpt_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=False, output_clipvision=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        out = comfy.model_registry.load(ckpt_path, lambda: comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=False, output_clipvision=True, embedding_directory=folder_paths.get_folder_paths("embeddings")), loader="image_only_checkpoint")
         return (out[0], out[3], out[2])
 
 
@@ -57,6 +57,7 @@ class ArchitecturalPromptNode:
     RETURN_TYPES = ("STRING",)  # Output will be the final prompt string
     RETURN_NAMES = ("prompt",)
     FUNCTION = "generate_prompt"
+    BATCHABLE_INPUTS = ("architect", "region", "building_type", "interior_exterior", "atmosphere")  # Queued prompts that only differ here can share one sampler call
     CATEGORY = "Text Generation"
 
     def generate_prompt(self, architect, region, building_type, interior_exterior, atmosphere):
@@ -5,6 +5,7 @@ import threading
 import heapq
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import inspect
 from typing import List, Literal, NamedTuple, Optional
@@ -13,9 +14,14 @@ import torch
 import nodes
 
 import comfy.model_management
+import comfy.utils
 from comfy_execution.graph import get_input_info, ExecutionList, DynamicPrompt, ExecutionBlocker
 from comfy_execution.graph_utils import is_link, GraphBuilder
+from comfy_execution.batching import BatchedInput, batch_key
 from comfy_execution.caching import HierarchicalCache, LRUCache, CacheKeySetInputSignature, CacheKeySetID
+from comfy_execution.scheduling import FairShareScheduler
+from comfy_execution.history import history_store
+from comfy_execution import image_writer
 from comfy.cli_args import args
 
 class ExecutionResult(Enum):
@@ -48,30 +54,34 @@ class IsChangedCache:
             return self.is_changed[node_id]
 
         # Intentionally do not use cached outputs here. We only want constants in IS_CHANGED
+        # The result is not written into the node: the prompt is the one in the queue and history,
+        # a resubmitted prompt would skip IS_CHANGED.
         input_data_all, _ = get_input_data(node["inputs"], class_def, node_id, None)
         try:
             is_changed = _map_node_over_list(class_def, input_data_all, "IS_CHANGED")
-            node["is_changed"] = [None if isinstance(x, ExecutionBlocker) else x for x in is_changed]
+            self.is_changed[node_id] = [None if isinstance(x, ExecutionBlocker) else x for x in is_changed]
         except Exception as e:
             logging.warning("WARNING: {}".format(e))
-            node["is_changed"] = float("NaN")
-        finally:
-            self.is_changed[node_id] = node["is_changed"]
+            self.is_changed[node_id] = float("NaN")
         return self.is_changed[node_id]
 
+# Number of UI results kept when the LRU cache is only bounded by memory
+UI_CACHE_SIZE = 1000
+
 class CacheSet:
-    def __init__(self, lru_size=None):
-        if lru_size is None or lru_size == 0:
+    def __init__(self, lru_size=None, ram_budget=None, vram_budget=None, disk_cache=None):
+        if (lru_size is None or lru_size == 0) and ram_budget is None and vram_budget is None:
             self.init_classic_cache() 
         else:
-            self.init_lru_cache(lru_size)
+            self.init_lru_cache(lru_size or None, ram_budget, vram_budget)
+        self.outputs.disk_cache = disk_cache
         self.all = [self.outputs, self.ui, self.objects]
 
     # Useful for those with ample RAM/VRAM -- allows experimenting without
     # blowing away the cache every time
-    def init_lru_cache(self, cache_size):
-        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
-        self.ui = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
+    def init_lru_cache(self, cache_size, ram_budget=None, vram_budget=None):
+        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size, max_ram=ram_budget, max_vram=vram_budget, name="outputs")
+        self.ui = LRUCache(CacheKeySetInputSignature, max_size=cache_size or UI_CACHE_SIZE)
         self.objects = HierarchicalCache(CacheKeySetID)
 
     # Performs like the old cache -- dump data ASAP
@@ -87,13 +97,14 @@ class CacheSet:
         }
         return result
 
-def get_input_data(inputs, class_def, unique_id, outputs=None, dynprompt=None, extra_data={}):
-    valid_inputs = class_def.INPUT_TYPES()
+def get_input_data(inputs, class_def, unique_id, outputs=None, dynprompt=None, extra_data={}, valid_inputs=None):
+    if valid_inputs is None:
+        valid_inputs = class_def.INPUT_TYPES()
     input_data_all = {}
     missing_keys = {}
     for x in inputs:
         input_data = inputs[x]
-        input_type, input_category, input_info = get_input_info(class_def, x)
+        input_type, input_category, input_info = get_input_info(class_def, x, valid_inputs)
         def mark_missing():
             missing_keys[x] = True
             input_data_all[x] = (None,)
@@ -112,6 +123,8 @@ def get_input_data(inputs, class_def, unique_id, outputs=None, dynprompt=None, e
                 continue
             obj = cached_output[output_index]
             input_data_all[x] = obj
+        elif isinstance(input_data, BatchedInput) and input_category is not None:
+            input_data_all[x] = list(input_data)
         elif input_category is not None:
             input_data_all[x] = [input_data]
 
@@ -119,18 +132,24 @@ def get_input_data(inputs, class_def, unique_id, outputs=None, dynprompt=None, e
         h = valid_inputs["hidden"]
         for x in h:
             if h[x] == "PROMPT":
-                input_data_all[x] = [dynprompt.get_original_prompt() if dynprompt is not None else {}]
+                if "batch_prompts" in extra_data:
+                    input_data_all[x] = list(extra_data["batch_prompts"])
+                else:
+                    input_data_all[x] = [dynprompt.get_original_prompt() if dynprompt is not None else {}]
             if h[x] == "DYNPROMPT":
                 input_data_all[x] = [dynprompt]
             if h[x] == "EXTRA_PNGINFO":
-                input_data_all[x] = [extra_data.get('extra_pnginfo', None)]
+                if "batch_extra_pnginfo" in extra_data:
+                    input_data_all[x] = list(extra_data["batch_extra_pnginfo"])
+                else:
+                    input_data_all[x] = [extra_data.get('extra_pnginfo', None)]
             if h[x] == "UNIQUE_ID":
                 input_data_all[x] = [unique_id]
     return input_data_all, missing_keys
 
 map_node_over_list = None #Don't hook this please
 
-def _map_node_over_list(obj, input_data_all, func, allow_interrupt=False, execution_block_cb=None, pre_execute_cb=None):
+def _map_node_over_list(obj, input_data_all, func, allow_interrupt=False, execution_block_cb=None, pre_execute_cb=None, allow_batching=False):
     # check if node wants the lists
     input_is_list = getattr(obj, "INPUT_IS_LIST", False)
 
@@ -138,6 +157,16 @@ def _map_node_over_list(obj, input_data_all, func, allow_interrupt=False, execut
         max_len_input = 0
     else:
         max_len_input = max(len(x) for x in input_data_all.values())
+
+    # merged prompts (see comfy_execution/batching.py) can run all their items in one call
+    batch_function = getattr(obj, "BATCH_FUNCTION", None)
+    if allow_batching and batch_function is not None and func == obj.FUNCTION and not input_is_list and max_len_input > 1:
+        if not any(isinstance(v, ExecutionBlocker) for x in input_data_all.values() for v in x):
+            if allow_interrupt:
+                nodes.before_node_execution()
+            results = getattr(obj, batch_function)(**input_data_all)
+            if results is not None:
+                return results
      
     # get a slice of inputs, repeat last input when list isn't long enough
     def slice_dict(d, i):
@@ -190,12 +219,12 @@ def merge_result_data(results, obj):
             output.append([o[i] for o in results])
     return output
 
-def get_output_data(obj, input_data_all, execution_block_cb=None, pre_execute_cb=None):
+def get_output_data(obj, input_data_all, execution_block_cb=None, pre_execute_cb=None, allow_batching=False):
     
     results = []
     uis = []
     subgraph_results = []
-    return_values = _map_node_over_list(obj, input_data_all, obj.FUNCTION, allow_interrupt=True, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
+    return_values = _map_node_over_list(obj, input_data_all, obj.FUNCTION, allow_interrupt=True, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb, allow_batching=allow_batching)
     has_subgraph = False
     for i in range(len(return_values)):
         r = return_values[i]
@@ -241,7 +270,7 @@ def format_value(x):
     else:
         return str(x)
 
-def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results):
+def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, node_futures=None):
     unique_id = current_item
     real_node_id = dynprompt.get_real_node_id(unique_id)
     display_node_id = dynprompt.get_display_node_id(unique_id)
@@ -256,6 +285,7 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
         return (ExecutionResult.SUCCESS, None, None)
 
     input_data_all = None
+    execution_time = None
     try:
         if unique_id in pending_subgraph_results:
             cached_results = pending_subgraph_results[unique_id]
@@ -289,7 +319,10 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
                 obj = class_def()
                 caches.objects.set(unique_id, obj)
 
-            if hasattr(obj, "check_lazy_status"):
+            # Nodes started on the node thread pool by PromptExecutor.start_concurrent_nodes()
+            future = node_futures.pop(unique_id, None) if node_futures is not None else None
+
+            if future is None and hasattr(obj, "check_lazy_status"):
                 required_inputs = _map_node_over_list(obj, input_data_all, "check_lazy_status", allow_interrupt=True)
                 required_inputs = set(sum([r for r in required_inputs if isinstance(r,list)], []))
                 required_inputs = [x for x in required_inputs if isinstance(x,str) and (
@@ -320,7 +353,16 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
                     return block
             def pre_execute_cb(call_index):
                 GraphBuilder.set_default_prefix(unique_id, call_index, 0)
-            output_data, output_ui, has_subgraph = get_output_data(obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
+            execution_start = time.perf_counter()
+            if future is not None:
+                try:
+                    output_data, output_ui, has_subgraph = future.result()
+                except comfy.model_management.ModelLoadOnNodePool:
+                    # The node loads a model to the GPU, that is only done on this thread
+                    future = None
+            if future is None:
+                output_data, output_ui, has_subgraph = get_output_data(obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb, allow_batching="batch_prompts" in extra_data)
+            execution_time = time.perf_counter() - execution_start
         if len(output_ui) > 0:
             caches.ui.set(unique_id, {
                 "meta": {
@@ -370,7 +412,7 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
                 execution_list.add_strong_link(link[0], link[1], unique_id)
             pending_subgraph_results[unique_id] = cached_outputs
             return (ExecutionResult.PENDING, None, None)
-        caches.outputs.set(unique_id, output_data)
+        caches.outputs.set(unique_id, output_data, execution_time=execution_time)
     except comfy.model_management.InterruptProcessingException as iex:
         logging.info("Processing interrupted")
 
@@ -409,16 +451,34 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
 
     return (ExecutionResult.SUCCESS, None, None)
 
+def run_concurrent_node(obj, input_data_all, allow_batching, display_node_id):
+    # inference_mode is thread local, and so is the node the progress bars report for
+    comfy.utils.PROGRESS_BAR_NODE.node_id = display_node_id
+    comfy.model_management.node_pool_thread.active = True
+    try:
+        with torch.inference_mode():
+            return get_output_data(obj, input_data_all, allow_batching=allow_batching)
+    finally:
+        comfy.utils.PROGRESS_BAR_NODE.node_id = None
+        comfy.model_management.node_pool_thread.active = False
+
 class PromptExecutor:
-    def __init__(self, server, lru_size=None):
+    def __init__(self, server, lru_size=None, concurrent_nodes=0, cache_ram_budget=None, cache_vram_budget=None, disk_cache=None):
         self.lru_size = lru_size
+        self.cache_ram_budget = cache_ram_budget
+        self.cache_vram_budget = cache_vram_budget
+        self.disk_cache = disk_cache
         self.server = server
+        # Runs ready nodes with CAN_RUN_CONCURRENTLY (loaders, image decoding, preprocessing) next to
+        # the node the prompt worker is executing.
+        self.node_pool = ThreadPoolExecutor(concurrent_nodes, thread_name_prefix="node") if concurrent_nodes > 0 else None
         self.reset()
 
     def reset(self):
-        self.caches = CacheSet(self.lru_size)
+        self.caches = CacheSet(self.lru_size, self.cache_ram_budget, self.cache_vram_budget, self.disk_cache)
         self.status_messages = []
         self.success = True
+        self.output_data = {}
 
     def add_message(self, event, data: dict, broadcast: bool):
         data = {
@@ -429,6 +489,30 @@ class PromptExecutor:
         if self.server.client_id is not None or broadcast:
             self.server.send_sync(event, data, self.server.client_id)
 
+    def start_concurrent_nodes(self, dynamic_prompt, execution_list, extra_data, node_futures):
+        """
+        Submits the ready nodes that opted into running concurrently to the node pool. execute()
+        picks up their result from `node_futures` when the execution list stages them, so errors,
+        caching and the messages to the client are handled in execution order as usual.
+        """
+        for unique_id in execution_list.get_ready_nodes():
+            if unique_id in node_futures or execution_list.is_cached(unique_id):
+                continue
+            inputs = dynamic_prompt.get_node(unique_id)['inputs']
+            class_type = dynamic_prompt.get_node(unique_id)['class_type']
+            class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+            if not getattr(class_def, "CAN_RUN_CONCURRENTLY", False) or hasattr(class_def, "check_lazy_status"):
+                continue
+            input_data_all, missing_keys = get_input_data(inputs, class_def, unique_id, self.caches.outputs, dynamic_prompt, extra_data)
+            if len(missing_keys) > 0 or any(isinstance(v, ExecutionBlocker) for x in input_data_all.values() for v in x):
+                continue
+            obj = self.caches.objects.get(unique_id)
+            if obj is None:
+                obj = class_def()
+                self.caches.objects.set(unique_id, obj)
+            display_node_id = dynamic_prompt.get_display_node_id(unique_id)
+            node_futures[unique_id] = self.node_pool.submit(run_concurrent_node, obj, input_data_all, "batch_prompts" in extra_data, display_node_id)
+
     def handle_execution_error(self, prompt_id, prompt, current_outputs, executed, error, ex):
         node_id = error["node_id"]
         class_type = prompt[node_id]["class_type"]
@@ -490,14 +574,18 @@ class PromptExecutor:
             current_outputs = self.caches.outputs.all_node_ids()
             for node_id in list(execute_outputs):
                 execution_list.add_node(node_id)
+            node_futures = {}
 
             while not execution_list.is_empty():
-                node_id, error, ex = execution_list.stage_node_execution()
+                if self.node_pool is not None:
+                    self.start_concurrent_nodes(dynamic_prompt, execution_list, extra_data, node_futures)
+                node_id, error, ex = execution_list.stage_node_execution(deferred=node_futures)
                 if error is not None:
                     self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
                     break
 
-                result, error, ex = execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results)
+                image_writer.writer.set_node(dynamic_prompt.get_real_node_id(node_id))
+                result, error, ex = execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, node_futures)
                 self.success = result != ExecutionResult.FAILURE
                 if result == ExecutionResult.FAILURE:
                     self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
@@ -508,7 +596,33 @@ class PromptExecutor:
                     execution_list.complete_node_execution()
             else:
                 # Only execute when the while-loop ends without break
-                self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
+                failures = image_writer.writer.wait()
+                if len(failures) > 0:
+                    self.success = False
+                    node_id, ex = failures[0]
+                    if node_id not in dynamic_prompt.original_prompt:
+                        node_id = execute_outputs[0]
+                    logging.error(f"!!! Exception while writing an image !!! {ex}")
+                    error = {
+                        "node_id": node_id,
+                        "exception_message": str(ex),
+                        "exception_type": full_type_name(type(ex)),
+                        "traceback": traceback.format_tb(ex.__traceback__),
+                        "current_inputs": {},
+                    }
+                    self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
+                else:
+                    self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
+
+            # Images queued before an error are still written
+            image_writer.writer.wait()
+
+            # Nodes still running after an error are waited for, their results are dropped
+            for future in node_futures.values():
+                future.cancel()
+            for future in node_futures.values():
+                if not future.cancelled():
+                    future.exception()
 
             ui_outputs = {}
             meta_outputs = {}
@@ -522,13 +636,15 @@ class PromptExecutor:
                 "outputs": ui_outputs,
                 "meta": meta_outputs,
             }
+            # Raw outputs of the requested nodes for in-process callers (see comfy_execution.embedded)
+            self.output_data = {node_id: self.caches.outputs.get(node_id) for node_id in execute_outputs}
             self.server.last_node_id = None
             if comfy.model_management.DISABLE_SMART_MEMORY:
                 comfy.model_management.unload_all_models()
 
 
 
-def validate_inputs(prompt, item, validated):
+def validate_inputs(prompt, item, validated, input_types=None):
     unique_id = item
     if unique_id in validated:
         return validated[unique_id]
@@ -537,7 +653,10 @@ def validate_inputs(prompt, item, validated):
     class_type = prompt[unique_id]['class_type']
     obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
 
-    class_inputs = obj_class.INPUT_TYPES()
+    if input_types is not None and unique_id in input_types:
+        class_inputs = input_types[unique_id]
+    else:
+        class_inputs = obj_class.INPUT_TYPES()
     valid_inputs = set(class_inputs.get('required',{})).union(set(class_inputs.get('optional',{})))
 
     errors = []
@@ -552,7 +671,7 @@ def validate_inputs(prompt, item, validated):
     received_types = {}
 
     for x in valid_inputs:
-        type_input, input_category, extra_info = get_input_info(obj_class, x)
+        type_input, input_category, extra_info = get_input_info(obj_class, x, class_inputs)
         assert extra_info is not None
         if x not in inputs:
             if input_category == "required":
@@ -605,7 +724,7 @@ def validate_inputs(prompt, item, validated):
                 errors.append(error)
                 continue
             try:
-                r = validate_inputs(prompt, o_id, validated)
+                r = validate_inputs(prompt, o_id, validated, input_types)
                 if r[0] is False:
                     # `r` will be set in `validated[o_id]` already
                     valid = False
@@ -713,7 +832,7 @@ def validate_inputs(prompt, item, validated):
                         continue
 
     if len(validate_function_inputs) > 0 or validate_has_kwargs:
-        input_data_all, _ = get_input_data(inputs, obj_class, unique_id)
+        input_data_all, _ = get_input_data(inputs, obj_class, unique_id, valid_inputs=class_inputs)
         input_filtered = {}
         for x in input_data_all:
             if x in validate_function_inputs or validate_has_kwargs:
@@ -863,8 +982,130 @@ def validate_prompt(prompt):
 
     return (True, None, list(good_outputs), node_errors)
 
+class PromptTemplate:
+    """
+    A prompt that is validated once and then submitted many times with a few changed inputs.
+
+    Registration runs the full validate_prompt and keeps the INPUT_TYPES() result of every node that
+    feeds a valid output. validate(overrides) only re-validates the nodes named in the overrides,
+    against those cached type specs, so requests don't pay for INPUT_TYPES() calls that list model
+    folders or the input directory. Overrides are {node_id: {input_name: value}}; an override that
+    links to another node changes the graph and falls back to a full validate_prompt.
+    """
+    def __init__(self, prompt):
+        self.prompt = copy.deepcopy(prompt)
+        self.valid = validate_prompt(self.prompt)
+        self.outputs = self.valid[2]
+        self.input_types = {}
+        self.dependent_outputs = {}
+        if not self.valid[0]:
+            return
+
+        for o in self.outputs:
+            to_visit = [o]
+            while len(to_visit) > 0:
+                node_id = to_visit.pop()
+                dependent_outputs = self.dependent_outputs.setdefault(node_id, [])
+                if o in dependent_outputs:
+                    continue
+                dependent_outputs.append(o)
+                if node_id not in self.input_types:
+                    class_type = self.prompt[node_id]['class_type']
+                    self.input_types[node_id] = nodes.NODE_CLASS_MAPPINGS[class_type].INPUT_TYPES()
+                for value in self.prompt[node_id]['inputs'].values():
+                    if is_link(value):
+                        to_visit.append(value[0])
+
+    def instantiate(self, overrides=None):
+        # Validation converts values in place, so every submission gets its own inputs dicts.
+        prompt = {}
+        for node_id, node in self.prompt.items():
+            prompt[node_id] = {**node, "inputs": dict(node["inputs"])}
+        if overrides is not None:
+            for node_id, values in overrides.items():
+                prompt[node_id]["inputs"].update(values)
+        return prompt
+
+    def validate(self, overrides):
+        """Returns (validate_prompt result, prompt) for the template with `overrides` applied."""
+        for node_id in overrides:
+            if node_id not in self.prompt:
+                error = {
+                    "type": "invalid_prompt",
+                    "message": "Cannot apply override because the node does not exist in the template.",
+                    "details": f"Node ID '#{node_id}'",
+                    "extra_info": {}
+                }
+                return (False, error, [], []), None
+
+        prompt = self.instantiate(overrides)
+        if any(is_link(value) for values in overrides.values() for value in values.values()):
+            return validate_prompt(prompt), prompt
+
+        validated = {node_id: (True, [], node_id) for node_id in self.input_types if node_id not in overrides}
+        node_errors = {}
+        for node_id in overrides:
+            if node_id not in self.input_types:
+                continue # Doesn't feed any output that passed validation
+            m = self.validate_node(prompt, node_id, validated)
+            if m[0] is not True and any(reason["type"] == "value_not_in_list" for reason in m[1]):
+                # The cached choices may be stale, e.g. a model was added after registration.
+                class_type = prompt[node_id]['class_type']
+                self.input_types[node_id] = nodes.NODE_CLASS_MAPPINGS[class_type].INPUT_TYPES()
+                del validated[node_id]
+                m = self.validate_node(prompt, node_id, validated)
+            if m[0] is not True:
+                class_type = prompt[node_id]['class_type']
+                node_errors[node_id] = {
+                    "errors": m[1],
+                    "dependent_outputs": list(self.dependent_outputs[node_id]),
+                    "class_type": class_type
+                }
+                logging.error(f"Failed to validate prompt template override for {class_type} {node_id}:")
+                for reason in m[1]:
+                    logging.error(f"  - {reason['message']}: {reason['details']}")
+
+        failed_outputs = set(o for errors in node_errors.values() for o in errors["dependent_outputs"])
+        good_outputs = [o for o in self.outputs if o not in failed_outputs]
+        if len(good_outputs) == 0:
+            errors_list = "\n".join(f"{reason['message']}: {reason['details']}" for errors in node_errors.values() for reason in errors["errors"])
+            error = {
+                "type": "prompt_outputs_failed_validation",
+                "message": "Prompt outputs failed validation",
+                "details": errors_list,
+                "extra_info": {}
+            }
+            return (False, error, [], node_errors), prompt
+
+        return (True, None, good_outputs, node_errors), prompt
+
+    def validate_node(self, prompt, node_id, validated):
+        try:
+            return validate_inputs(prompt, node_id, validated, self.input_types)
+        except Exception as ex:
+            typ, _, tb = sys.exc_info()
+            reasons = [{
+                "type": "exception_during_validation",
+                "message": "Exception when validating node",
+                "details": str(ex),
+                "extra_info": {
+                    "exception_type": full_type_name(typ),
+                    "traceback": traceback.format_tb(tb)
+                }
+            }]
+            validated[node_id] = (False, reasons, node_id)
+            return validated[node_id]
+
 MAXIMUM_HISTORY_SIZE = 10000
 
+# How far PromptQueue.get() looks past the head of the queue for a prompt the worker prefers, and how
+# often the head can be passed over that way.
+AFFINITY_LOOKAHEAD = 8
+AFFINITY_MAX_SKIPS = 4
+
+# Queue changes kept for the next queue_delta message, beyond that clients are told to reload the queue.
+MAX_QUEUE_CHANGES = 200
+
 class PromptQueue:
     def __init__(self, server):
         self.server = server
@@ -873,59 +1114,187 @@ class PromptQueue:
         self.task_counter = 0
         self.queue = []
         self.currently_running = {}
-        self.history = {}
+        self.history = history_store(args.history_db, MAXIMUM_HISTORY_SIZE)
         self.flags = {}
+        self.on_done_callbacks = {}
+        self.batch_keys = {}
+        self.affinity_skips = {}
+        self.scheduler = FairShareScheduler(max_queued=args.max_queued_per_client, max_running=args.max_running_per_client)
+        # Number of prompts that execute at the same time, for the estimated waits.
+        self.worker_count = 1
+        # Incremented on every change of the queue, used as the ETag of /queue.
+        self.version = 0
+        self.changes = []
         server.prompt_queue = self
 
-    def put(self, item):
+    def queue_changed(self, change=None, items=()):
+        self.version += 1
+        if self.changes is not None:
+            self.changes += [{"type": change, "prompt_id": item[1], "number": item[0]} for item in items]
+            if len(self.changes) > MAX_QUEUE_CHANGES:
+                self.changes = None
+        self.server.queue_updated()
+
+    def take_changes(self):
+        """
+        The queue version and the changes ("added", "started", "done" or "removed") since the last
+        call, None if there were too many of them.
+        """
+        with self.mutex:
+            changes = self.changes
+            self.changes = []
+            return self.version, changes
+
+    def put(self, item, on_done=None):
+        """
+        Queue items are shared by the queue, the prompt worker and the history without copying, so
+        they must not be modified once they are put. Raises comfy_execution.scheduling.QueueFull
+        when the client has too many prompts queued.
+        """
         with self.mutex:
+            self.scheduler.add(item)
+            if on_done is not None:
+                self.on_done_callbacks[item[1]] = on_done
             heapq.heappush(self.queue, item)
-            self.server.queue_updated()
+            self.queue_changed("added", [item])
             self.not_empty.notify()
 
-    def get(self, timeout=None):
+    def get(self, timeout=None, affinity=None):
         with self.not_empty:
-            while len(self.queue) == 0:
+            item = self.pop_next(affinity)
+            while item is None:
                 self.not_empty.wait(timeout=timeout)
-                if timeout is not None and len(self.queue) == 0:
+                item = self.pop_next(affinity)
+                if timeout is not None and item is None:
                     return None
-            item = heapq.heappop(self.queue)
             i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
+            self.currently_running[i] = item
             self.task_counter += 1
-            self.server.queue_updated()
+            self.queue_changed("started", [item])
             return (item, i)
 
+    def get_batch(self, max_size, timeout=None, affinity=None):
+        """
+        Like get(), but also takes up to max_size - 1 other queued prompts that only differ from the
+        first one in batchable inputs (see comfy_execution/batching.py), in scheduling order. Returns a
+        list of (item, item_id) or None.
+        """
+        with self.not_empty:
+            first = self.pop_next(affinity)
+            while first is None:
+                self.not_empty.wait(timeout=timeout)
+                first = self.pop_next(affinity)
+                if timeout is not None and first is None:
+                    return None
+            items = [first]
+            if max_size > 1 and len(self.queue) > 0:
+                key = self.get_batch_key(first)
+                for item in sorted(self.queue, key=self.scheduler.key):
+                    if len(items) >= max_size:
+                        break
+                    if self.get_batch_key(item) == key and self.scheduler.can_start(item):
+                        self.scheduler.start(item)
+                        items.append(item)
+                if len(items) > 1:
+                    taken = set(item[1] for item in items)
+                    self.queue = [item for item in self.queue if item[1] not in taken]
+                    heapq.heapify(self.queue)
+
+            out = []
+            for item in items:
+                self.batch_keys.pop(item[1], None)
+                i = self.task_counter
+                self.currently_running[i] = item
+                self.task_counter += 1
+                out.append((item, i))
+            self.queue_changed("started", items)
+            return out
+
+    def pop_next(self, affinity=None):
+        """
+        Pops the next item the scheduler picks (see comfy_execution/scheduling.py), or None if no
+        queued item can start. If `affinity(item)` (from comfy_execution/worker_pool.py: the worker
+        already has the prompt's models loaded) is false for that item and true for one of the items
+        after it, that one is taken instead, at most AFFINITY_MAX_SKIPS times for the same head.
+        """
+        if len(self.queue) == 0:
+            return None
+        candidates = self.scheduler.next_items(self.queue, AFFINITY_LOOKAHEAD if affinity is not None else 1)
+        if len(candidates) == 0:
+            return None
+
+        item = candidates[0]
+        if affinity is not None and not affinity(item):
+            skips = self.affinity_skips.get(item[1], 0)
+            if skips < AFFINITY_MAX_SKIPS:
+                for other in candidates[1:]:
+                    if affinity(other):
+                        self.affinity_skips[item[1]] = skips + 1
+                        item = other
+                        break
+        self.affinity_skips.pop(item[1], None)
+        self.queue.remove(item)
+        heapq.heapify(self.queue)
+        self.scheduler.start(item)
+        return item
+
+    def get_batch_key(self, item):
+        if item[1] not in self.batch_keys:
+            self.batch_keys[item[1]] = batch_key(item[2], item[4])
+        return self.batch_keys[item[1]]
+
     class ExecutionStatus(NamedTuple):
         status_str: Literal['success', 'error']
         completed: bool
         messages: List[str]
 
     def task_done(self, item_id, history_result,
-                  status: Optional['PromptQueue.ExecutionStatus']):
+                  status: Optional['PromptQueue.ExecutionStatus'], output_data=None):
         with self.mutex:
             prompt = self.currently_running.pop(item_id)
-            if len(self.history) > MAXIMUM_HISTORY_SIZE:
-                self.history.pop(next(iter(self.history)))
+            self.scheduler.finish(prompt)
+            self.not_empty.notify()
 
             status_dict: Optional[dict] = None
             if status is not None:
                 status_dict = copy.deepcopy(status._asdict())
 
-            self.history[prompt[1]] = {
+            entry = {
                 "prompt": prompt,
                 "outputs": {},
                 'status': status_dict,
             }
-            self.history[prompt[1]].update(history_result)
-            self.server.queue_updated()
+            entry.update(history_result)
+            self.history.add(prompt[1], entry)
+            self.queue_changed("done", [prompt])
+
+            on_done = self.on_done_callbacks.pop(prompt[1], None)
+            if on_done is not None:
+                on_done(status, output_data)
+
+    def forget_queued(self, items):
+        for item in items:
+            self.scheduler.remove(item)
+            self.batch_keys.pop(item[1], None)
+            self.affinity_skips.pop(item[1], None)
+            on_done = self.on_done_callbacks.pop(item[1], None)
+            if on_done is not None:
+                on_done(None, None)
 
     def get_current_queue(self):
         with self.mutex:
-            out = []
-            for x in self.currently_running.values():
-                out += [x]
-            return (out, copy.deepcopy(self.queue))
+            return (list(self.currently_running.values()), list(self.queue))
+
+    def get_queue_summary(self):
+        """Numbers and prompt ids of the running and pending prompts, without the prompts."""
+        with self.mutex:
+            running = [{"number": x[0], "prompt_id": x[1]} for x in self.currently_running.values()]
+            pending = [{"number": x[0], "prompt_id": x[1]} for x in sorted(self.queue, key=self.scheduler.key)]
+            return (running, pending)
+
+    def get_estimated_waits(self):
+        with self.mutex:
+            return self.scheduler.estimated_waits(self.queue, self.worker_count)
 
     def get_tasks_remaining(self):
         with self.mutex:
@@ -933,8 +1302,12 @@ class PromptQueue:
 
     def wipe_queue(self):
         with self.mutex:
+            removed = self.queue
+            self.forget_queued(removed)
             self.queue = []
-            self.server.queue_updated()
+            self.batch_keys = {}
+            self.affinity_skips = {}
+            self.queue_changed("removed", removed)
 
     def delete_queue_item(self, function):
         with self.mutex:
@@ -943,43 +1316,35 @@ class PromptQueue:
                     if len(self.queue) == 1:
                         self.wipe_queue()
                     else:
-                        self.queue.pop(x)
+                        item = self.queue.pop(x)
+                        self.forget_queued([item])
                         heapq.heapify(self.queue)
-                    self.server.queue_updated()
+                        self.queue_changed("removed", [item])
                     return True
         return False
 
-    def get_history(self, prompt_id=None, max_items=None, offset=-1):
+    def get_history(self, prompt_id=None, max_items=None, offset=-1, since=None):
         with self.mutex:
             if prompt_id is None:
-                out = {}
-                i = 0
-                if offset < 0 and max_items is not None:
-                    offset = len(self.history) - max_items
-                for k in self.history:
-                    if i >= offset:
-                        out[k] = self.history[k]
-                        if max_items is not None and len(out) >= max_items:
-                            break
-                    i += 1
-                return out
-            elif prompt_id in self.history:
-                return {prompt_id: copy.deepcopy(self.history[prompt_id])}
+                return self.history.page(max_items, offset, since)
+            entry = self.history.get(prompt_id)
+            if entry is not None:
+                return {prompt_id: entry}
             else:
                 return {}
 
     def wipe_history(self):
         with self.mutex:
-            self.history = {}
+            self.history.wipe()
 
     def delete_history_item(self, id_to_delete):
         with self.mutex:
-            self.history.pop(id_to_delete, None)
+            self.history.delete(id_to_delete)
 
     def set_flag(self, name, data):
         with self.mutex:
             self.flags[name] = data
-            self.not_empty.notify()
+            self.not_empty.notify_all()
 
     def get_flags(self, reset=True):
         with self.mutex:
@@ -1,37 +1,114 @@
 import os
 import threading
 import csv
-from flask import Flask, request, make_response
+from flask import Flask, request, make_response, jsonify, Response
 from flask_cors import CORS
 import time
 import nest_asyncio
 import gdown
 import shutil
 import random
+import tempfile
+import uuid
+import json
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 from comfy_api_simplified import ComfyApiWrapper, ComfyWorkflowWrapper
 
 import main
+import folder_paths
+
+class GenerationJob:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    ERROR = "error"
+
+    def __init__(self, userName: str):
+        self.id = uuid.uuid4().hex
+        self.userName = userName
+        self.status = GenerationJob.QUEUED
+        self.created = time.time()
+        self.finished = None
+        self.image_name = None
+        self.image_data = None
+        self.error = None
+        self.done_event = threading.Event()
+
+    def is_finished(self) -> bool:
+        return self.status in (GenerationJob.DONE, GenerationJob.ERROR)
+
+    def set_result(self, image_name, image_data):
+        self.image_name = image_name
+        self.image_data = image_data
+        self.status = GenerationJob.DONE
+        self.finished = time.time()
+        self.done_event.set()
+
+    def set_error(self, error: str):
+        self.error = error
+        self.status = GenerationJob.ERROR
+        self.finished = time.time()
+        self.done_event.set()
+
+    def wait(self, timeout=None) -> bool:
+        return self.done_event.wait(timeout)
+
+    def to_dict(self):
+        info = {"job_id": self.id, "status": self.status}
+        if self.error is not None:
+            info["error"] = self.error
+        return info
 
 class FlaskServer:
     LOCAL_SERVER_ADDRESS = "http://127.0.0.1:8188/"
     LOCAL_CONFIG_PATH = "workflows/adil_workflow_v1.0.0.json"
+    OUTPUT_NODE_TITLE = "Save Image"
+    # Results are served as JPEG, the output node encodes them that way (see SaveImage).
+    OUTPUT_FORMAT = "jpeg"
+    OUTPUT_QUALITY = 95
+    # Subfolder of the ComfyUI input directory used for sketches in in-process mode.
+    UPLOAD_SUBFOLDER = "api"
     USER_COOLDOWN = 1
-    
-    def __init__(self, userCredentialsPath: str):
+    # Number of generations that may be in flight against ComfyUI at the same time.
+    JOB_WORKERS = 4
+    # Finished jobs are kept this many seconds so clients can collect the result.
+    JOB_RETENTION = 600
+    # Upper bound for a single long-poll on /jobs/<id>?wait=N.
+    MAX_JOB_WAIT = 60
+
+    def __init__(self, userCredentialsPath: str, api=None, executor=None):
         self.userCredentials = []
         self.userLastRequestTimes = {}
-        
-        self.api = ComfyApiWrapper(FlaskServer.LOCAL_SERVER_ADDRESS) 
+        self.jobs = {}
+        self.jobsLock = threading.Lock()
+        self.jobExecutor = ThreadPoolExecutor(max_workers=FlaskServer.JOB_WORKERS, thread_name_prefix="generate")
+
+        # With an executor (comfy_execution.embedded.EmbeddedExecutor) workflows run in this process
+        # and uploads are written straight into the ComfyUI input folder. Otherwise ComfyUI is driven
+        # over HTTP and the workflow JSON is parsed once and copied for every request.
+        self.executor = executor
+        if executor is not None:
+            from comfy_execution.embedded import WorkflowTemplate
+            self.template = WorkflowTemplate.from_file(FlaskServer.LOCAL_CONFIG_PATH, [FlaskServer.OUTPUT_NODE_TITLE])
+            self.uploadDirectory = os.path.join(folder_paths.get_input_directory(), FlaskServer.UPLOAD_SUBFOLDER)
+            os.makedirs(self.uploadDirectory, exist_ok=True)
+        else:
+            with open(FlaskServer.LOCAL_CONFIG_PATH, "r", encoding="utf-8") as f:
+                self.workflow = json.load(f)
+            self.uploadDirectory = tempfile.mkdtemp(prefix="genarci_uploads_")
+
+        self.api = api if api is not None or executor is not None else ComfyApiWrapper(FlaskServer.LOCAL_SERVER_ADDRESS)
         self.app = Flask("Flask Server")
         CORS(self.app, resources={r"/*": {"origins": "*"}})
         self.setup_routes()
         self.parse_user_credentials(userCredentialsPath)
-        
-        self.app.run(host='0.0.0.0', port=80, ssl_context=('/etc/letsencrypt/live/genarci.com/fullchain.pem', '/etc/letsencrypt/live/genarci.com/privkey.pem'))
-        
+
+    def run(self):
         print("Started running flask server...")
-        
+        self.app.run(host='0.0.0.0', port=80, threaded=True, ssl_context=('/etc/letsencrypt/live/genarci.com/fullchain.pem', '/etc/letsencrypt/live/genarci.com/privkey.pem'))
+
     def setup_routes(self):
         @self.app.route("/healthCheck", methods=['GET'])
         def healthCheck():
@@ -40,43 +117,150 @@ class FlaskServer:
         @self.app.route("/generateImage", methods=['POST'])
         def generateImage():
             result = "Invalid username or password.", 403
-            
+
             userName = request.authorization.get('username')
             password = request.authorization.get('password')
-            
+
             print("Got request from {},{}".format(userName, password))
             if self.validate_user(userName, password):
                 currentRequestTime = int(time.time())
                 lastRequestTime = 0
                 if self.userLastRequestTimes.get(userName) != None:
                     lastRequestTime = self.userLastRequestTimes[userName]
-                
-                passedTime = currentRequestTime - lastRequestTime 
+
+                passedTime = currentRequestTime - lastRequestTime
                 if passedTime > FlaskServer.USER_COOLDOWN:
                     print("Generating image!")
-                    sketchImageFile = request.files['sketch']
-                    sketchImageFile.save('temp.jpg')
-                    sketchImageMetaData = self.api.upload_image('temp.jpg')
-                    imagetype = request.form['imagetype'] 
-                    buildingtype = request.form['buildingtype']
-                    subregion = request.form['subregion']
-                    architect = request.form['architect']
-                    atmosphere = request.form['atmosphere']
-                    ratio = request.form['ratio']
-                    result = self.generate_image(sketchImageMetaData, imagetype, buildingtype, subregion, architect, atmosphere, ratio)
-                    if os.path.exists('./temp.jpg'):
-                        os.remove('./temp.jpg')
-                        
+                    sketchPath = self.save_upload(request.files['sketch'])
+                    parameters = {
+                        "imagetype": request.form['imagetype'],
+                        "buildingtype": request.form['buildingtype'],
+                        "subregion": request.form['subregion'],
+                        "architect": request.form['architect'],
+                        "atmosphere": request.form['atmosphere'],
+                        "ratio": request.form['ratio'],
+                    }
+                    job = self.submit_job(userName, sketchPath, parameters)
                     self.userLastRequestTimes[userName] = currentRequestTime
-                    print("Generated image!")
+
+                    if self.is_async_request():
+                        result = jsonify({**job.to_dict(), "status_url": "/jobs/{}".format(job.id)}), 202
+                    else:
+                        job.wait()
+                        result = self.job_result(job)
+                        self.forget_job(job.id)
                 else:
                     remainingTime = FlaskServer.USER_COOLDOWN - passedTime
                     minutes = int(remainingTime // 60)
                     seconds = int(remainingTime % 60)
                     result = "You have to wait before making any new requests! Current wait time is {} minutes and {} seconds".format(minutes, seconds), 429
-            
+
             return result
 
+        @self.app.route("/jobs/<job_id>", methods=['GET'])
+        def getJob(job_id):
+            job, error = self.get_user_job(job_id)
+            if job is None:
+                return error
+
+            wait = request.args.get('wait', 0, type=float)
+            if wait > 0 and not job.is_finished():
+                job.wait(min(wait, FlaskServer.MAX_JOB_WAIT))
+
+            if not job.is_finished():
+                return jsonify(job.to_dict()), 202
+            return self.job_result(job)
+
+        @self.app.route("/jobs/<job_id>/events", methods=['GET'])
+        def getJobEvents(job_id):
+            job, error = self.get_user_job(job_id)
+            if job is None:
+                return error
+
+            def stream():
+                lastStatus = None
+                deadline = time.time() + FlaskServer.JOB_RETENTION
+                while time.time() < deadline:
+                    if job.status != lastStatus:
+                        lastStatus = job.status
+                        yield "event: status\ndata: {}\n\n".format(json.dumps(job.to_dict()))
+                    if job.is_finished():
+                        return
+                    # A comment line keeps proxies from closing an idle stream.
+                    if not job.wait(15):
+                        yield ": keep-alive\n\n"
+
+            return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    def is_async_request(self) -> bool:
+        value = request.args.get('async', request.form.get('async', ''))
+        return value.lower() in ('1', 'true', 'yes')
+
+    def get_user_job(self, job_id):
+        userName = request.authorization.get('username') if request.authorization else None
+        password = request.authorization.get('password') if request.authorization else None
+        if not self.validate_user(userName, password):
+            return None, ("Invalid username or password.", 403)
+
+        with self.jobsLock:
+            job = self.jobs.get(job_id)
+        if job is None or job.userName != userName:
+            return None, ("Unknown job.", 404)
+        return job, None
+
+    def save_upload(self, fileStorage) -> str:
+        # Every request gets its own file so concurrent uploads cannot overwrite each other.
+        extension = os.path.splitext(fileStorage.filename or "")[1] or ".jpg"
+        path = os.path.join(self.uploadDirectory, "sketch_{}{}".format(uuid.uuid4().hex, extension))
+        fileStorage.save(path)
+        return path
+
+    def submit_job(self, userName: str, sketchPath: str, parameters: dict) -> GenerationJob:
+        job = GenerationJob(userName)
+        with self.jobsLock:
+            self.purge_finished_jobs()
+            self.jobs[job.id] = job
+        self.jobExecutor.submit(self.run_job, job, sketchPath, parameters)
+        return job
+
+    def run_job(self, job: GenerationJob, sketchPath: str, parameters: dict):
+        job.status = GenerationJob.RUNNING
+        try:
+            if self.executor is not None:
+                image = self.generate_image_in_process(sketchPath, job.userName, **parameters)
+            else:
+                sketchImageMetaData = self.api.upload_image(sketchPath)
+                image = self.generate_image(sketchImageMetaData, **parameters)
+            if image is None:
+                job.set_error("No generated image!")
+            else:
+                job.set_result(*image)
+                print("Generated image!")
+        except Exception as e:
+            print("Failed to generate image: {}".format(e))
+            job.set_error(str(e))
+        finally:
+            if os.path.exists(sketchPath):
+                os.remove(sketchPath)
+
+    def job_result(self, job: GenerationJob):
+        if job.status == GenerationJob.ERROR:
+            return job.error, 500
+        response = make_response(job.image_data)
+        response.headers.set('Content-Type', 'image/jpeg')
+        response.headers.set('Content-Disposition', 'attachment', filename='%s.jpg' % job.image_name)
+        return response
+
+    def forget_job(self, job_id: str):
+        with self.jobsLock:
+            self.jobs.pop(job_id, None)
+
+    def purge_finished_jobs(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items() if job.is_finished() and now - job.finished > FlaskServer.JOB_RETENTION]
+        for job_id in expired:
+            del self.jobs[job_id]
+
     def parse_user_credentials(self, filePath: str):
         try:
             with open(filePath, newline='') as file:
@@ -85,35 +269,56 @@ class FlaskServer:
                     self.userCredentials.append((row[0], row[1]))
         except FileNotFoundError:
             print("File {0} not found!".format(filePath))
-    
+
     def validate_user(self, userName: str, password: str) -> bool:
         for userCredential in self.userCredentials:
             if userCredential[0] == userName and userCredential[1] == password:
                 return True
-        
+
         return False
-    
-    def generate_image(self, sketchImageMetaData, imagetype, buildingtype, subregion, architect, atmosphere, ratio):
-        workflow = ComfyWorkflowWrapper(FlaskServer.LOCAL_CONFIG_PATH)
-        
-        workflow.set_node_param("Load Image", "image", "{0}/{1}".format(sketchImageMetaData['subfolder'], sketchImageMetaData['name']))
-        workflow.set_node_param("Architectural Prompt Generator", "architect", architect)
-        workflow.set_node_param("Architectural Prompt Generator", "region", subregion)
-        workflow.set_node_param("Architectural Prompt Generator", "building_type", buildingtype)
-        workflow.set_node_param("Architectural Prompt Generator", "interior_exterior", imagetype.lower())
-        workflow.set_node_param("Architectural Prompt Generator", "atmosphere", atmosphere)
-        workflow.set_node_param("Latent Image Resolution", "aspect_ratio", ratio)
-        workflow.set_node_param("SamplerCustom", "noise_seed", random.randint(0, 0xFFFFFFFFFFFFFFFF))
-        
-        results = self.api.queue_and_wait_images(workflow, output_node_title="Save Image")
+
+    def workflow_parameters(self, sketchImage, imagetype, buildingtype, subregion, architect, atmosphere, ratio):
+        return {
+            "Load Image": {"image": sketchImage},
+            "Architectural Prompt Generator": {
+                "architect": architect,
+                "region": subregion,
+                "building_type": buildingtype,
+                "interior_exterior": imagetype.lower(),
+                "atmosphere": atmosphere,
+            },
+            "Latent Image Resolution": {"aspect_ratio": ratio},
+            "SamplerCustom": {"noise_seed": random.randint(0, 0xFFFFFFFFFFFFFFFF)},
+        }
+
+    def generate_image(self, sketchImageMetaData, **parameters):
+        workflow = ComfyWorkflowWrapper(copy.deepcopy(self.workflow))
+
+        sketchImage = "{0}/{1}".format(sketchImageMetaData['subfolder'], sketchImageMetaData['name'])
+        for title, values in self.workflow_parameters(sketchImage, **parameters).items():
+            for param, value in values.items():
+                workflow.set_node_param(title, param, value)
+        workflow.set_node_param(FlaskServer.OUTPUT_NODE_TITLE, "format", FlaskServer.OUTPUT_FORMAT)
+        workflow.set_node_param(FlaskServer.OUTPUT_NODE_TITLE, "quality", FlaskServer.OUTPUT_QUALITY)
+        workflow.set_node_param(FlaskServer.OUTPUT_NODE_TITLE, "metadata", False)
+
+        results = self.api.queue_and_wait_images(workflow, output_node_title=FlaskServer.OUTPUT_NODE_TITLE)
         for image_name, image_data in results.items():
-            response = make_response(image_data)
-            response.headers.set('Content-Type', 'image/jpeg')
-            response.headers.set('Content-Disposition', 'attachment', filename='%s.jpg' % image_name)
-            return response
-        
-        return "No generated image!", 500
-    
+            return image_name, image_data
+
+        return None
+
+    def generate_image_in_process(self, sketchPath: str, userName: str, **parameters):
+        sketchImage = "{0}/{1}".format(FlaskServer.UPLOAD_SUBFOLDER, os.path.basename(sketchPath))
+        overrides = self.workflow_parameters(sketchImage, **parameters)
+
+        # Users share the prompt queue fairly, see comfy_execution/scheduling.py.
+        results = self.executor.run_encoded(self.template, overrides, image_format=FlaskServer.OUTPUT_FORMAT, quality=FlaskServer.OUTPUT_QUALITY, tenant=userName)
+        for image_data in results[FlaskServer.OUTPUT_NODE_TITLE]:
+            return "genarci_{}".format(uuid.uuid4().hex[:8]), image_data
+
+        return None
+
 if __name__ == "__main__":
     extras = [('https://drive.google.com/uc?id=1-sOYJNuCvRB966m30b604sgWvw-boLJU', 'control_v11p_sd15_lineart_fp16.safetensors', 'models/controlnet'),
               ('https://drive.google.com/uc?id=16S-lSU4dqkGfEc6bub0DpCyjkjkDXi4n', 'control_v11f1p_sd15_depth_fp16.safetensors', 'models/controlnet'),
@@ -123,11 +328,18 @@ if __name__ == "__main__":
         if not os.path.exists("{0}/{1}".format(extra[2], extra[1])):
             gdown.download(extra[0], extra[1], quiet=False)
             shutil.move("./{}".format(extra[1]), "./{0}/{1}".format(extra[2], extra[1]))
-    
+
     nest_asyncio.apply()
-    
+
     comfyUiServer = threading.Thread(target=main.main, daemon=True)
     comfyUiServer.start()
-    
+
     userCredentialsPath = os.environ.get('USER_CREDENTIALS')
-    app = FlaskServer(userCredentialsPath)
\ No newline at end of file
+    executor = None
+    if os.environ.get('COMFY_IN_PROCESS', '').lower() in ('1', 'true', 'yes'):
+        import server
+        from comfy_execution.embedded import EmbeddedExecutor
+        main.ready.wait()
+        executor = EmbeddedExecutor(server.PromptServer.instance.prompt_queue)
+    app = FlaskServer(userCredentialsPath, executor=executor)
+    app.run()
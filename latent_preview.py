@@ -7,16 +7,14 @@ from comfy.taesd.taesd import TAESD
 import comfy.model_management
 import folder_paths
 import comfy.utils
+from comfy_execution import image_writer
 import logging
 
 MAX_PREVIEW_RESOLUTION = args.preview_size
 
 def preview_to_image(latent_image):
-        latents_ubyte = (((latent_image + 1.0) / 2.0).clamp(0, 1)  # change scale from -1..1 to 0..1
-                            .mul(0xFF)  # to 0..255
-                            ).to(device="cpu", dtype=torch.uint8, non_blocking=comfy.model_management.device_supports_non_blocking(latent_image.device))
-
-        return Image.fromarray(latents_ubyte.numpy())
+        latents_ubyte = image_writer.images_to_uint8(latent_image.unsqueeze(0), value_range=(-1.0, 1.0))[0]
+        return Image.fromarray(latents_ubyte)
 
 class LatentPreviewer:
     def decode_latent_to_preview(self, x0):
@@ -76,10 +76,16 @@ if args.windows_standalone_build:
 import comfy.utils
 
 import execution
+from comfy_execution import batching
+from comfy_execution.worker_pool import WorkerPool
+from comfy_execution.caching import DiskCache
+from app.content_store import ContentStore
 import server
 from server import BinaryEventTypes
 import nodes
 import comfy.model_management
+import comfy.model_registry
+import comfy.model_patcher
 
 def cuda_malloc_warning():
     device = comfy.model_management.get_torch_device()
@@ -92,8 +98,35 @@ def cuda_malloc_warning():
         if cuda_malloc_warning:
             logging.warning("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
+def execute_batch(q, e, server, queue_items):
+    items = [item for item, item_id in queue_items]
+    prompts = [item[2] for item in items]
+    merged = batching.merge_prompts(prompts)
+    extra_data = batching.merge_extra_data([item[3] for item in items], prompts)
+    prompt_id = items[0][1]
+    server.last_prompt_id = prompt_id
+
+    e.execute(merged, prompt_id, extra_data, items[0][4])
+    results = batching.split_results(merged, len(items), e.history_result, e.output_data)
+    for (item, item_id), (history_result, output_data) in zip(queue_items, results):
+        q.task_done(item_id,
+                    history_result,
+                    status=execution.PromptQueue.ExecutionStatus(
+                        status_str='success' if e.success else 'error',
+                        completed=e.success,
+                        messages=batching.split_status_messages(e.status_messages, item[1])),
+                    output_data=output_data)
+        client_id = item[3].get("client_id", None)
+        if client_id is not None:
+            server.send_sync("executing", { "node": None, "prompt_id": item[1] }, client_id)
+
 def prompt_worker(q, server):
-    e = execution.PromptExecutor(server, lru_size=args.cache_lru)
+    cache_budgets = [None if gb is None else int(gb * 1024 ** 3) for gb in (args.cache_ram_budget, args.cache_vram_budget)]
+    disk_cache = None
+    if args.cache_disk is not None:
+        disk_cache = DiskCache(args.cache_disk, int(args.cache_disk_size * 1024 ** 3))
+    e = execution.PromptExecutor(server, lru_size=args.cache_lru, concurrent_nodes=args.concurrent_nodes,
+                                 cache_ram_budget=cache_budgets[0], cache_vram_budget=cache_budgets[1], disk_cache=disk_cache)
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
@@ -103,9 +136,22 @@ def prompt_worker(q, server):
         if need_gc:
             timeout = max(gc_collect_interval - (current_time - last_gc_collect), 0.0)
 
-        queue_item = q.get(timeout=timeout)
-        if queue_item is not None:
-            item, item_id = queue_item
+        if args.batch_prompts > 1:
+            queue_items = q.get_batch(args.batch_prompts, timeout=timeout)
+        else:
+            queue_item = q.get(timeout=timeout)
+            queue_items = [queue_item] if queue_item is not None else None
+
+        if queue_items is not None and len(queue_items) > 1:
+            execution_start_time = time.perf_counter()
+            execute_batch(q, e, server, queue_items)
+            need_gc = True
+
+            current_time = time.perf_counter()
+            execution_time = current_time - execution_start_time
+            logging.info("Batch of {} prompts executed in {:.2f} seconds".format(len(queue_items), execution_time))
+        elif queue_items is not None:
+            item, item_id = queue_items[0]
             execution_start_time = time.perf_counter()
             prompt_id = item[1]
             server.last_prompt_id = prompt_id
@@ -117,7 +163,8 @@ def prompt_worker(q, server):
                         status=execution.PromptQueue.ExecutionStatus(
                             status_str='success' if e.success else 'error',
                             completed=e.success,
-                            messages=e.status_messages))
+                            messages=e.status_messages),
+                        output_data=e.output_data)
             if server.client_id is not None:
                 server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, server.client_id)
 
@@ -135,6 +182,10 @@ def prompt_worker(q, server):
 
         if free_memory:
             e.reset()
+            comfy.model_registry.registry().clear()
+            patched_weights = comfy.model_patcher.patched_weight_cache()
+            if patched_weights is not None:
+                patched_weights.clear()
             need_gc = True
             last_gc_collect = 0
 
@@ -147,6 +198,11 @@ def prompt_worker(q, server):
                 last_gc_collect = current_time
                 need_gc = False
 
+def run_worker(q, server):
+    # Entry point of the worker processes of a comfy_execution.worker_pool.WorkerPool.
+    hijack_progress(server)
+    prompt_worker(q, server)
+
 async def run(server, address='', port=8188, verbose=True, call_on_start=None):
     addresses = []
     for addr in address.split(","):
@@ -155,12 +211,14 @@ async def run(server, address='', port=8188, verbose=True, call_on_start=None):
 
 
 def hijack_progress(server):
-    def hook(value, total, preview_image):
+    def hook(value, total, preview_image, node_id=None):
+        # node_id is set for nodes that run on the node thread pool next to the executing node
         comfy.model_management.throw_exception_if_processing_interrupted()
-        progress = {"value": value, "max": total, "prompt_id": server.last_prompt_id, "node": server.last_node_id}
+        progress = {"value": value, "max": total, "prompt_id": server.last_prompt_id, "node": server.last_node_id if node_id is None else node_id}
 
         server.send_sync("progress", progress, server.client_id)
-        if preview_image is not None:
+        # Previews carry no node, the client shows them on the executing node
+        if preview_image is not None and node_id is None:
             server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, server.client_id)
     comfy.utils.set_progress_bar_global_hook(hook)
 
@@ -191,6 +249,9 @@ def load_extra_path_config(yaml_path):
                 logging.info("Adding extra search path {} {}".format(x, full_path))
                 folder_paths.add_model_folder_path(x, full_path)
 
+# Set once main() has created the prompt queue and loaded all nodes (see flask_server.py).
+ready = threading.Event()
+
 def main():
     if args.cuda_device is not None:
         os.environ['CUDA_VISIBLE_DEVICES'] = str(args.cuda_device)
@@ -235,8 +296,6 @@ def main():
     currentServer.add_routes()
     hijack_progress(currentServer)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, currentServer,)).start()
-
     if args.output_directory:
         output_dir = os.path.abspath(args.output_directory)
         logging.info(f"Setting output directory to: {output_dir}")
@@ -262,6 +321,17 @@ def main():
     if args.quick_test_for_ci:
         exit(0)
 
+    if args.content_addressed_uploads:
+        # Blobs of uploads that were replaced or deleted since the last start
+        stores = [ContentStore(directory) for directory in (folder_paths.get_input_directory(), folder_paths.get_output_directory())]
+        threading.Thread(target=lambda: [store.collect_garbage() for store in stores], daemon=True).start()
+
+    # Worker processes copy the folder paths when they start, so they are started once those are set.
+    if args.worker_count > 1:
+        WorkerPool(q, currentServer, args.worker_count, run_worker).start()
+    else:
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, currentServer,)).start()
+
     os.makedirs(folder_paths.get_temp_directory(), exist_ok=True)
     call_on_start = None
     if args.auto_launch:
@@ -274,6 +344,9 @@ def main():
             webbrowser.open(f"{scheme}://{address}:{port}")
         call_on_start = startup_server
 
+    # Nodes are registered and folder paths are set, so in-process users of the prompt queue can start.
+    ready.set()
+
     try:
         loop.run_until_complete(currentServer.setup())
         loop.run_until_complete(run(currentServer, address=args.listen, port=args.port, verbose=not args.dont_print_server, call_on_start=call_on_start))
@@ -0,0 +1,156 @@
+"""
+Pickled model files (.ckpt, .pt, .pth, .bin) converted once to .safetensors, so later loads take the
+memory mapped path of comfy.utils.load_torch_file instead of unpickling the whole file.
+
+The converted files are named by the sha256 of the source file. The hashes are kept in a database in
+the cache directory (see node_helpers.FileHashCache), so after a restart finding the converted file
+costs a stat of the source file, not a read.
+
+Enabled with --conversion-cache PATH. The cache can be filled ahead of time:
+    python -m model_filemanager.conversion_cache --cache PATH [directories]
+"""
+import argparse
+import logging
+import os
+import threading
+import uuid
+
+import torch
+import safetensors.torch
+
+import comfy.utils
+import node_helpers
+from comfy.cli_args import args
+
+PICKLE_EXTENSIONS = (".ckpt", ".pt", ".pth", ".bin")
+
+DTYPES = {"keep": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+# Model folders the loaders convert, with the safe_load they load the files with.
+LOADER_FOLDERS = {"checkpoints": False, "vae": False, "controlnet": True, "loras": True}
+
+
+def normalize_state_dict(sd, dtype=None):
+    """
+    The state dict as it is written to the safetensors file: contiguous tensors that don't share
+    memory, floating point tensors larger than `dtype` converted to it. None if the file holds more
+    than a flat dict of tensors (embeddings, training state), those are not converted.
+    """
+    if not isinstance(sd, dict) or len(sd) == 0:
+        return None
+    out = {}
+    storages = set()
+    for k, v in sd.items():
+        if not isinstance(k, str) or not isinstance(v, torch.Tensor):
+            return None
+        if dtype is not None and v.is_floating_point() and v.dtype.itemsize > dtype.itemsize:
+            v = v.to(dtype)
+        v = v.contiguous()
+        storage = v.untyped_storage().data_ptr()
+        if storage in storages:
+            v = v.clone()
+        storages.add(v.untyped_storage().data_ptr())
+        out[k] = v
+    return out
+
+
+class ConversionCache:
+    def __init__(self, root, dtype=None):
+        self.root = root
+        self.dtype = dtype
+        self.hashes = node_helpers.FileHashCache(os.path.join(root, "hashes.sqlite"))
+        self.lock = threading.Lock()
+
+    def path_for(self, digest):
+        suffix = "" if self.dtype is None else "." + str(self.dtype).split(".")[-1]
+        return os.path.join(self.root, digest[:2], "{}{}.safetensors".format(digest, suffix))
+
+    def load(self, path, safe_load=False):
+        """comfy.utils.load_torch_file(path, safe_load), converting pickled files on first use."""
+        if not path.lower().endswith(PICKLE_EXTENSIONS):
+            return comfy.utils.load_torch_file(path, safe_load=safe_load)
+
+        digest = self.hashes.hash(path)
+        target = self.path_for(digest)
+        if os.path.exists(target):
+            return comfy.utils.load_torch_file(target)
+
+        # Loaders can run concurrently, a file is converted once
+        with self.lock:
+            if os.path.exists(target):
+                return comfy.utils.load_torch_file(target)
+            sd = comfy.utils.load_torch_file(path, safe_load=safe_load)
+            if not self.convert(path, sd, target, digest):
+                return sd
+        del sd
+        return comfy.utils.load_torch_file(target)
+
+    def convert(self, path, sd, target, digest):
+        tensors = normalize_state_dict(sd, self.dtype)
+        if tensors is None:
+            logging.debug("Not converting {}, it is not a flat state dict.".format(path))
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = "{}.{}.tmp".format(target, uuid.uuid4().hex)
+        try:
+            safetensors.torch.save_file(tensors, temp_path, metadata={"source": os.path.basename(path), "sha256": digest})
+            os.replace(temp_path, target)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logging.info("Converted {} to {}".format(path, target))
+        return True
+
+
+_conversion_cache = None
+
+def conversion_cache():
+    """The cache configured with --conversion-cache, None if it is disabled."""
+    global _conversion_cache
+    if _conversion_cache is None and args.conversion_cache is not None:
+        _conversion_cache = ConversionCache(args.conversion_cache, DTYPES[args.conversion_cache_dtype])
+    return _conversion_cache
+
+
+def load_torch_file(path, safe_load=False):
+    """comfy.utils.load_torch_file for the model loaders, through the conversion cache if it is enabled."""
+    cache = conversion_cache()
+    if cache is None:
+        return comfy.utils.load_torch_file(path, safe_load=safe_load)
+    return cache.load(path, safe_load=safe_load)
+
+
+def model_files(directory):
+    for root, _, files in os.walk(directory, followlinks=True):
+        for name in sorted(files):
+            if name.lower().endswith(PICKLE_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the pickled model files of the model folders (or of the given directories) ahead of time for --conversion-cache.")
+    parser.add_argument("directories", nargs="*", help="Directories to convert instead of the checkpoints, vae, controlnet and loras folders.")
+    parser.add_argument("--cache", required=True, metavar="PATH", help="The --conversion-cache directory.")
+    parser.add_argument("--dtype", choices=list(DTYPES.keys()), default="keep", help="The --conversion-cache-dtype.")
+    parser.add_argument("--unsafe", action="store_true", help="Unpickle the files of the given directories without weights_only, like checkpoints are loaded.")
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if len(cli_args.directories) > 0:
+        folders = [(directory, not cli_args.unsafe) for directory in cli_args.directories]
+    else:
+        import folder_paths
+        folders = [(directory, safe_load) for name, safe_load in LOADER_FOLDERS.items() for directory in folder_paths.get_folder_paths(name)]
+
+    cache = ConversionCache(cli_args.cache, DTYPES[cli_args.dtype])
+    for directory, safe_load in folders:
+        for path in model_files(directory):
+            try:
+                cache.load(path, safe_load=safe_load)
+            except Exception as e:
+                logging.warning("Could not convert {}: {}".format(path, e))
+
+
+if __name__ == "__main__":
+    main()
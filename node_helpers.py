@@ -1,4 +1,8 @@
+import collections
 import hashlib
+import os
+import sqlite3
+import threading
 
 from comfy.cli_args import args
 
@@ -35,3 +39,103 @@ def hasher():
         "sha512": hashlib.sha512
     }
     return hashfuncs[args.default_hashing_function]
+
+class FileHashCache:
+    """
+    Content hashes of files, only recomputed when the stat fingerprint of the file (size, mtime_ns,
+    inode) changes. With a `db_path` the hashes are also kept in a SQLite database so they survive
+    restarts. At most `max_entries` hashes are kept in memory.
+    """
+    def __init__(self, db_path=None, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS file_hashes (
+                    path TEXT NOT NULL,
+                    algorithm TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    PRIMARY KEY (path, algorithm)
+                )
+            """)
+
+    @staticmethod
+    def fingerprint(stat):
+        return "{}:{}:{}".format(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def _lookup(self, key, fingerprint):
+        entry = self.entries.get(key)
+        if entry is None and self.db is not None:
+            row = self.db.execute("SELECT fingerprint, digest FROM file_hashes WHERE path = ? AND algorithm = ?", key).fetchone()
+            if row is not None:
+                entry = tuple(row)
+        if entry is None or entry[0] != fingerprint:
+            return None
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def _store(self, key, fingerprint, digest):
+        self.entries[key] = (fingerprint, digest)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO file_hashes (path, algorithm, fingerprint, digest) VALUES (?, ?, ?, ?)", key + (fingerprint, digest))
+
+    def remember(self, path, digest, algorithm="sha256"):
+        """Records the hash of a file that was just written, computed while writing it."""
+        path = os.path.abspath(path)
+        fingerprint = self.fingerprint(os.stat(path))
+        with self.lock:
+            self._store((path, algorithm), fingerprint, digest)
+
+    def hash(self, path, algorithm="sha256"):
+        """The hex digest of the content of the file at `path`."""
+        path = os.path.abspath(path)
+        key = (path, algorithm)
+        fingerprint = self.fingerprint(os.stat(path))
+        with self.lock:
+            digest = self._lookup(key, fingerprint)
+        if digest is not None:
+            return digest
+
+        digest = hash_file(path, algorithm)
+        # The file may have been replaced while it was read
+        if self.fingerprint(os.stat(path)) == fingerprint:
+            with self.lock:
+                self._store(key, fingerprint, digest)
+        return digest
+
+def hash_file(file, algorithm="sha256", chunk_size=1024 * 1024):
+    """The hex digest of a file, given by path or as a binary file object (read from its current position)."""
+    m = hashlib.new(algorithm)
+    if isinstance(file, (str, bytes, os.PathLike)):
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                m.update(chunk)
+    else:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            m.update(chunk)
+    return m.hexdigest()
+
+_file_hash_cache = None
+
+def file_hash_cache():
+    global _file_hash_cache
+    if _file_hash_cache is None:
+        _file_hash_cache = FileHashCache(args.file_hash_db)
+    return _file_hash_cache
+
+def file_hash(path, algorithm="sha256"):
+    """Cached content hash of a file, see FileHashCache. Persisted in --file-hash-db if it is set."""
+    return file_hash_cache().hash(path, algorithm)
+
+def remember_file_hash(path, digest, algorithm="sha256"):
+    file_hash_cache().remember(path, digest, algorithm)
@@ -3,7 +3,6 @@ import torch
 import os
 import sys
 import json
-import hashlib
 import traceback
 import math
 import time
@@ -28,6 +27,7 @@ import comfy.controlnet
 import comfy.clip_vision
 
 import comfy.model_management
+import comfy.model_registry
 from comfy.cli_args import args
 
 import importlib
@@ -35,6 +35,8 @@ import importlib
 import folder_paths
 import latent_preview
 import node_helpers
+from comfy_execution import image_writer
+from model_filemanager import conversion_cache
 
 def before_node_execution():
     comfy.model_management.throw_exception_if_processing_interrupted()
@@ -56,6 +58,7 @@ class CLIPTextEncode:
     RETURN_TYPES = ("CONDITIONING",)
     OUTPUT_TOOLTIPS = ("A conditioning containing the embedded text used to guide the diffusion model.",)
     FUNCTION = "encode"
+    BATCHABLE_INPUTS = ("text",)
 
     CATEGORY = "conditioning"
     DESCRIPTION = "Encodes a text prompt using a CLIP model into an embedding that can be used to guide the diffusion model towards generating specific images."
@@ -490,10 +493,7 @@ class LoadLatent:
     @classmethod
     def IS_CHANGED(s, latent):
         image_path = folder_paths.get_annotated_filepath(latent)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return node_helpers.file_hash(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, latent):
@@ -516,7 +516,7 @@ class CheckpointLoader:
     def load_checkpoint(self, config_name, ckpt_name):
         config_path = folder_paths.get_full_path("configs", config_name)
         ckpt_path = folder_paths.get_full_path_or_raise("checkpoints", ckpt_name)
-        return comfy.sd.load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        return comfy.model_registry.load([config_path, ckpt_path], lambda: comfy.sd.load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings")), loader="checkpoint_config")
 
 class CheckpointLoaderSimple:
     @classmethod
@@ -533,12 +533,18 @@ class CheckpointLoaderSimple:
     FUNCTION = "load_checkpoint"
 
     CATEGORY = "loaders"
+    CAN_RUN_CONCURRENTLY = True
     DESCRIPTION = "Loads a diffusion model checkpoint, diffusion models are used to denoise latents."
 
     def load_checkpoint(self, ckpt_name):
         ckpt_path = folder_paths.get_full_path_or_raise("checkpoints", ckpt_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
-        return out[:3]
+        def load():
+            sd = conversion_cache.load_torch_file(ckpt_path)
+            out = comfy.sd.load_state_dict_guess_config(sd, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+            if out is None:
+                raise RuntimeError("ERROR: Could not detect model type of: {}".format(ckpt_path))
+            return out[:3]
+        return comfy.model_registry.load(ckpt_path, load, loader="checkpoint")
 
 class DiffusersLoader:
     @classmethod
@@ -579,7 +585,7 @@ class unCLIPCheckpointLoader:
 
     def load_checkpoint(self, ckpt_name, output_vae=True, output_clip=True):
         ckpt_path = folder_paths.get_full_path_or_raise("checkpoints", ckpt_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        out = comfy.model_registry.load(ckpt_path, lambda: comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=True, embedding_directory=folder_paths.get_folder_paths("embeddings")), loader="checkpoint_clipvision")
         return out
 
 class CLIPSetLastLayer:
@@ -619,6 +625,7 @@ class LoraLoader:
     FUNCTION = "load_lora"
 
     CATEGORY = "loaders"
+    CAN_RUN_CONCURRENTLY = True
     DESCRIPTION = "LoRAs are used to modify diffusion and CLIP models, altering the way in which latents are denoised such as applying styles. Multiple LoRA nodes can be linked together."
 
     def load_lora(self, model, clip, lora_name, strength_model, strength_clip):
@@ -636,7 +643,7 @@ class LoraLoader:
                 del temp
 
         if lora is None:
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+            lora = comfy.model_registry.load(lora_path, lambda: conversion_cache.load_torch_file(lora_path, safe_load=True), loader="lora")
             self.loaded_lora = (lora_path, lora)
 
         model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip)
@@ -697,18 +704,22 @@ class VAELoader:
         return vaes
 
     @staticmethod
-    def load_taesd(name):
-        sd = {}
+    def taesd_paths(name):
         approx_vaes = folder_paths.get_filename_list("vae_approx")
-
         encoder = next(filter(lambda a: a.startswith("{}_encoder.".format(name)), approx_vaes))
         decoder = next(filter(lambda a: a.startswith("{}_decoder.".format(name)), approx_vaes))
+        return folder_paths.get_full_path_or_raise("vae_approx", encoder), folder_paths.get_full_path_or_raise("vae_approx", decoder)
+
+    @staticmethod
+    def load_taesd(name):
+        sd = {}
+        encoder_path, decoder_path = VAELoader.taesd_paths(name)
 
-        enc = comfy.utils.load_torch_file(folder_paths.get_full_path_or_raise("vae_approx", encoder))
+        enc = comfy.utils.load_torch_file(encoder_path)
         for k in enc:
             sd["taesd_encoder.{}".format(k)] = enc[k]
 
-        dec = comfy.utils.load_torch_file(folder_paths.get_full_path_or_raise("vae_approx", decoder))
+        dec = comfy.utils.load_torch_file(decoder_path)
         for k in dec:
             sd["taesd_decoder.{}".format(k)] = dec[k]
 
@@ -733,15 +744,17 @@ class VAELoader:
     FUNCTION = "load_vae"
 
     CATEGORY = "loaders"
+    CAN_RUN_CONCURRENTLY = True
 
     #TODO: scale factor?
     def load_vae(self, vae_name):
         if vae_name in ["taesd", "taesdxl", "taesd3", "taef1"]:
-            sd = self.load_taesd(vae_name)
+            paths = self.taesd_paths(vae_name)
+            load_sd = lambda: self.load_taesd(vae_name)
         else:
-            vae_path = folder_paths.get_full_path_or_raise("vae", vae_name)
-            sd = comfy.utils.load_torch_file(vae_path)
-        vae = comfy.sd.VAE(sd=sd)
+            paths = folder_paths.get_full_path_or_raise("vae", vae_name)
+            load_sd = lambda: conversion_cache.load_torch_file(paths)
+        vae = comfy.model_registry.load(paths, lambda: comfy.sd.VAE(sd=load_sd()), loader="vae", name=vae_name)
         return (vae,)
 
 class ControlNetLoader:
@@ -753,10 +766,11 @@ class ControlNetLoader:
     FUNCTION = "load_controlnet"
 
     CATEGORY = "loaders"
+    CAN_RUN_CONCURRENTLY = True
 
     def load_controlnet(self, control_net_name):
         controlnet_path = folder_paths.get_full_path_or_raise("controlnet", control_net_name)
-        controlnet = comfy.controlnet.load_controlnet(controlnet_path)
+        controlnet = comfy.model_registry.load(controlnet_path, lambda: comfy.controlnet.load_controlnet(controlnet_path, state_dict=conversion_cache.load_torch_file(controlnet_path, safe_load=True)), loader="controlnet")
         return (controlnet,)
 
 class DiffControlNetLoader:
@@ -867,6 +881,7 @@ class UNETLoader:
     FUNCTION = "load_unet"
 
     CATEGORY = "advanced/loaders"
+    CAN_RUN_CONCURRENTLY = True
 
     def load_unet(self, unet_name, weight_dtype):
         model_options = {}
@@ -876,7 +891,7 @@ class UNETLoader:
             model_options["dtype"] = torch.float8_e5m2
 
         unet_path = folder_paths.get_full_path_or_raise("diffusion_models", unet_name)
-        model = comfy.sd.load_diffusion_model(unet_path, model_options=model_options)
+        model = comfy.model_registry.load(unet_path, lambda: comfy.sd.load_diffusion_model(unet_path, model_options=model_options), loader="diffusion_model", weight_dtype=weight_dtype)
         return (model,)
 
 class CLIPLoader:
@@ -889,6 +904,7 @@ class CLIPLoader:
     FUNCTION = "load_clip"
 
     CATEGORY = "advanced/loaders"
+    CAN_RUN_CONCURRENTLY = True
 
     def load_clip(self, clip_name, type="stable_diffusion"):
         if type == "stable_cascade":
@@ -901,7 +917,7 @@ class CLIPLoader:
             clip_type = comfy.sd.CLIPType.STABLE_DIFFUSION
 
         clip_path = folder_paths.get_full_path_or_raise("clip", clip_name)
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type)
+        clip = comfy.model_registry.load(clip_path, lambda: comfy.sd.load_clip(ckpt_paths=[clip_path], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type), loader="clip", clip_type=clip_type)
         return (clip,)
 
 class DualCLIPLoader:
@@ -926,7 +942,7 @@ class DualCLIPLoader:
         elif type == "flux":
             clip_type = comfy.sd.CLIPType.FLUX
 
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type)
+        clip = comfy.model_registry.load([clip_path1, clip_path2], lambda: comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type), loader="clip", clip_type=clip_type)
         return (clip,)
 
 class CLIPVisionLoader:
@@ -941,7 +957,7 @@ class CLIPVisionLoader:
 
     def load_clip(self, clip_name):
         clip_path = folder_paths.get_full_path_or_raise("clip_vision", clip_name)
-        clip_vision = comfy.clip_vision.load(clip_path)
+        clip_vision = comfy.model_registry.load(clip_path, lambda: comfy.clip_vision.load(clip_path), loader="clip_vision")
         return (clip_vision,)
 
 class CLIPVisionEncode:
@@ -971,7 +987,7 @@ class StyleModelLoader:
 
     def load_style_model(self, style_model_name):
         style_model_path = folder_paths.get_full_path_or_raise("style_models", style_model_name)
-        style_model = comfy.sd.load_style_model(style_model_path)
+        style_model = comfy.model_registry.load(style_model_path, lambda: comfy.sd.load_style_model(style_model_path), loader="style_model")
         return (style_model,)
 
 
@@ -1036,7 +1052,7 @@ class GLIGENLoader:
 
     def load_gligen(self, gligen_name):
         gligen_path = folder_paths.get_full_path_or_raise("gligen", gligen_name)
-        gligen = comfy.sd.load_gligen(gligen_path)
+        gligen = comfy.model_registry.load(gligen_path, lambda: comfy.sd.load_gligen(gligen_path), loader="gligen")
         return (gligen,)
 
 class GLIGENTextBoxApply:
@@ -1405,6 +1421,34 @@ def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
     out["samples"] = samples
     return (out, )
 
+def common_ksampler_batch(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=[1.0]):
+    #every argument is the list of per prompt values, see BATCH_FUNCTION in comfy_execution/batching.py
+    try:
+        model, steps, cfg, sampler_name, scheduler, denoise = [comfy.sample.batch_shared(x) for x in (model, steps, cfg, sampler_name, scheduler, denoise)]
+        batch_size = max(len(seed), len(positive), len(negative), len(latent))
+        seed = comfy.sample.batch_expand(seed, batch_size)
+        latent = comfy.sample.batch_expand(latent, batch_size)
+        latent_image, noise_mask = comfy.sample.batch_latents(model, latent)
+        comfy.sample.batch_sampler(sampler_name, noise_mask)
+        memo = {}
+        positive = comfy.sample.batch_conditioning(comfy.sample.batch_expand(positive, batch_size), latent_image.shape, memo)
+        negative = comfy.sample.batch_conditioning(comfy.sample.batch_expand(negative, batch_size), latent_image.shape, memo)
+    except comfy.sample.CannotBatch as e:
+        logging.info("Sampling prompts one at a time: {}".format(e))
+        return None
+
+    noise = comfy.sample.prepare_noise_batch(latent_image, seed)
+    callback = latent_preview.prepare_callback(model, steps)
+    disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
+    samples = comfy.sample.sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative, latent_image,
+                                  denoise=denoise, noise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed[0])
+    out = []
+    for i in range(batch_size):
+        o = latent[i].copy()
+        o["samples"] = samples[i:i + 1]
+        out.append((o, ))
+    return out
+
 class KSampler:
     @classmethod
     def INPUT_TYPES(s):
@@ -1426,6 +1470,8 @@ class KSampler:
     RETURN_TYPES = ("LATENT",)
     OUTPUT_TOOLTIPS = ("The denoised latent.",)
     FUNCTION = "sample"
+    BATCHABLE_INPUTS = ("seed",)
+    BATCH_FUNCTION = "sample_batch"
 
     CATEGORY = "sampling"
     DESCRIPTION = "Uses the provided model, positive and negative conditioning to denoise the latent image."
@@ -1433,6 +1479,9 @@ class KSampler:
     def sample(self, model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0):
         return common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
 
+    def sample_batch(self, model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=[1.0]):
+        return common_ksampler_batch(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
+
 class KSamplerAdvanced:
     @classmethod
     def INPUT_TYPES(s):
@@ -1481,6 +1530,12 @@ class SaveImage:
                 "images": ("IMAGE", {"tooltip": "The images to save."}),
                 "filename_prefix": ("STRING", {"default": "ComfyUI", "tooltip": "The prefix for the file to save. This may include formatting information such as %date:yyyy-MM-dd% or %Empty Latent Image.width% to include values from nodes."})
             },
+            "optional": {
+                "format": (list(image_writer.IMAGE_FORMATS.keys()), {"default": "png", "tooltip": "The file format, PNG is lossless."}),
+                "quality": ("INT", {"default": 90, "min": 1, "max": 100, "tooltip": "The quality of JPEG and WebP images, WebP is lossless at 100."}),
+                "effort": (image_writer.EFFORTS, {"default": "default", "tooltip": "Trades encoding time for file size."}),
+                "metadata": ("BOOLEAN", {"default": True, "tooltip": "Embed the prompt and workflow, as EXIF and XMP for JPEG and WebP."}),
+            },
             "hidden": {
                 "prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"
             },
@@ -1494,25 +1549,22 @@ class SaveImage:
     CATEGORY = "image"
     DESCRIPTION = "Saves the input images to your ComfyUI output directory."
 
-    def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
+    def save_images(self, images, filename_prefix="ComfyUI", format="png", quality=90, effort="default", metadata=True, prompt=None, extra_pnginfo=None):
         filename_prefix += self.prefix_append
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+        extension = image_writer.IMAGE_FORMATS[format][1]
         results = list()
-        for (batch_number, image) in enumerate(images):
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            metadata = None
-            if not args.disable_metadata:
-                metadata = PngInfo()
-                if prompt is not None:
-                    metadata.add_text("prompt", json.dumps(prompt))
-                if extra_pnginfo is not None:
-                    for x in extra_pnginfo:
-                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+        image_metadata = None
+        if metadata and not args.disable_metadata:
+            image_metadata = image_writer.image_metadata(prompt, extra_pnginfo)
 
+        # One conversion and device to host copy for the batch, encoding and writing happen on the
+        # image writer threads (the executor waits for them before the prompt is done)
+        for (batch_number, image) in enumerate(image_writer.images_to_uint8(images)):
             filename_with_batch_num = filename.replace("%batch_num%", str(batch_number))
-            file = f"{filename_with_batch_num}_{counter:05}_.png"
-            img.save(os.path.join(full_output_folder, file), pnginfo=metadata, compress_level=self.compress_level)
+            file = f"{filename_with_batch_num}_{counter:05}_.{extension}"
+            path = os.path.join(full_output_folder, file)
+            image_writer.writer.submit(path, self.write_image, image, path, format, quality, effort, image_metadata)
             results.append({
                 "filename": file,
                 "subfolder": subfolder,
@@ -1522,6 +1574,16 @@ class SaveImage:
 
         return { "ui": { "images": results } }
 
+    def write_image(self, image, path, format, quality, effort, metadata):
+        image_writer.encode_image(image, path, format, quality, effort, metadata, self.compress_level)
+
+    def encode_images(self, images, format="png", quality=90, effort="default", metadata=True, prompt=None, extra_pnginfo=None):
+        """Like save_images, but returns the encoded bytes of every image instead of writing files."""
+        image_metadata = None
+        if metadata and not args.disable_metadata:
+            image_metadata = image_writer.image_metadata(prompt, extra_pnginfo)
+        return image_writer.encode_images(images, format, quality, effort, image_metadata, self.compress_level)
+
 class PreviewImage(SaveImage):
     def __init__(self):
         self.output_dir = folder_paths.get_temp_directory()
@@ -1546,9 +1608,11 @@ class LoadImage:
                 }
 
     CATEGORY = "image"
+    CAN_RUN_CONCURRENTLY = True
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
+    BATCHABLE_INPUTS = ("image",)
     def load_image(self, image):
         image_path = folder_paths.get_annotated_filepath(image)
         
@@ -1596,10 +1660,7 @@ class LoadImage:
     @classmethod
     def IS_CHANGED(s, image):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return node_helpers.file_hash(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1645,10 +1706,7 @@ class LoadImageMask:
     @classmethod
     def IS_CHANGED(s, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return node_helpers.file_hash(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1,6 +1,9 @@
 import os
 import sys
 import asyncio
+import collections
+import shutil
+import tempfile
 import traceback
 
 import nodes
@@ -10,9 +13,11 @@ import uuid
 import urllib
 import json
 import glob
+import hashlib
 import struct
 import ssl
 import socket
+import threading
 import ipaddress
 from PIL import Image, ImageOps
 from PIL.PngImagePlugin import PngInfo
@@ -26,8 +31,15 @@ import mimetypes
 from comfy.cli_args import args
 import comfy.utils
 import comfy.model_management
+import comfy.model_registry
+import comfy.model_patcher
 import node_helpers
+from comfy_execution.scheduling import QueueFull, PRIORITY_WEIGHTS
+from comfy_execution.caching import cache_stats
+from comfy_execution import image_writer
 from app.frontend_management import FrontendManager
+from app.content_store import ContentStore
+from app.view_cache import DerivedImageCache
 from app.user_manager import UserManager
 from model_filemanager import download_model, DownloadModelStatus
 from typing import Optional
@@ -37,12 +49,123 @@ class BinaryEventTypes:
     PREVIEW_IMAGE = 1
     UNENCODED_PREVIEW_IMAGE = 2
 
+# Queue changes are published in one status and queue_delta message at most this often (seconds).
+STATUS_INTERVAL = 0.1
+
+# Messages that can wait for a slow websocket client before it is disconnected.
+SOCKET_QUEUE_SIZE = 256
+
+# Only the most recent queued message of these types is sent to a client that falls behind, in the
+# order it was sent in.
+COLLAPSIBLE_EVENTS = {"status", "progress", BinaryEventTypes.PREVIEW_IMAGE}
+
+# Uploaded files are read from the request and written to disk in chunks of this many bytes.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Disk space and threads for the previews and channel extracts of /view, see DerivedImageCache.
+VIEW_CACHE_SIZE = 1024 * 1024 * 1024
+VIEW_WORKERS = min(4, os.cpu_count() or 1)
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadedFile:
+    """A file field of an upload form, like aiohttp's FileField, spooled to a temporary file."""
+    def __init__(self, filename, file, content_type):
+        self.filename = filename
+        self.file = file
+        self.content_type = content_type
+
+async def read_upload_form(request, max_size):
+    """
+    Reads a multipart form without buffering it: file parts are streamed in chunks to temporary
+    files (written on the default executor), other fields are decoded to strings. Raises
+    UploadTooLarge as soon as more than `max_size` bytes were sent.
+    """
+    if request.content_length is not None and request.content_length > max_size:
+        raise UploadTooLarge()
+    loop = asyncio.get_running_loop()
+    form = {}
+    size = 0
+    reader = await request.multipart()
+    try:
+        async for part in reader:
+            if part.filename is None:
+                value = await part.read(decode=True)
+                size += len(value)
+                if size > max_size:
+                    raise UploadTooLarge()
+                form[part.name] = value.decode(part.get_charset(default="utf-8"))
+                continue
+
+            file = tempfile.TemporaryFile()
+            form[part.name] = UploadedFile(part.filename, file, part.headers.get(aiohttp.hdrs.CONTENT_TYPE))
+            while True:
+                chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge()
+                await loop.run_in_executor(None, file.write, chunk)
+            file.seek(0)
+    except BaseException:
+        close_upload_form(form)
+        raise
+    return form
+
+def close_upload_form(form):
+    for value in form.values():
+        if isinstance(value, UploadedFile):
+            value.file.close()
+
 async def send_socket_catch_exception(function, message):
     try:
         await function(message)
     except (aiohttp.ClientError, aiohttp.ClientPayloadError, ConnectionResetError) as err:
         logging.warning("send error: {}".format(err))
 
+class SocketSender:
+    """
+    Sends the messages of one websocket client from its own queue, so a slow client only delays
+    itself. See COLLAPSIBLE_EVENTS and SOCKET_QUEUE_SIZE.
+    """
+    def __init__(self, ws):
+        self.ws = ws
+        self.messages = collections.deque()
+        self.ready = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, event, message):
+        """Queues a str (JSON) or bytes message, returns False if the client is too far behind."""
+        if event in COLLAPSIBLE_EVENTS:
+            # The older message is dropped and the new one goes to the end, sending it in the place of
+            # the older one would put it before the messages that came in between (the "executing"
+            # of the node a preview belongs to, for example)
+            for i, (queued_event, _) in enumerate(self.messages):
+                if queued_event == event:
+                    del self.messages[i]
+                    break
+        if len(self.messages) >= SOCKET_QUEUE_SIZE:
+            return False
+        self.messages.append((event, message))
+        self.ready.set()
+        return True
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while len(self.messages) > 0:
+                event, message = self.messages.popleft()
+                if isinstance(message, str):
+                    await send_socket_catch_exception(self.ws.send_str, message)
+                else:
+                    await send_socket_catch_exception(self.ws.send_bytes, message)
+
+    def close(self):
+        self.task.cancel()
+
 def get_comfyui_version():
     comfyui_version = "unknown"
     repo_path = os.path.dirname(os.path.realpath(__file__))
@@ -155,10 +278,12 @@ class PromptServer():
         self.internal_routes = InternalRoutes()
         self.supports = ["custom_nodes_from_web"]
         self.prompt_queue = None
+        self.prompt_templates = {}
         self.loop = loop
         self.messages = asyncio.Queue()
         self.client_session:Optional[aiohttp.ClientSession] = None
         self.number = 0
+        self.number_lock = threading.Lock()
 
         middlewares = [cache_control]
         if args.enable_cors_header:
@@ -167,8 +292,11 @@ class PromptServer():
             middlewares.append(create_origin_only_middleware())
 
         max_upload_size = round(args.max_upload_size * 1024 * 1024)
+        self.max_upload_size = max_upload_size
         self.app = web.Application(client_max_size=max_upload_size, middlewares=middlewares)
         self.sockets = dict()
+        self.socket_senders = dict()
+        self.status_handle = None
         self.web_root = (
             FrontendManager.init_frontend(args.front_end_version)
             if args.front_end_root is None
@@ -179,6 +307,11 @@ class PromptServer():
         self.routes = routes
         self.last_node_id = None
         self.client_id = None
+        self.worker_pool = None
+        self.view_cache = None
+        # JSON of the queue items that /queue returned, by prompt_id. Items are not modified once
+        # they are queued, so every one is encoded once.
+        self.queue_item_json = {}
 
         self.on_prompt_handlers = []
 
@@ -189,11 +322,12 @@ class PromptServer():
             sid = request.rel_url.query.get('clientId', '')
             if sid:
                 # Reusing existing session, remove old
-                self.sockets.pop(sid, None)
+                self.remove_socket(sid)
             else:
                 sid = uuid.uuid4().hex
 
             self.sockets[sid] = ws
+            self.socket_senders[sid] = SocketSender(ws)
 
             try:
                 # Send initial state to the new client
@@ -206,7 +340,8 @@ class PromptServer():
                     if msg.type == aiohttp.WSMsgType.ERROR:
                         logging.warning('ws connection closed with exception %s' % ws.exception())
             finally:
-                self.sockets.pop(sid, None)
+                if self.sockets.get(sid) is ws:
+                    self.remove_socket(sid)
             return ws
 
         @routes.get("/")
@@ -264,24 +399,22 @@ class PromptServer():
             return type_dir, dir_type
 
         def compare_image_hash(filepath, image):
-            hasher = node_helpers.hasher()
-            
             # function to compare hashes of two images to see if it already exists, fix to #3465
             if os.path.exists(filepath):
-                a = hasher()
-                b = hasher()
-                with open(filepath, "rb") as f:
-                    a.update(f.read())
-                    b.update(image.file.read())
-                    image.file.seek(0)
-                    f.close()
-                return a.hexdigest() == b.hexdigest()
+                image.file.seek(0, os.SEEK_END)
+                size = image.file.tell()
+                image.file.seek(0)
+                if size != os.path.getsize(filepath):
+                    return False
+                algorithm = args.default_hashing_function
+                upload_hash = node_helpers.hash_file(image.file, algorithm)
+                image.file.seek(0)
+                return node_helpers.file_hash(filepath, algorithm) == upload_hash
             return False
 
         def image_upload(post, image_save_function=None):
             image = post.get("image")
             overwrite = post.get("overwrite")
-            image_is_duplicate = False
 
             image_upload_type = post.get("type")
             upload_dir, image_upload_type = get_dir_by_type(image_upload_type)
@@ -302,40 +435,67 @@ class PromptServer():
                     os.makedirs(full_output_folder)
 
                 split = os.path.splitext(filename)
+                overwrite = overwrite is not None and (overwrite == "true" or overwrite == "1")
 
-                if overwrite is not None and (overwrite == "true" or overwrite == "1"):
-                    pass
-                else:
-                    i = 1
-                    while os.path.exists(filepath):
-                        if compare_image_hash(filepath, image): #compare hash to prevent saving of duplicates with same name, fix for #3465
-                            image_is_duplicate = True
-                            break
-                        filename = f"{split[0]} ({i}){split[1]}"
-                        filepath = os.path.join(full_output_folder, filename)
-                        i += 1
+                if args.content_addressed_uploads and image_save_function is None:
+                    filename = ContentStore(upload_dir).save(image.file, full_output_folder, filename, overwrite=overwrite)
+                    return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
 
-                if not image_is_duplicate:
+                # Uploads run on several threads: the file is written under a temporary name and the
+                # name is reserved with O_EXCL before the file replaces it, so two uploads can't both
+                # pick the same free name. Replacing also leaves other links to an old file untouched.
+                temp_path = os.path.join(full_output_folder, ".upload-{}{}".format(uuid.uuid4().hex, split[1]))
+                try:
                     if image_save_function is not None:
-                        image_save_function(image, post, filepath)
+                        image_save_function(image, post, temp_path)
                     else:
-                        with open(filepath, "wb") as f:
-                            f.write(image.file.read())
+                        with open(temp_path, "wb") as f:
+                            shutil.copyfileobj(image.file, f, UPLOAD_CHUNK_SIZE)
+
+                    if not os.path.exists(temp_path):
+                        pass
+                    elif overwrite:
+                        os.replace(temp_path, filepath)
+                    else:
+                        i = 1
+                        while True:
+                            try:
+                                os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                            except FileExistsError:
+                                if compare_image_hash(filepath, image): #compare hash to prevent saving of duplicates with same name, fix for #3465
+                                    break
+                                filename = f"{split[0]} ({i}){split[1]}"
+                                filepath = os.path.join(full_output_folder, filename)
+                                i += 1
+                                continue
+                            os.replace(temp_path, filepath)
+                            break
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
 
                 return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
             else:
                 return web.Response(status=400)
 
+        async def handle_upload(request, image_save_function=None):
+            # Reading, hashing, PIL work and writing all happen off the event loop
+            try:
+                post = await read_upload_form(request, self.max_upload_size)
+            except UploadTooLarge:
+                return web.Response(status=413)
+            try:
+                return await asyncio.get_running_loop().run_in_executor(None, image_upload, post, image_save_function)
+            finally:
+                close_upload_form(post)
+
         @routes.post("/upload/image")
         async def upload_image(request):
-            post = await request.post()
-            return image_upload(post)
+            return await handle_upload(request)
 
 
         @routes.post("/upload/mask")
         async def upload_mask(request):
-            post = await request.post()
-
             def image_save_function(image, post, filepath):
                 original_ref = json.loads(post.get("original_ref"))
                 filename, output_dir = folder_paths.annotated_filepath(original_ref['filename'])
@@ -373,7 +533,7 @@ class PromptServer():
                         original_pil.putalpha(new_alpha)
                         original_pil.save(filepath, compress_level=4, pnginfo=metadata)
 
-            return image_upload(post, image_save_function)
+            return await handle_upload(request, image_save_function)
 
         @routes.get("/view")
         async def view_image(request):
@@ -401,65 +561,39 @@ class PromptServer():
                 filename = os.path.basename(filename)
                 file = os.path.join(output_dir, filename)
 
+                # Outputs are created empty when they are queued for writing, don't serve them half written
+                pending = image_writer.writer.pending_write(file)
+                if pending is not None:
+                    try:
+                        await asyncio.wrap_future(pending)
+                    except Exception:
+                        pass
+
                 if os.path.isfile(file):
+                    headers = {"Content-Disposition": f"filename=\"{filename}\""}
+                    channel = request.rel_url.query.get('channel', 'rgba')
                     if 'preview' in request.rel_url.query:
-                        with Image.open(file) as img:
-                            preview_info = request.rel_url.query['preview'].split(';')
-                            image_format = preview_info[0]
-                            if image_format not in ['webp', 'jpeg'] or 'a' in request.rel_url.query.get('channel', ''):
-                                image_format = 'webp'
-
-                            quality = 90
-                            if preview_info[-1].isdigit():
-                                quality = int(preview_info[-1])
-
-                            buffer = BytesIO()
-                            if image_format in ['jpeg'] or request.rel_url.query.get('channel', '') == 'rgb':
-                                img = img.convert("RGB")
-                            img.save(buffer, format=image_format, quality=quality)
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type=f'image/{image_format}',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    if 'channel' not in request.rel_url.query:
-                        channel = 'rgba'
-                    else:
-                        channel = request.rel_url.query["channel"]
-
-                    if channel == 'rgb':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                r, g, b, a = img.split()
-                                new_img = Image.merge('RGB', (r, g, b))
-                            else:
-                                new_img = img.convert("RGB")
-
-                            buffer = BytesIO()
-                            new_img.save(buffer, format='PNG')
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    elif channel == 'a':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                _, _, _, a = img.split()
-                            else:
-                                a = Image.new('L', img.size, 255)
-
-                            # alpha img
-                            alpha_img = Image.new('RGBA', img.size)
-                            alpha_img.putalpha(a)
-                            alpha_buffer = BytesIO()
-                            alpha_img.save(alpha_buffer, format='PNG')
-                            alpha_buffer.seek(0)
-
-                            return web.Response(body=alpha_buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
+                        preview_info = request.rel_url.query['preview'].split(';')
+                        image_format = preview_info[0]
+                        if image_format not in ['webp', 'jpeg'] or 'a' in request.rel_url.query.get('channel', ''):
+                            image_format = 'webp'
+
+                        quality = 90
+                        if preview_info[-1].isdigit():
+                            quality = int(preview_info[-1])
+
+                        channel = 'rgb' if image_format == 'jpeg' or channel == 'rgb' else 'rgba'
+                    elif channel in ('rgb', 'a'):
+                        image_format = 'png'
+                        quality = None
                     else:
-                        return web.FileResponse(file, headers={"Content-Disposition": f"filename=\"{filename}\""})
+                        # FileResponse answers If-None-Match with 304 and handles Range requests
+                        return web.FileResponse(file, headers=headers)
+
+                    # Transcoded on the view pool and cached, so repeated views are plain file responses too
+                    path = await self.get_view_cache().get(file, channel, image_format, quality)
+                    headers["Content-Type"] = f"image/{image_format}"
+                    return web.FileResponse(path, headers=headers)
 
             return web.Response(status=404)
 
@@ -495,6 +629,7 @@ class PromptServer():
             ram_free = comfy.model_management.get_free_memory(cpu_device)
             vram_total, torch_vram_total = comfy.model_management.get_total_memory(device, torch_total_too=True)
             vram_free, torch_vram_free = comfy.model_management.get_free_memory(device, torch_free_too=True)
+            patched_weights = comfy.model_patcher.patched_weight_cache()
 
             system_stats = {
                 "system": {
@@ -517,7 +652,13 @@ class PromptServer():
                         "torch_vram_total": torch_vram_total,
                         "torch_vram_free": torch_vram_free,
                     }
-                ]
+                ],
+                # Node output cache of the prompt executor in this process (LRU caching only)
+                "cache": cache_stats(),
+                # Loaded models kept across prompts in this process (--model-cache-ram)
+                "model_cache": comfy.model_registry.stats(),
+                # Patched weights kept for the next load (--patched-weight-cache)
+                "patched_weight_cache": None if patched_weights is None else patched_weights.get_stats(),
             }
             return web.json_response(system_stats)
 
@@ -580,7 +721,11 @@ class PromptServer():
             max_items = request.rel_url.query.get("max_items", None)
             if max_items is not None:
                 max_items = int(max_items)
-            return web.json_response(self.prompt_queue.get_history(max_items=max_items))
+            offset = int(request.rel_url.query.get("offset", -1))
+            since = request.rel_url.query.get("since", None)
+            if since is not None:
+                since = float(since)
+            return web.json_response(self.prompt_queue.get_history(max_items=max_items, offset=offset, since=since))
 
         @routes.get("/history/{prompt_id}")
         async def get_history(request):
@@ -589,11 +734,30 @@ class PromptServer():
 
         @routes.get("/queue")
         async def get_queue(request):
-            queue_info = {}
-            current_queue = self.prompt_queue.get_current_queue()
-            queue_info['queue_running'] = current_queue[0]
-            queue_info['queue_pending'] = current_queue[1]
-            return web.json_response(queue_info)
+            # Read before the queue, a change in between only makes the next poll fetch it again.
+            version = self.prompt_queue.version
+            summary = request.rel_url.query.get("summary", "") in ("1", "true")
+            # The estimates count down while prompts run, in whole seconds they are part of the ETag.
+            estimated_wait = {prompt_id: None if wait is None else round(wait) for prompt_id, wait in self.prompt_queue.get_estimated_waits().items()}
+            estimated_wait_json = json.dumps(estimated_wait)
+            etag = '"{}-{}-{}"'.format(version, "summary" if summary else "full", hashlib.sha1(estimated_wait_json.encode()).hexdigest()[:16])
+            if request.headers.get("If-None-Match") == etag:
+                return web.Response(status=304, headers={"ETag": etag})
+
+            if summary:
+                running, pending = self.prompt_queue.get_queue_summary()
+                queue_info = {
+                    "queue_running": running,
+                    "queue_pending": pending,
+                    "estimated_wait": estimated_wait,
+                    "version": version,
+                }
+                return web.json_response(queue_info, headers={"ETag": etag})
+
+            running, pending = self.queue_items_json(*self.prompt_queue.get_current_queue())
+            body = '{{"queue_running": {}, "queue_pending": {}, "estimated_wait": {}, "version": {}}}'.format(
+                running, pending, estimated_wait_json, version)
+            return web.Response(text=body, content_type="application/json", headers={"ETag": etag})
 
         @routes.post("/prompt")
         async def post_prompt(request):
@@ -603,37 +767,91 @@ class PromptServer():
             json_data =  await request.json()
             json_data = self.trigger_on_prompt(json_data)
 
+            extra_data = {}
+            if "extra_data" in json_data:
+                extra_data = json_data["extra_data"]
+            if not isinstance(extra_data, dict):
+                return web.json_response({"error": "extra_data must be an object", "node_errors": []}, status=400)
+            if "client_id" in json_data:
+                extra_data["client_id"] = json_data["client_id"]
+            if "priority" in json_data:
+                extra_data["priority"] = json_data["priority"]
+            # The tenant is only set by the embedded executor, clients of /prompt are told apart by client_id
+            extra_data.pop("tenant", None)
+            error = self.scheduling_error(extra_data)
+            if error is not None:
+                return web.json_response({"error": error, "node_errors": []}, status=400)
+
             if "number" in json_data:
                 number = float(json_data['number'])
             else:
-                number = self.number
+                number = self.next_prompt_number()
                 if "front" in json_data:
                     if json_data['front']:
                         number = -number
 
-                self.number += 1
-
-            if "prompt" in json_data:
+            if "template_id" in json_data:
+                template = self.prompt_templates.get(json_data["template_id"])
+                if template is None:
+                    error = {
+                        "type": "template_not_found",
+                        "message": "Prompt template not found",
+                        "details": str(json_data["template_id"]),
+                        "extra_info": {}
+                    }
+                    return web.json_response({"error": error, "node_errors": []}, status=400)
+                valid, prompt = template.validate(json_data.get("overrides", {}))
+            elif "prompt" in json_data:
                 prompt = json_data["prompt"]
                 valid = execution.validate_prompt(prompt)
-                extra_data = {}
-                if "extra_data" in json_data:
-                    extra_data = json_data["extra_data"]
-
-                if "client_id" in json_data:
-                    extra_data["client_id"] = json_data["client_id"]
-                if valid[0]:
-                    prompt_id = str(uuid.uuid4())
-                    outputs_to_execute = valid[2]
+            else:
+                return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
+
+            if valid[0]:
+                prompt_id = str(uuid.uuid4())
+                outputs_to_execute = valid[2]
+                try:
                     self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
-                    response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
-                    return web.json_response(response)
-                else:
-                    logging.warning("invalid prompt: {}".format(valid[1]))
-                    return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+                except QueueFull as e:
+                    error = {
+                        "type": "queue_full",
+                        "message": "Too many queued prompts",
+                        "details": str(e),
+                        "extra_info": {}
+                    }
+                    return web.json_response({"error": error, "node_errors": []}, status=429)
+                estimated_wait = self.prompt_queue.get_estimated_waits().get(prompt_id)
+                response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3], "estimated_wait": estimated_wait}
+                return web.json_response(response)
             else:
+                logging.warning("invalid prompt: {}".format(valid[1]))
+                return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+
+        @routes.get("/prompt/templates")
+        async def get_prompt_templates(request):
+            return web.json_response({template_id: {"outputs": template.outputs} for template_id, template in self.prompt_templates.items()})
+
+        @routes.post("/prompt/templates")
+        async def post_prompt_template(request):
+            json_data = await request.json()
+            if "prompt" not in json_data:
                 return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
 
+            template = execution.PromptTemplate(json_data["prompt"])
+            if not template.valid[0]:
+                logging.warning("invalid prompt template: {}".format(template.valid[1]))
+                return web.json_response({"error": template.valid[1], "node_errors": template.valid[3]}, status=400)
+
+            template_id = str(json_data.get("template_id", uuid.uuid4()))
+            self.prompt_templates[template_id] = template
+            return web.json_response({"template_id": template_id, "outputs": template.outputs, "node_errors": template.valid[3]})
+
+        @routes.delete("/prompt/templates/{template_id}")
+        async def delete_prompt_template(request):
+            if self.prompt_templates.pop(request.match_info["template_id"], None) is None:
+                return web.Response(status=404)
+            return web.Response(status=200)
+
         @routes.post("/queue")
         async def post_queue(request):
             json_data =  await request.json()
@@ -651,6 +869,8 @@ class PromptServer():
         @routes.post("/interrupt")
         async def post_interrupt(request):
             nodes.interrupt_processing()
+            if self.worker_pool is not None:
+                self.worker_pool.interrupt()
             return web.Response(status=200)
 
         @routes.post("/free")
@@ -738,6 +958,12 @@ class PromptServer():
             web.static('/', self.web_root),
         ])
 
+    def get_view_cache(self):
+        # Created on first use, the temp directory can be changed after the server is created
+        if self.view_cache is None:
+            self.view_cache = DerivedImageCache(os.path.join(folder_paths.get_temp_directory(), "view_cache"), VIEW_CACHE_SIZE, VIEW_WORKERS)
+        return self.view_cache
+
     def get_queue_info(self):
         prompt_info = {}
         exec_info = {}
@@ -787,31 +1013,85 @@ class PromptServer():
         await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
 
     async def send_bytes(self, event, data, sid=None):
-        message = self.encode_bytes(event, data)
-
-        if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_bytes, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_bytes, message)
+        self.send_to_sockets(event, self.encode_bytes(event, data), sid)
 
     async def send_json(self, event, data, sid=None):
-        message = {"type": event, "data": data}
+        self.send_to_sockets(event, json.dumps({"type": event, "data": data}), sid)
 
+    def send_to_sockets(self, event, message, sid=None):
+        # The message is encoded once and queued for every client, see SocketSender.
         if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_json, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_json, message)
+            sids = list(self.socket_senders)
+        elif sid in self.socket_senders:
+            sids = [sid]
+        else:
+            return
+
+        for sid in sids:
+            if not self.socket_senders[sid].put(event, message):
+                logging.warning("websocket client {} fell too far behind, disconnecting it".format(sid))
+                ws = self.sockets.get(sid)
+                self.remove_socket(sid)
+                if ws is not None:
+                    asyncio.ensure_future(ws.close())
+
+    def remove_socket(self, sid):
+        self.sockets.pop(sid, None)
+        sender = self.socket_senders.pop(sid, None)
+        if sender is not None:
+            sender.close()
 
     def send_sync(self, event, data, sid=None):
         self.loop.call_soon_threadsafe(
             self.messages.put_nowait, (event, data, sid))
 
+    def next_prompt_number(self):
+        """The queue number of the next prompt. Prompts are also queued from other threads, see comfy_execution/embedded.py."""
+        with self.number_lock:
+            number = self.number
+            self.number += 1
+            return number
+
+    def scheduling_error(self, extra_data):
+        """The error of the client_id and priority that a /prompt request asked for, None if they are fine."""
+        for key in ("client_id", "priority"):
+            if key in extra_data and not isinstance(extra_data[key], str):
+                return {"type": "invalid_{}".format(key), "message": "{} must be a string".format(key), "details": "", "extra_info": {}}
+        priority = extra_data.get("priority", "normal")
+        if priority not in PRIORITY_WEIGHTS:
+            return {"type": "invalid_priority", "message": "Unknown priority", "details": priority, "extra_info": {}}
+        if priority != "normal" and not args.allow_prompt_priority:
+            return {"type": "priority_not_allowed", "message": "Only normal priority prompts can be queued, see --allow-prompt-priority", "details": priority, "extra_info": {}}
+        return None
+
+    def queue_items_json(self, *item_lists):
+        encoded = {}
+        out = []
+        for items in item_lists:
+            for item in items:
+                if item[1] not in encoded:
+                    encoded[item[1]] = self.queue_item_json.get(item[1]) or json.dumps(item)
+            out.append("[" + ", ".join(encoded[item[1]] for item in items) + "]")
+        self.queue_item_json = encoded
+        return out
+
     def queue_updated(self):
-        self.send_sync("status", { "status": self.get_queue_info() })
+        # Called by the PromptQueue on every change. The changes are published by publish_status()
+        # at most every STATUS_INTERVAL seconds.
+        self.loop.call_soon_threadsafe(self.schedule_status)
+
+    def schedule_status(self):
+        if self.status_handle is None:
+            self.status_handle = self.loop.call_later(STATUS_INTERVAL, self.publish_status)
+
+    def publish_status(self):
+        self.status_handle = None
+        version, changes = self.prompt_queue.take_changes()
+        if changes is None:
+            self.messages.put_nowait(("queue_delta", {"version": version, "reset": True}, None))
+        elif len(changes) > 0:
+            self.messages.put_nowait(("queue_delta", {"version": version, "changes": changes}, None))
+        self.messages.put_nowait(("status", { "status": self.get_queue_info() }, None))
 
     async def publish_loop(self):
         while True:
@@ -0,0 +1,54 @@
+import io
+import os
+
+import node_helpers
+from app.content_store import ContentStore, BLOB_DIRECTORY
+
+
+def test_same_content_is_stored_once(tmp_path):
+    store = ContentStore(str(tmp_path))
+    assert store.save(io.BytesIO(b"first"), str(tmp_path), "temp.jpg") == "temp.jpg"
+    assert store.save(io.BytesIO(b"first"), str(tmp_path), "temp.jpg") == "temp.jpg"
+    assert store.save(io.BytesIO(b"first"), str(tmp_path), "other.jpg") == "other.jpg"
+
+    blobs = [f for _, _, files in os.walk(tmp_path / BLOB_DIRECTORY) for f in files]
+    assert len(blobs) == 1
+    assert os.path.samefile(tmp_path / "temp.jpg", tmp_path / "other.jpg")
+
+
+def test_taken_names_get_the_digest(tmp_path):
+    store = ContentStore(str(tmp_path))
+    store.save(io.BytesIO(b"first"), str(tmp_path), "temp.jpg")
+    name = store.save(io.BytesIO(b"second"), str(tmp_path), "temp.jpg")
+    assert name.startswith("temp_") and name.endswith(".jpg")
+    assert (tmp_path / name).read_bytes() == b"second"
+    assert (tmp_path / "temp.jpg").read_bytes() == b"first"
+    assert store.save(io.BytesIO(b"second"), str(tmp_path), "temp.jpg") == name
+
+    assert store.save(io.BytesIO(b"third"), str(tmp_path), "temp.jpg", overwrite=True) == "temp.jpg"
+    assert (tmp_path / "temp.jpg").read_bytes() == b"third"
+
+
+def test_existing_files_are_compared_by_hash(tmp_path, monkeypatch):
+    (tmp_path / "image.png").write_bytes(b"pixels")
+    store = ContentStore(str(tmp_path))
+    assert store.save(io.BytesIO(b"pixels"), str(tmp_path), "image.png") == "image.png"
+
+    # The digest computed while writing is reused by IS_CHANGED
+    monkeypatch.setattr(node_helpers, "hash_file", None)
+    name = store.save(io.BytesIO(b"new pixels"), str(tmp_path), "image.png")
+    assert node_helpers.file_hash(str(tmp_path / name)) is not None
+
+
+def test_unlinked_blobs_are_collected(tmp_path):
+    store = ContentStore(str(tmp_path))
+    store.save(io.BytesIO(b"first"), str(tmp_path), "temp.jpg")
+    store.save(io.BytesIO(b"kept"), str(tmp_path), "kept.jpg")
+    store.save(io.BytesIO(b"second"), str(tmp_path), "temp.jpg", overwrite=True)
+
+    assert store.collect_garbage() == 0
+    assert store.collect_garbage(min_age=0) == len(b"first")
+    blobs = [f for _, _, files in os.walk(tmp_path / BLOB_DIRECTORY) for f in files]
+    assert len(blobs) == 2
+    assert (tmp_path / "temp.jpg").read_bytes() == b"second"
+    assert (tmp_path / "kept.jpg").read_bytes() == b"kept"
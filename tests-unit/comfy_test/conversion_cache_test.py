@@ -0,0 +1,90 @@
+import os
+
+import pytest
+import safetensors
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.utils
+from model_filemanager import conversion_cache
+
+
+@pytest.fixture
+def weights():
+    linear = torch.randn(8, 4, dtype=torch.float32)
+    return {
+        "linear.weight": linear,
+        "tied.weight": linear, # Shares its storage, safetensors can't save that as is
+        "transposed": torch.randn(4, 6).t(),
+        "ids": torch.arange(6, dtype=torch.int64),
+    }
+
+
+def converted_files(root):
+    return [os.path.join(d, f) for d, _, files in os.walk(root) for f in files if f.endswith(".safetensors")]
+
+
+def test_pickled_files_are_converted_once(tmp_path, weights, monkeypatch):
+    path = str(tmp_path / "model.ckpt")
+    torch.save({"state_dict": weights}, path)
+    cache = conversion_cache.ConversionCache(str(tmp_path / "cache"))
+
+    sd = cache.load(path)
+    files = converted_files(cache.root)
+    assert len(files) == 1
+    with safetensors.safe_open(files[0], framework="pt") as f:
+        assert f.metadata()["source"] == "model.ckpt"
+    assert comfy.utils.is_mapped(sd["linear.weight"])
+    for k, v in weights.items():
+        assert torch.equal(sd[k], v)
+
+    # Later loads, also by a new cache after a restart, don't unpickle the file
+    def unpickle(*args, **kwargs):
+        raise AssertionError("loaded the pickled file")
+    monkeypatch.setattr(torch, "load", unpickle)
+    sd = conversion_cache.ConversionCache(cache.root).load(path)
+    assert torch.equal(sd["transposed"], weights["transposed"])
+    assert converted_files(cache.root) == files
+
+
+def test_dtype_and_changed_files(tmp_path, weights):
+    path = str(tmp_path / "model.pt")
+    torch.save(weights, path)
+    cache = conversion_cache.ConversionCache(str(tmp_path / "cache"), dtype=torch.float16)
+    sd = cache.load(path, safe_load=True)
+    assert sd["linear.weight"].dtype == torch.float16
+    assert sd["ids"].dtype == torch.int64
+
+    weights["linear.weight"] = torch.zeros(8, 4)
+    torch.save(weights, path)
+    sd = cache.load(path, safe_load=True)
+    assert torch.equal(sd["linear.weight"], torch.zeros(8, 4, dtype=torch.float16))
+    assert len(converted_files(cache.root)) == 2
+
+
+def test_other_files_are_not_converted(tmp_path, weights):
+    cache = conversion_cache.ConversionCache(str(tmp_path / "cache"))
+    path = str(tmp_path / "embedding.pt")
+    torch.save({"string_to_param": {"*": torch.randn(2, 4)}, "name": "embedding"}, path)
+    sd = cache.load(path, safe_load=True)
+    assert sd["name"] == "embedding"
+
+    path = str(tmp_path / "model.safetensors")
+    safetensors.torch.save_file({"ids": weights["ids"]}, path)
+    assert torch.equal(cache.load(path)["ids"], weights["ids"])
+    assert converted_files(cache.root) == []
+
+
+def test_disabled_without_the_argument(tmp_path, weights, monkeypatch):
+    path = str(tmp_path / "model.ckpt")
+    torch.save(weights, path)
+    monkeypatch.setattr(conversion_cache, "_conversion_cache", None)
+    assert conversion_cache.conversion_cache() is None
+    assert torch.equal(conversion_cache.load_torch_file(path)["ids"], weights["ids"])
+
+    monkeypatch.setattr(args, "conversion_cache", str(tmp_path / "cache"))
+    conversion_cache.load_torch_file(path)
+    assert len(converted_files(tmp_path / "cache")) == 1
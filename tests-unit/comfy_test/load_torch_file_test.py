@@ -0,0 +1,78 @@
+import pytest
+import safetensors.torch
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.utils
+
+
+@pytest.fixture
+def weights():
+    return {
+        "linear.weight": torch.randn(8, 4),
+        "linear.bias": torch.randn(8, dtype=torch.bfloat16),
+        "norm.weight": torch.randn(4, dtype=torch.float16),
+        "ids": torch.arange(6, dtype=torch.int8),
+        "empty": torch.zeros(0, 3),
+    }
+
+
+def test_safetensors_are_memory_mapped(tmp_path, weights):
+    path = str(tmp_path / "model.safetensors")
+    safetensors.torch.save_file(weights, path)
+
+    sd = comfy.utils.load_torch_file(path)
+    assert sd.keys() == weights.keys()
+    for k, v in weights.items():
+        assert sd[k].dtype == v.dtype
+        assert torch.equal(sd[k], v)
+    assert comfy.utils.is_mapped(sd["linear.weight"])
+
+    # Private mapping: changes don't reach the file and are kept when the pages are released
+    sd["linear.weight"].mul_(2)
+    comfy.utils.release_pages(sd.values())
+    assert torch.equal(sd["linear.weight"], weights["linear.weight"] * 2)
+    assert torch.equal(safetensors.torch.load_file(path)["linear.weight"], weights["linear.weight"])
+
+
+def test_disable_mmap_reads_the_file(tmp_path, weights, monkeypatch):
+    path = str(tmp_path / "model.safetensors")
+    safetensors.torch.save_file(weights, path)
+    monkeypatch.setattr(args, "disable_mmap", True)
+    sd = comfy.utils.load_torch_file(path)
+    assert not comfy.utils.is_mapped(sd["linear.weight"])
+    assert torch.equal(sd["ids"], weights["ids"])
+
+
+def test_load_state_dict_in_chunks(tmp_path, monkeypatch):
+    model = torch.nn.Sequential(*[torch.nn.Linear(16, 16) for _ in range(6)])
+    path = str(tmp_path / "model.safetensors")
+    safetensors.torch.save_file({"model.{}".format(k): v for k, v in model.state_dict().items()}, path)
+    sd = comfy.utils.state_dict_prefix_replace(comfy.utils.load_torch_file(path), {"model.": ""}, filter_keys=True)
+    del sd["5.bias"]
+    sd["extra"] = torch.zeros(1)
+
+    # A few modules per chunk
+    monkeypatch.setattr(comfy.utils, "LOAD_CHUNK_BYTES", 2000)
+    loaded = torch.nn.Sequential(*[torch.nn.Linear(16, 16) for _ in range(6)])
+    missing, unexpected = comfy.utils.load_state_dict(loaded, sd, strict=False)
+    assert missing == ["5.bias"]
+    assert unexpected == ["extra"]
+    for k, v in model.state_dict().items():
+        if k != "5.bias":
+            assert torch.equal(loaded.state_dict()[k], v)
+    # The module has its own copy of the weights
+    assert not comfy.utils.is_mapped(loaded[0].weight)
+
+    with pytest.raises(RuntimeError):
+        comfy.utils.load_state_dict(loaded, sd, strict=True)
+
+
+def test_ckpt_files_load_with_and_without_zip_format(tmp_path, weights):
+    for legacy in (False, True):
+        path = str(tmp_path / "model_{}.ckpt".format(legacy))
+        torch.save({"state_dict": weights}, path, _use_new_zipfile_serialization=not legacy)
+        sd = comfy.utils.load_torch_file(path, safe_load=True)
+        assert torch.equal(sd["linear.weight"], weights["linear.weight"])
@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_detection
+
+
+def flux_state_dict(depth=2, single_blocks=3, guidance=True, prefix=""):
+    sd = {}
+    for i in range(depth):
+        sd["{}double_blocks.{}.img_attn.norm.key_norm.scale".format(prefix, i)] = torch.empty(128, device="meta")
+    for i in range(single_blocks):
+        sd["{}single_blocks.{}.linear1.weight".format(prefix, i)] = torch.empty(8, 4, device="meta")
+    if guidance:
+        sd["{}guidance_in.in_layer.weight".format(prefix)] = torch.empty(3072, 256, device="meta")
+    return sd
+
+
+@pytest.fixture
+def detection_cache(monkeypatch):
+    cache = comfy.model_detection.DetectionCache()
+    monkeypatch.setattr(comfy.model_detection, "_detection_cache", cache)
+    return cache
+
+
+def test_detection_runs_once_per_layout(detection_cache, monkeypatch):
+    sd = flux_state_dict()
+    model_config = comfy.model_detection.model_config_from_unet(sd, "")
+    assert type(model_config).__name__ == "Flux"
+    assert model_config.unet_config["depth"] == 2
+
+    def detect(*args):
+        raise AssertionError("detected again")
+    monkeypatch.setattr(comfy.model_detection, "detect_unet_config", detect)
+    cached = comfy.model_detection.model_config_from_unet(flux_state_dict(), "")
+    assert type(cached) is type(model_config)
+    assert cached.unet_config == model_config.unet_config
+    # Changing the config of one doesn't change the cached one
+    cached.unet_config["axes_dim"].append(0)
+    assert comfy.model_detection.model_config_from_unet(sd, "").unet_config["axes_dim"] == [16, 56, 56]
+
+    with pytest.raises(AssertionError):
+        comfy.model_detection.model_config_from_unet(flux_state_dict(depth=3), "")
+    with pytest.raises(AssertionError):
+        comfy.model_detection.model_config_from_unet(sd, "model.")
+
+
+def test_shapes_and_keys_are_part_of_the_key():
+    sd = flux_state_dict()
+    key = comfy.model_detection.state_dict_layout_hash(sd)
+    assert comfy.model_detection.state_dict_layout_hash(dict(reversed(list(sd.items())))) == key
+    assert comfy.model_detection.state_dict_layout_hash(flux_state_dict(guidance=False)) != key
+    sd["guidance_in.in_layer.weight"] = torch.empty(3072, 128, device="meta")
+    assert comfy.model_detection.state_dict_layout_hash(sd) != key
+
+
+def test_detection_code_is_part_of_the_key(monkeypatch):
+    sd = flux_state_dict()
+    key = comfy.model_detection.state_dict_layout_hash(sd)
+    # An update of the detection code
+    monkeypatch.setattr(comfy.model_detection, "_detection_code_hash", "0" * 64)
+    assert comfy.model_detection.state_dict_layout_hash(sd) != key
+
+
+def test_persisted_detection(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "detection.sqlite")
+    monkeypatch.setattr(comfy.model_detection, "_detection_cache", comfy.model_detection.DetectionCache(db_path))
+    assert type(comfy.model_detection.model_config_from_unet(flux_state_dict(guidance=False), "")).__name__ == "FluxSchnell"
+    # Failed detections are kept too
+    unknown = {"encoder.conv_in.weight": torch.empty(128, 3, 3, 3, device="meta")}
+    assert comfy.model_detection.model_config_from_unet(unknown, "") is None
+
+    # Another process
+    monkeypatch.setattr(comfy.model_detection, "_detection_cache", comfy.model_detection.DetectionCache(db_path))
+    monkeypatch.setattr(comfy.model_detection, "detect_unet_config", None)
+    assert type(comfy.model_detection.model_config_from_unet(flux_state_dict(guidance=False), "")).__name__ == "FluxSchnell"
+    assert comfy.model_detection.model_config_from_unet(unknown, "") is None
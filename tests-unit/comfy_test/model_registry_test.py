@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.model_patcher
+import comfy.model_registry
+
+
+class Loader:
+    """Loads a float32 tensor of `elements` elements, counting the loads."""
+    def __init__(self, elements=256, delay=0.0):
+        self.elements = elements
+        self.delay = delay
+        self.loads = 0
+
+    def __call__(self):
+        self.loads += 1
+        time.sleep(self.delay)
+        return {"weight": torch.zeros(self.elements)}
+
+
+@pytest.fixture
+def model_files(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / "model_{}.safetensors".format(i)
+        path.write_bytes(b"weights")
+        paths.append(str(path))
+    return paths
+
+
+def test_least_recently_used_over_budget_are_dropped(model_files):
+    # Two 1 KiB models fit
+    registry = comfy.model_registry.ModelRegistry(max_bytes=2048)
+    loaders = [Loader() for _ in model_files]
+    first = registry.load(model_files[0], loaders[0])
+    assert registry.load(model_files[0], loaders[0]) is first
+    registry.load(model_files[1], loaders[1])
+    registry.load(model_files[0], loaders[0])
+    registry.load(model_files[2], loaders[2])
+    assert registry.get_stats() == {"hits": 2, "misses": 3, "evictions": 1, "evicted_bytes": 1024, "entries": 2, "ram_bytes": 2048, "max_ram": 2048}
+
+    registry.load(model_files[0], loaders[0])
+    registry.load(model_files[1], loaders[1])
+    assert [loader.loads for loader in loaders] == [1, 2, 1]
+
+    # Options are part of the key, a model larger than the budget is not kept
+    big = Loader(elements=1024)
+    registry.load(model_files[0], big, dtype="fp8")
+    registry.load(model_files[0], big, dtype="fp8")
+    assert big.loads == 2
+    stats = registry.get_stats()
+    assert (stats["entries"], stats["ram_bytes"]) == (2, 2048)
+    registry.load(model_files[0], loaders[0])
+    registry.load(model_files[1], loaders[1])
+    assert [loader.loads for loader in loaders] == [1, 2, 1]
+
+
+def test_changed_files_are_loaded_again(model_files):
+    registry = comfy.model_registry.ModelRegistry()
+    loader = Loader()
+    registry.load(model_files, loader)
+    with open(model_files[1], "ab") as f:
+        f.write(b" v2")
+    registry.load(model_files, loader)
+    assert loader.loads == 2
+    # The old version is dropped
+    assert registry.get_stats()["entries"] == 1
+
+
+def test_concurrent_loads_of_a_model_load_it_once(model_files):
+    registry = comfy.model_registry.ModelRegistry()
+    loader = Loader(delay=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.load(model_files[0], loader))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loader.loads == 1
+    assert all(result is results[0] for result in results)
+    assert registry.get_stats()["hits"] == 3
+
+
+def test_failed_loads_are_not_kept(model_files):
+    registry = comfy.model_registry.ModelRegistry()
+    def fail():
+        raise RuntimeError("bad file")
+    with pytest.raises(RuntimeError):
+        registry.load(model_files[0], fail)
+    assert registry.get_stats()["entries"] == 0
+    assert registry.load(model_files[0], Loader())["weight"].shape == (256,)
+
+
+def test_disabled_by_default(model_files, monkeypatch):
+    monkeypatch.setattr(comfy.model_registry, "_registry", None)
+    loader = Loader()
+    comfy.model_registry.load(model_files[0], loader)
+    comfy.model_registry.load(model_files[0], loader)
+    assert loader.loads == 2
+    assert comfy.model_registry.stats()["misses"] == 2
+
+    monkeypatch.setattr(comfy.model_registry, "_registry", None)
+    monkeypatch.setattr(args, "model_cache_ram", 1.0)
+    comfy.model_registry.load(model_files[0], loader)
+    comfy.model_registry.load(model_files[0], loader)
+    assert loader.loads == 3
+    assert comfy.model_registry.stats()["max_ram"] == 1024 ** 3
+
+
+def test_value_size_of_models():
+    linear = torch.nn.Linear(16, 16)
+    patcher = comfy.model_patcher.ModelPatcher(linear, load_device=torch.device("cpu"), offload_device=torch.device("cpu"))
+    linear_bytes = (16 * 16 + 16) * 4
+
+    class Holder:
+        def __init__(self):
+            self.control_model_wrapped = patcher
+            self.extra = torch.nn.Sequential(torch.nn.Linear(4, 4, bias=False))
+
+    # Models and tensors appearing several times are counted once
+    assert comfy.model_registry.value_size((patcher, Holder(), {"w": linear.weight})) == linear_bytes + 4 * 4 * 4
+    assert comfy.model_registry.value_size({"a": torch.zeros(8), "b": torch.zeros(8, device="meta")}) == 32
@@ -0,0 +1,109 @@
+import gc
+
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.lora
+import comfy.model_patcher
+
+CPU = torch.device("cpu")
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = comfy.model_patcher.PatchedWeightCache(max_bytes=1024 ** 2)
+    monkeypatch.setattr(comfy.model_patcher, "_patched_weight_cache", cache)
+    return cache
+
+
+def make_lora(model, rank=2):
+    return {k: ("lora", (torch.randn(w.shape[0], rank), torch.randn(rank, w.shape[1]), None, None, None, None))
+            for k, w in model.state_dict().items() if w.ndim == 2}
+
+
+def load_patched(patcher, lora, strength=1.0):
+    model = patcher.clone()
+    model.add_patches(lora, strength)
+    model.patch_model(device_to=CPU)
+    weights = {k: v.clone() for k, v in model.model.state_dict().items()}
+    model.unpatch_model(device_to=CPU)
+    return weights
+
+
+def test_same_patches_are_copied_from_the_cache(cache, monkeypatch):
+    model = torch.nn.Sequential(torch.nn.Linear(8, 8), torch.nn.Linear(8, 4))
+    original = {k: v.clone() for k, v in model.state_dict().items()}
+    patcher = comfy.model_patcher.ModelPatcher(model, load_device=CPU, offload_device=CPU)
+    lora = make_lora(model)
+
+    patched = load_patched(patcher, lora)
+    assert not torch.equal(patched["0.weight"], original["0.weight"])
+    assert cache.get_stats()["entries"] == 2
+
+    def calculate_weight(*args, **kwargs):
+        raise AssertionError("calculated again")
+    with monkeypatch.context() as m:
+        m.setattr(comfy.lora, "calculate_weight", calculate_weight)
+        again = load_patched(patcher, lora)
+    for k in patched:
+        assert torch.equal(again[k], patched[k])
+    # Unpatching still gives the original weights back
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, original[k])
+
+    # Other strengths are other patches
+    other = load_patched(patcher, lora, strength=0.5)
+    assert not torch.equal(other["0.weight"], patched["0.weight"])
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 4, 4)
+
+
+def test_budget_and_freed_models(cache):
+    model = torch.nn.Sequential(torch.nn.Linear(16, 16), torch.nn.Linear(16, 16))
+    patcher = comfy.model_patcher.ModelPatcher(model, load_device=CPU, offload_device=CPU)
+    lora = make_lora(model)
+
+    # Room for one patched weight and the LoRA tensors it keeps alive
+    lora_bytes = 2 * 16 * 2 * 4
+    cache.max_bytes = 16 * 16 * 4 + lora_bytes
+    load_patched(patcher, lora)
+    assert cache.get_stats()["entries"] == 1
+    assert cache.get_stats()["evictions"] == 1
+    assert cache.get_stats()["ram_bytes"] == 16 * 16 * 4 + lora_bytes
+    assert cache.get_stats()["patch_bytes"] == lora_bytes
+
+    # An entry of a model that was freed is not used for another model with the same id
+    cache_key = next(iter(cache.entries))
+    del patcher, model
+    gc.collect()
+    assert cache.get(cache_key, torch.nn.Linear(1, 1)) is None
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_patch_tensors_are_counted_once(cache):
+    model = torch.nn.Sequential(torch.nn.Linear(16, 16))
+    patcher = comfy.model_patcher.ModelPatcher(model, load_device=CPU, offload_device=CPU)
+    lora = make_lora(model)
+    load_patched(patcher, lora)
+    # Another strength is another entry that keeps the same LoRA tensors alive
+    load_patched(patcher, lora, strength=0.5)
+    stats = cache.get_stats()
+    assert stats["entries"] == 2
+    assert stats["patch_bytes"] == 2 * 16 * 2 * 4
+    assert stats["ram_bytes"] == 2 * 16 * 16 * 4 + stats["patch_bytes"]
+
+    cache._remove(next(iter(cache.entries)))
+    assert cache.get_stats()["patch_bytes"] == 2 * 16 * 2 * 4
+    cache._remove(next(iter(cache.entries)))
+    assert (cache.ram_bytes, cache.patch_bytes, cache.patch_refs) == (0, 0, {})
+
+
+def test_disabled_by_default(monkeypatch):
+    monkeypatch.setattr(comfy.model_patcher, "_patched_weight_cache", None)
+    assert comfy.model_patcher.patched_weight_cache() is None
+    model = torch.nn.Linear(4, 4)
+    patcher = comfy.model_patcher.ModelPatcher(model, load_device=CPU, offload_device=CPU)
+    load_patched(patcher, make_lora(model))
@@ -0,0 +1,120 @@
+import pytest
+import torch
+
+from comfy.cli_args import args
+args.cpu = True
+
+import comfy.controlnet
+import comfy.sample
+
+
+class FakeModel:
+    def get_model_object(self, name):
+        class LatentFormat:
+            latent_channels = 4
+        return LatentFormat()
+
+
+def conditioning(tokens, value, **options):
+    return [[torch.full((1, tokens, 8), value), {"pooled_output": torch.full((1, 8), value), **options}]]
+
+
+def test_batch_conditioning_pads_tokens_and_concatenates():
+    a = conditioning(77, 1.0)
+    b = conditioning(154, 2.0)
+    merged = comfy.sample.batch_conditioning([a, b], (2, 4, 8, 8), {})
+    assert merged[0][0].shape == (2, 154, 8)
+    assert torch.all(merged[0][0][0] == 1.0)
+    assert torch.all(merged[0][0][1] == 2.0)
+    assert merged[0][1]["pooled_output"].shape == (2, 8)
+
+
+def test_batch_conditioning_keeps_shared_values():
+    a = conditioning(77, 1.0)
+    assert comfy.sample.batch_conditioning([a, a, a], (3, 4, 8, 8), {}) is a
+
+    with pytest.raises(comfy.sample.CannotBatch):
+        comfy.sample.batch_conditioning([conditioning(77, 1.0, strength=1.0), conditioning(77, 1.0, strength=0.5)], (2, 4, 8, 8), {})
+
+
+def test_batch_controls_share_one_merged_control():
+    base = comfy.controlnet.ControlNet(torch.nn.Linear(1, 1), device="cpu", load_device=torch.device("cpu"))
+    controls = [base.copy().set_cond_hint(torch.full((1, 3, 64, 64), float(i)), strength=0.7) for i in range(3)]
+    memo = {}
+    positive = comfy.sample.batch_conditioning([conditioning(77, i, control=c) for i, c in enumerate(controls)], (3, 4, 8, 8), memo)
+    negative = comfy.sample.batch_conditioning([conditioning(77, 0, control=c) for c in controls], (3, 4, 8, 8), memo)
+    control = positive[0][1]["control"]
+    assert control is negative[0][1]["control"]
+    assert control.cond_hint_original.shape == (3, 3, 64, 64)
+    assert [float(h[0, 0, 0]) for h in control.cond_hint_original] == [0.0, 1.0, 2.0]
+    assert control.strength == 0.7
+
+    other_strength = base.copy().set_cond_hint(torch.zeros((1, 3, 64, 64)), strength=0.5)
+    assert comfy.controlnet.batch_controls([controls[0], other_strength], (2, 4, 8, 8), {}) is None
+
+
+def test_batch_latents_and_noise_match_single_prompts():
+    latents = [{"samples": torch.zeros((1, 4, 8, 8))} for _ in range(3)]
+    samples, noise_mask = comfy.sample.batch_latents(FakeModel(), latents)
+    assert samples.shape == (3, 4, 8, 8)
+    assert noise_mask is None
+
+    seeds = [1, 2, 3]
+    noise = comfy.sample.prepare_noise_batch(samples, seeds)
+    for i, seed in enumerate(seeds):
+        assert torch.equal(noise[i:i + 1], comfy.sample.prepare_noise(latents[i]["samples"], seed))
+
+    with pytest.raises(comfy.sample.CannotBatch):
+        comfy.sample.batch_latents(FakeModel(), [{"samples": torch.zeros((2, 4, 8, 8))}])
+    with pytest.raises(comfy.sample.CannotBatch):
+        comfy.sample.batch_latents(FakeModel(), [{"samples": torch.zeros((1, 4, 8, 8))}, {"samples": torch.zeros((1, 4, 16, 8))}])
+
+
+def test_batch_expand_and_shared():
+    assert comfy.sample.batch_expand([1], 3) == [1, 1, 1]
+    assert comfy.sample.batch_shared([7, 7]) == 7
+    with pytest.raises(comfy.sample.CannotBatch):
+        comfy.sample.batch_expand([1, 2], 3)
+    with pytest.raises(comfy.sample.CannotBatch):
+        comfy.sample.batch_shared([7, 8])
+
+
+def toy_denoiser(x, sigma, **kwargs):
+    return x * 0.5
+
+
+def run_sampler(name, noise, seed):
+    import comfy.k_diffusion.sampling
+    torch.manual_seed(seed)
+    sigmas = torch.linspace(1.0, 0.0, 5)
+    return getattr(comfy.k_diffusion.sampling, "sample_{}".format(name))(toy_denoiser, noise, sigmas, extra_args={"seed": seed}, disable=True)
+
+
+@pytest.mark.parametrize("name", ["euler", "euler_ancestral"])
+def test_batched_samplers_match_solo_runs(name):
+    seeds = [1, 2]
+    noise = comfy.sample.prepare_noise_batch(torch.zeros((2, 4, 8, 8)), seeds)
+    solo = [run_sampler(name, noise[i:i + 1], seed) for i, seed in enumerate(seeds)]
+    batched = run_sampler(name, noise, seeds[0])
+
+    if name == "euler":
+        comfy.sample.batch_sampler(name)
+        assert torch.allclose(batched[1:], solo[1])
+    else:
+        # The later prompts of the batch would get the noise of the first prompt's seed
+        assert not torch.allclose(batched[1:], solo[1])
+        with pytest.raises(comfy.sample.CannotBatch):
+            comfy.sample.batch_sampler(name)
+
+
+def test_batch_sampler_rejects_noisy_samplers():
+    import comfy.samplers
+    for name in ("dpmpp_2m_sde", "dpmpp_sde", "ddpm", "lcm", "dpm_2_ancestral"):
+        with pytest.raises(comfy.sample.CannotBatch):
+            comfy.sample.batch_sampler(name)
+    for name in ("dpmpp_2m", "dpm_fast", "uni_pc", "ddim"):
+        comfy.sample.batch_sampler(name)
+    with pytest.raises(comfy.sample.CannotBatch):
+        comfy.sample.batch_sampler("ddim", noise_mask=torch.ones((1, 1, 8, 8)))
+    with pytest.raises(comfy.sample.CannotBatch):
+        comfy.sample.batch_sampler(comfy.samplers.ksampler("euler", {"s_churn": 1.0}))
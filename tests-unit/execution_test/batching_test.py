@@ -0,0 +1,141 @@
+import threading
+
+import pytest
+import torch
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # See embedded_test.py: importing execution puts comfy/ on sys.path, so import at run time.
+    global execution, nodes, batching
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    import nodes
+    from comfy_execution import batching
+
+
+class FakeServer:
+    def __init__(self):
+        self.number = 0
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+
+class BatchedScale:
+    calls = []
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"image": ("IMAGE",), "factor": ("FLOAT", {"default": 1.0})}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "scale"
+    BATCHABLE_INPUTS = ("factor",)
+    BATCH_FUNCTION = "scale_batch"
+
+    def scale(self, image, factor):
+        BatchedScale.calls.append(("single", factor))
+        return (image * factor,)
+
+    def scale_batch(self, image, factor):
+        BatchedScale.calls.append(("batch", tuple(factor)))
+        images = torch.cat(image * len(factor) if len(image) == 1 else image)
+        factors = torch.tensor(factor).reshape(-1, 1, 1, 1)
+        return [(x.unsqueeze(0),) for x in images * factors]
+
+
+def prompt(factor, color=0xFFFFFF):
+    return {
+        "1": {"class_type": "EmptyImage", "inputs": {"width": 4, "height": 4, "batch_size": 1, "color": color}},
+        "2": {"class_type": "BatchedScale", "inputs": {"image": ["1", 0], "factor": factor}},
+        "3": {"class_type": "PreviewImage", "inputs": {"images": ["2", 0]}},
+    }
+
+
+@pytest.fixture
+def batched_scale(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "BatchedScale", BatchedScale)
+    BatchedScale.calls = []
+    return BatchedScale
+
+
+def test_batch_key_ignores_batchable_inputs(batched_scale):
+    assert batching.batch_key(prompt(0.5), ["3"]) == batching.batch_key(prompt(0.25), ["3"])
+    assert batching.batch_key(prompt(0.5), ["3"]) != batching.batch_key(prompt(0.5, color=0), ["3"])
+    assert batching.batch_key(prompt(0.5), ["3"]) != batching.batch_key(prompt(0.5), ["2"])
+
+
+def test_merge_prompts_only_batches_differing_inputs(batched_scale):
+    merged = batching.merge_prompts([prompt(0.5), prompt(0.25), prompt(0.5)])
+    assert merged["1"] == prompt(0.5)["1"]
+    assert isinstance(merged["2"]["inputs"]["factor"], batching.BatchedInput)
+    assert list(merged["2"]["inputs"]["factor"]) == [0.5, 0.25, 0.5]
+    assert batching.per_prompt_nodes(merged) == {"2", "3"}
+
+
+def test_get_batch_takes_compatible_prompts_in_order(batched_scale):
+    q = execution.PromptQueue(FakeServer())
+    q.put((0, "a", prompt(0.5), {}, ["3"]))
+    q.put((1, "b", prompt(0.5, color=0), {}, ["3"]))
+    q.put((2, "c", prompt(0.25), {}, ["3"]))
+    q.put((3, "d", prompt(0.75), {}, ["3"]))
+
+    items = q.get_batch(2)
+    assert [item[1] for item, _ in items] == ["a", "c"]
+    assert len(q.currently_running) == 2
+    assert sorted(item[1] for item in q.queue) == ["b", "d"]
+
+    items = q.get_batch(4)
+    assert [item[1] for item, _ in items] == ["b"]
+
+
+def test_merged_prompt_runs_batch_function_and_splits_results(batched_scale):
+    server = FakeServer()
+    q = execution.PromptQueue(server)
+    e = execution.PromptExecutor(server)
+    prompts = [prompt(0.5), prompt(0.25), prompt(1.0)]
+    for i, p in enumerate(prompts):
+        q.put((i, "prompt-{}".format(i), p, {}, ["2"]))
+
+    queue_items = q.get_batch(4)
+    merged = batching.merge_prompts([item[2] for item, _ in queue_items])
+    extra_data = batching.merge_extra_data([item[3] for item, _ in queue_items], [item[2] for item, _ in queue_items])
+    e.execute(merged, "prompt-0", extra_data, ["2"])
+    assert e.success
+    assert batched_scale.calls == [("batch", (0.5, 0.25, 1.0))]
+
+    results = batching.split_results(merged, 3, e.history_result, e.output_data)
+    for (history_result, output_data), factor in zip(results, [0.5, 0.25, 1.0]):
+        images = output_data["2"][0]
+        assert len(images) == 1
+        assert torch.all(images[0] == factor)
+        assert images[0].shape == (1, 4, 4, 3)
+
+
+def test_batch_function_is_not_used_for_regular_prompts(batched_scale):
+    e = execution.PromptExecutor(FakeServer())
+    e.execute(prompt(0.5), "single", {}, ["2"])
+    assert e.success
+    assert batched_scale.calls == [("single", 0.5)]
+
+
+def test_split_results_divides_per_prompt_ui(batched_scale):
+    merged = batching.merge_prompts([prompt(0.5), prompt(0.25)])
+    history_result = {
+        "outputs": {"3": {"images": [{"filename": "a"}, {"filename": "b"}]}},
+        "meta": {"3": {"node_id": "3"}},
+    }
+    results = batching.split_results(merged, 2, history_result, {"1": [["shared"]], "2": [["x", "y"]]})
+    assert results[0][0]["outputs"]["3"]["images"] == [{"filename": "a"}]
+    assert results[1][0]["outputs"]["3"]["images"] == [{"filename": "b"}]
+    assert results[1][0]["meta"]["3"] == {"node_id": "3"}
+    assert results[1][1] == {"1": [["shared"]], "2": [["y"]]}
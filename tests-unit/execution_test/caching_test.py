@@ -0,0 +1,277 @@
+import pytest
+import torch
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # See embedded_test.py: importing execution puts comfy/ on sys.path, so import at run time.
+    global execution, caching, graph
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    from comfy_execution import caching, graph
+
+
+class FakeServer:
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+
+class NotChanged:
+    def get(self, node_id):
+        return False
+
+
+def image_prompt(color, size=8):
+    return {"1": {"class_type": "EmptyImage", "inputs": {"width": size, "height": size, "batch_size": 1, "color": color}}}
+
+
+def run_prompt(cache, prompt, value, execution_time):
+    cache.set_prompt(graph.DynamicPrompt(prompt), prompt.keys(), NotChanged())
+    cache.clean_unused()
+    if cache.get("1") is None:
+        cache.set("1", value, execution_time=execution_time)
+
+
+def chain_prompt(length, offset=0, seed=0):
+    prompt = {}
+    for i in range(length):
+        inputs = {"width": 8, "height": 8, "batch_size": 1, "color": seed} if i == 0 else {"image": [str(offset + i - 1), 0], "amount": 1}
+        prompt[str(offset + i)] = {"class_type": "EmptyImage" if i == 0 else "ImageInvert", "inputs": inputs}
+    return prompt
+
+
+def key_set(prompt):
+    return caching.CacheKeySetInputSignature(graph.DynamicPrompt(prompt), prompt.keys(), NotChanged())
+
+
+def test_keys_only_depend_on_the_upstream_graph():
+    keys = key_set(chain_prompt(4))
+    assert len(set(keys.get_used_keys())) == 4
+    # Same workflow with other node ids
+    assert key_set(chain_prompt(4, offset=10)).get_data_key("13") == keys.get_data_key("3")
+
+    changed = key_set({**chain_prompt(4, seed=1), "9": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 1, "color": 0}}})
+    assert changed.get_data_key("3") != keys.get_data_key("3")
+    assert changed.get_data_key("9") == keys.get_data_key("0")
+
+
+def test_uncacheable_nodes_taint_their_descendants():
+    class AlwaysChanged:
+        def get(self, node_id):
+            return float("NaN") if node_id == "1" else False
+
+    prompt = chain_prompt(3)
+    keys = caching.CacheKeySetInputSignature(graph.DynamicPrompt(prompt), prompt.keys(), AlwaysChanged())
+    again = caching.CacheKeySetInputSignature(graph.DynamicPrompt(prompt), prompt.keys(), AlwaysChanged())
+    assert keys.get_data_key("0") == again.get_data_key("0")
+    assert keys.get_data_key("1") != again.get_data_key("1")
+    assert keys.get_data_key("2") != again.get_data_key("2")
+    assert keys.get_digest("2") is None
+
+
+def test_deep_graphs_and_cycles():
+    keys = key_set(chain_prompt(5000))
+    assert len(set(keys.get_used_keys())) == 5000
+
+    prompt = chain_prompt(3)
+    prompt["1"]["inputs"]["image"] = ["2", 0]
+    keys = key_set(prompt)
+    assert keys.get_digest("2") is None
+
+
+def test_output_size_counts_tensors_once():
+    image = torch.zeros((1, 8, 8, 3))
+    assert caching.output_size([[image, image[0]], [4, "text"]]) == (image.nelement() * 4, 0)
+    assert caching.output_size({"samples": torch.zeros(10, dtype=torch.float16)}) == (20, 0)
+
+
+def test_budget_evicts_least_valuable_per_byte():
+    cache = caching.LRUCache(caching.CacheKeySetInputSignature, max_size=None, max_ram=1000)
+    cheap_and_large = torch.zeros(150)
+    expensive_and_small = torch.zeros(50)
+    run_prompt(cache, image_prompt(0), [[cheap_and_large]], execution_time=0.1)
+    run_prompt(cache, image_prompt(1), [[expensive_and_small]], execution_time=5.0)
+    assert cache.ram_bytes == 800
+
+    run_prompt(cache, image_prompt(2), [[torch.zeros(100)]], execution_time=1.0)
+    assert cache.get_stats()["evictions"] == 1
+    assert cache.ram_bytes == 600
+
+    run_prompt(cache, image_prompt(1), None, execution_time=None)
+    assert cache.get_stats()["hits"] == 1
+    run_prompt(cache, image_prompt(0), [[cheap_and_large]], execution_time=0.1)
+    assert cache.get_stats()["misses"] == 4
+
+
+class FakeModel:
+    loaded = 0
+
+
+class FakePatcher:
+    # Clones share the model, and with it what is loaded to the GPU
+    def __init__(self, model):
+        self.model = model
+        self.load_device = "cuda"
+        self.offload_device = "cpu"
+
+    def model_size(self):
+        return 1000
+
+    def loaded_size(self):
+        return self.model.loaded
+
+
+def test_budget_measures_models_as_they_are_now():
+    cache = caching.LRUCache(caching.CacheKeySetInputSignature, max_size=None, max_ram=1500)
+    model = FakeModel()
+    base = FakePatcher(model)
+    run_prompt(cache, image_prompt(0), [base], execution_time=1.0)
+    # A clone with other patches shares the model
+    run_prompt(cache, image_prompt(1), [FakePatcher(model)], execution_time=1.0)
+    assert cache.get_stats()["evictions"] == 0
+    assert cache.ram_bytes == 1000
+
+    model.loaded = 1000
+    run_prompt(cache, image_prompt(2), [[torch.zeros(200)]], execution_time=1.0)
+    stats = cache.get_stats()
+    assert stats["evictions"] == 0
+    assert (stats["ram_bytes"], stats["vram_bytes"]) == (800, 1000)
+
+
+def test_values_of_the_current_prompt_are_kept():
+    cache = caching.LRUCache(caching.CacheKeySetInputSignature, max_size=None, max_ram=10)
+    run_prompt(cache, image_prompt(0), [[torch.zeros(100)]], execution_time=1.0)
+    assert cache.get("1") is not None
+    assert cache.get_stats()["evictions"] == 0
+
+
+def test_executor_reports_cache_stats():
+    e = execution.PromptExecutor(FakeServer(), cache_ram_budget=1024 ** 2)
+    e.execute(image_prompt(0), "first", {}, ["1"])
+    e.execute(image_prompt(0), "second", {}, ["1"])
+    assert e.success
+
+    stats = caching.cache_stats()["outputs"]
+    assert stats["hits"] >= 1
+    assert stats["entries"] >= 1
+    assert stats["ram_bytes"] >= 8 * 8 * 3 * 4
+    assert stats["max_ram"] is not None
+
+
+class SlowEncode:
+    DISK_CACHEABLE = True
+    calls = 0
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"image": ("IMAGE",)}}
+
+    RETURN_TYPES = ("CONDITIONING",)
+    FUNCTION = "encode"
+
+    def encode(self, image):
+        SlowEncode.calls += 1
+        return ([[image.mean(dim=-1), {"pooled_output": image[0, 0], "strength": 0.5}]],)
+
+
+def encode_prompt(color):
+    return {
+        **image_prompt(color),
+        "2": {"class_type": "SlowEncode", "inputs": {"image": ["1", 0]}},
+    }
+
+
+def test_disk_cache_round_trip(tmp_path):
+    disk_cache = caching.DiskCache(str(tmp_path), 1024 ** 2)
+    image = torch.rand((1, 4, 4, 3))
+    value = [[[[image, {"pooled_output": image[0], "strength": 0.5}]]], [(1, "text")]]
+    assert disk_cache.put("ab" * 32, value)
+
+    loaded = disk_cache.get("ab" * 32)
+    assert torch.equal(loaded[0][0][0][0], image)
+    assert torch.equal(loaded[0][0][0][1]["pooled_output"], image[0])
+    assert loaded[0][0][0][1]["strength"] == 0.5
+    assert loaded[1] == [(1, "text")]
+    assert disk_cache.get("cd" * 32) is None
+    assert not disk_cache.put("cd" * 32, [[object()]])
+
+
+def test_disk_cache_drops_least_recently_used(tmp_path):
+    disk_cache = caching.DiskCache(str(tmp_path), 10000)
+    for i in range(3):
+        disk_cache.put("{:064x}".format(i), [[torch.zeros(1000)]])
+    assert disk_cache.get("{:064x}".format(0)) is None
+    assert disk_cache.get("{:064x}".format(2)) is not None
+    assert disk_cache.size <= 10000
+
+
+def test_disk_cacheable_defaults_to_encoder_outputs():
+    class Node:
+        RETURN_TYPES = ("CONDITIONING",)
+    assert caching.disk_cacheable(Node, 1.0)
+    assert not caching.disk_cacheable(Node, 0.01)
+    assert not caching.disk_cacheable(execution.nodes.KSampler, 10.0)
+    assert not caching.disk_cacheable(execution.nodes.VAEDecode, 10.0)
+    assert caching.disk_cacheable(SlowEncode, 0.0)
+
+
+def test_disk_cache_is_shared_between_executors(tmp_path, monkeypatch):
+    monkeypatch.setitem(execution.nodes.NODE_CLASS_MAPPINGS, "SlowEncode", SlowEncode)
+    SlowEncode.calls = 0
+    disk_cache = caching.DiskCache(str(tmp_path), 1024 ** 2)
+    first = execution.PromptExecutor(FakeServer(), disk_cache=disk_cache)
+    first.execute(encode_prompt(0), "first", {}, ["2"])
+    assert first.success
+    disk_cache.flush()
+    assert SlowEncode.calls == 1
+
+    second = execution.PromptExecutor(FakeServer(), lru_size=10, disk_cache=caching.DiskCache(str(tmp_path), 1024 ** 2))
+    second.execute(encode_prompt(0), "second", {}, ["2"])
+    assert second.success
+    assert SlowEncode.calls == 1
+    assert torch.equal(second.output_data["2"][0][0][0][0], first.output_data["2"][0][0][0][0])
+    assert second.caches.outputs.get_stats()["disk_hits"] == 1
+
+    second.execute(encode_prompt(1), "third", {}, ["2"])
+    assert SlowEncode.calls == 2
+
+
+class ChangedImage:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"image": ("IMAGE",)}}
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "load"
+
+    @classmethod
+    def IS_CHANGED(s, image):
+        return "file-hash"
+
+    def load(self, image):
+        return (image,)
+
+
+def test_history_prompts_come_back_unchanged(monkeypatch):
+    import copy
+    monkeypatch.setitem(execution.nodes.NODE_CLASS_MAPPINGS, "ChangedImage", ChangedImage)
+    prompt = {**image_prompt(0), "2": {"class_type": "ChangedImage", "inputs": {"image": ["1", 0]}}}
+    original = copy.deepcopy(prompt)
+
+    server = FakeServer()
+    server.queue_updated = lambda: None
+    q = execution.PromptQueue(server)
+    e = execution.PromptExecutor(server)
+    q.put((0, "prompt-0", prompt, {}, ["2"]))
+    item, item_id = q.get()
+    e.execute(item[2], item[1], item[3], item[4])
+    assert e.success
+    q.task_done(item_id, e.history_result, status=None)
+
+    assert q.get_history("prompt-0")["prompt-0"]["prompt"][2] == original
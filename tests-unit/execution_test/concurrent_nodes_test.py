@@ -0,0 +1,163 @@
+import threading
+import time
+
+import pytest
+
+SLEEP = 0.3
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # See embedded_test.py: importing execution puts comfy/ on sys.path, so import at run time.
+    global execution, nodes
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    import nodes
+
+
+class FakeServer:
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+
+class SlowLoad:
+    CAN_RUN_CONCURRENTLY = True
+    threads = set()
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT", {"default": 0})}}
+
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "load"
+
+    def load(self, value):
+        SlowLoad.threads.add(threading.current_thread().name)
+        time.sleep(SLEEP)
+        if value < 0:
+            raise ValueError("negative value")
+        return (value,)
+
+
+class SlowSum:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"a": ("INT",), "b": ("INT",), "c": ("INT",)}}
+
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "add"
+
+    def add(self, a, b, c):
+        return (a + b + c,)
+
+
+def prompt(a=1, b=2, c=3):
+    return {
+        "1": {"class_type": "SlowLoad", "inputs": {"value": a}},
+        "2": {"class_type": "SlowLoad", "inputs": {"value": b}},
+        "3": {"class_type": "SlowLoad", "inputs": {"value": c}},
+        "4": {"class_type": "SlowSum", "inputs": {"a": ["1", 0], "b": ["2", 0], "c": ["3", 0]}},
+    }
+
+
+@pytest.fixture(autouse=True)
+def slow_nodes(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "SlowLoad", SlowLoad)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "SlowSum", SlowSum)
+    SlowLoad.threads = set()
+
+
+def test_independent_nodes_run_concurrently():
+    e = execution.PromptExecutor(FakeServer(), concurrent_nodes=4)
+    start = time.perf_counter()
+    e.execute(prompt(), "concurrent", {}, ["4"])
+    elapsed = time.perf_counter() - start
+
+    assert e.success
+    assert e.output_data["4"] == [[6]]
+    assert elapsed < SLEEP * 2
+    assert all(name.startswith("node") for name in SlowLoad.threads)
+
+
+def test_nodes_run_serially_by_default():
+    e = execution.PromptExecutor(FakeServer())
+    e.execute(prompt(), "serial", {}, ["4"])
+    assert e.success
+    assert e.output_data["4"] == [[6]]
+    assert SlowLoad.threads == {threading.current_thread().name}
+
+
+def test_error_in_concurrent_node_is_reported_for_that_node():
+    e = execution.PromptExecutor(FakeServer(), concurrent_nodes=4)
+    e.execute(prompt(b=-1), "failing", {}, ["4"])
+
+    assert not e.success
+    errors = [data for event, data in e.status_messages if event == "execution_error"]
+    assert len(errors) == 1
+    assert errors[0]["node_id"] == "2"
+    assert errors[0]["exception_message"] == "negative value"
+
+
+class ProgressLoad(SlowLoad):
+    def load(self, value):
+        import comfy.utils
+        comfy.utils.ProgressBar(1).update(1)
+        return (value,)
+
+
+def test_concurrent_nodes_report_progress_for_themselves(monkeypatch):
+    import comfy.utils
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "SlowLoad", ProgressLoad)
+    reports = []
+    monkeypatch.setattr(comfy.utils, "PROGRESS_BAR_HOOK", lambda value, total, preview, node_id=None: reports.append(node_id))
+
+    e = execution.PromptExecutor(FakeServer(), concurrent_nodes=4)
+    e.execute(prompt(), "progress", {}, ["4"])
+    assert e.success
+    assert sorted(reports) == ["1", "2", "3"]
+
+
+class GPULoad(SlowLoad):
+    def load(self, value):
+        import comfy.model_management
+        comfy.model_management.load_models_gpu([])
+        SlowLoad.threads.add(threading.current_thread().name)
+        return (value,)
+
+
+def test_concurrent_nodes_load_models_on_the_prompt_worker(monkeypatch):
+    import comfy.model_management
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "SlowLoad", GPULoad)
+    loaded = list(comfy.model_management.current_loaded_models)
+
+    e = execution.PromptExecutor(FakeServer(), concurrent_nodes=4)
+    e.execute(prompt(), "gpu load", {}, ["4"])
+    assert e.success
+    assert e.output_data["4"] == [[6]]
+    # The loads ran again on the prompt worker
+    assert SlowLoad.threads == {threading.current_thread().name}
+    assert comfy.model_management.current_loaded_models == loaded
+
+
+def test_node_pool_loads_models_to_the_cpu(monkeypatch):
+    import torch
+    import comfy.model_management
+    monkeypatch.setattr(comfy.model_management, "vram_state", comfy.model_management.VRAMState.HIGH_VRAM)
+    monkeypatch.setattr(comfy.model_management, "get_torch_device", lambda: torch.device("cuda"))
+    assert comfy.model_management.unet_inital_load_device(1000, torch.float16) == torch.device("cuda")
+
+    def on_pool():
+        comfy.model_management.node_pool_thread.active = True
+        return (comfy.model_management.unet_inital_load_device(1000, torch.float16),
+                comfy.model_management.text_encoder_initial_device(torch.device("cuda"), torch.device("cpu"), 2 * 1024 ** 3))
+    with execution.ThreadPoolExecutor(1) as pool:
+        assert pool.submit(on_pool).result() == (torch.device("cpu"), torch.device("cpu"))
@@ -0,0 +1,114 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # Importing execution loads nodes, which puts comfy/ on sys.path and shadows the top level
+    # utils package. Import at run time so the other test modules are already collected.
+    global execution, EmbeddedExecutor, WorkflowExecutionError, WorkflowTemplate, WorkflowTemplateError
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    from comfy_execution.embedded import EmbeddedExecutor, WorkflowExecutionError, WorkflowTemplate, WorkflowTemplateError
+
+
+class FakeServer:
+    def __init__(self):
+        self.number = 0
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+
+    def next_prompt_number(self):
+        self.number += 1
+        return self.number - 1
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+
+WORKFLOW = {
+    "1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 4, "batch_size": 1, "color": 0},
+          "_meta": {"title": "Empty Image"}},
+    "2": {"class_type": "SaveImage", "inputs": {"images": ["1", 0], "filename_prefix": "test"},
+          "_meta": {"title": "Save Image"}},
+}
+
+
+@pytest.fixture
+def prompt_queue(comfy_modules):
+    server = FakeServer()
+    q = execution.PromptQueue(server)
+    executor = execution.PromptExecutor(server)
+
+    def worker():
+        while True:
+            queue_item = q.get(timeout=None)
+            if queue_item is None:
+                continue
+            item, item_id = queue_item
+            if item[2] is None:
+                q.task_done(item_id, {}, None)
+                return
+            executor.execute(item[2], item[1], item[3], item[4])
+            q.task_done(item_id, executor.history_result,
+                        status=execution.PromptQueue.ExecutionStatus(
+                            status_str='success' if executor.success else 'error',
+                            completed=executor.success,
+                            messages=executor.status_messages),
+                        output_data=executor.output_data)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    yield q
+    q.put((float("inf"), "stop", None, {}, []))
+    thread.join(timeout=10)
+
+
+def test_template_validates_once_and_captures_output_source():
+    template = WorkflowTemplate(WORKFLOW, ["Save Image"])
+    assert template.captures == {"Save Image": ("1", 0)}
+    assert template.execute_outputs() == ["1"]
+
+
+def test_template_rejects_invalid_workflow():
+    workflow = {"1": {"class_type": "EmptyImage", "inputs": {"width": "wide"}, "_meta": {"title": "Empty Image"}}}
+    with pytest.raises(WorkflowTemplateError):
+        WorkflowTemplate(workflow, [])
+
+
+def test_instantiate_does_not_mutate_template():
+    template = WorkflowTemplate(WORKFLOW, ["Save Image"])
+    prompt = template.instantiate({"Empty Image": {"width": 16}})
+    assert prompt["1"]["inputs"]["width"] == 16
+    assert template.prompt["1"]["inputs"]["width"] == 8
+    with pytest.raises(WorkflowTemplateError):
+        template.instantiate({"Missing": {"width": 16}})
+
+
+def test_run_returns_tensors_without_running_output_node(prompt_queue):
+    template = WorkflowTemplate(WORKFLOW, ["Save Image"])
+    executor = EmbeddedExecutor(prompt_queue)
+
+    images = executor.run(template, {"Empty Image": {"width": 16, "color": 0xFF0000}}, timeout=60)
+    assert images["Save Image"].shape == (1, 4, 16, 3)
+    assert images["Save Image"][0, 0, 0].tolist() == [1.0, 0.0, 0.0]
+
+    encoded = executor.run_encoded(template, {"Empty Image": {"batch_size": 2}}, image_format="PNG", timeout=60)
+    assert len(encoded["Save Image"]) == 2
+    assert encoded["Save Image"][0].startswith(b"\x89PNG")
+
+
+def test_removed_prompt_reports_error():
+    server = FakeServer()
+    q = execution.PromptQueue(server)
+    pending = EmbeddedExecutor(q).queue(WorkflowTemplate(WORKFLOW, ["Save Image"]))
+    q.wipe_queue()
+    with pytest.raises(WorkflowExecutionError):
+        pending.result(timeout=1)
@@ -0,0 +1,80 @@
+import pytest
+
+from comfy_execution import history
+from comfy_execution.history import MemoryHistoryStore, SQLiteHistoryStore
+
+WORKFLOW = {"1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 1, "color": 0}}}
+
+
+def entry(number, seed=0):
+    prompt = {"1": {"class_type": "KSampler", "inputs": {"seed": seed}}}
+    item = (number, "prompt-{}".format(number), prompt, {"extra_pnginfo": {"workflow": WORKFLOW}}, ["1"])
+    return {"prompt": item, "outputs": {"1": {"images": [number]}}, "status": {"completed": True}}
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    def make(max_size=100):
+        if request.param == "memory":
+            return MemoryHistoryStore(max_size)
+        return SQLiteHistoryStore(str(tmp_path / "history.db"), max_size)
+    return make
+
+
+def test_get_and_page(make_store):
+    store = make_store()
+    for i in range(5):
+        store.add("prompt-{}".format(i), entry(i))
+
+    assert len(store) == 5
+    assert store.get("missing") is None
+    found = store.get("prompt-3")
+    assert list(found["prompt"][:2]) == [3, "prompt-3"]
+    assert found["prompt"][2] == entry(3)["prompt"][2]
+    assert found["outputs"] == {"1": {"images": [3]}}
+
+    assert list(store.page()) == ["prompt-{}".format(i) for i in range(5)]
+    assert list(store.page(max_items=2)) == ["prompt-3", "prompt-4"]
+    assert list(store.page(max_items=2, offset=1)) == ["prompt-1", "prompt-2"]
+    assert list(store.page(offset=3)) == ["prompt-3", "prompt-4"]
+    assert store.page(since=float("inf")) == {}
+
+
+def test_delete_and_wipe(make_store):
+    store = make_store()
+    for i in range(3):
+        store.add("prompt-{}".format(i), entry(i))
+    store.delete("prompt-1")
+    assert list(store.page()) == ["prompt-0", "prompt-2"]
+    store.wipe()
+    assert len(store) == 0
+
+
+def test_oldest_entries_are_dropped(make_store, monkeypatch):
+    monkeypatch.setattr(history, "PRUNE_BATCH", 2)
+    store = make_store(max_size=5)
+    for i in range(20):
+        store.add("prompt-{}".format(i), entry(i))
+    assert len(store) <= 5 + 2
+    assert "prompt-19" in store.page()
+    assert store.get("prompt-0") is None
+
+
+def test_sqlite_store_persists_and_deduplicates_bodies(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, "HOT_ENTRIES", 1)
+    path = str(tmp_path / "history.db")
+    store = SQLiteHistoryStore(path, 100)
+    for i in range(10):
+        store.add("prompt-{}".format(i), entry(i, seed=i % 2))
+    # Two distinct prompts and one extra_data body.
+    assert store.db.execute("SELECT COUNT(*) FROM bodies").fetchone()[0] == 3
+
+    reopened = SQLiteHistoryStore(path, 100)
+    assert len(reopened) == 10
+    assert reopened.get("prompt-5")["prompt"][2] == entry(5, seed=1)["prompt"][2]
+    assert reopened.get("prompt-5")["prompt"][3]["extra_pnginfo"]["workflow"] == WORKFLOW
+
+    for i in range(10):
+        if i % 2 == 1:
+            reopened.delete("prompt-{}".format(i))
+    assert reopened.db.execute("SELECT COUNT(*) FROM bodies").fetchone()[0] == 2
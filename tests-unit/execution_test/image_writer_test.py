@@ -0,0 +1,137 @@
+import io
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # See embedded_test.py: importing execution puts comfy/ on sys.path, so import at run time.
+    global execution, folder_paths, image_writer
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    import folder_paths
+    from comfy_execution import image_writer
+
+
+class FakeServer:
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+
+@pytest.fixture
+def output_directory(tmp_path):
+    previous = folder_paths.get_output_directory()
+    folder_paths.set_output_directory(str(tmp_path))
+    yield tmp_path
+    folder_paths.set_output_directory(previous)
+
+
+def save_prompt(prefix, **options):
+    return {
+        "1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 4, "batch_size": 2, "color": 0x336699}},
+        "2": {"class_type": "SaveImage", "inputs": {"images": ["1", 0], "filename_prefix": prefix, **options}},
+        "3": {"class_type": "ImageInvert", "inputs": {"image": ["1", 0]}},
+        "4": {"class_type": "SaveImage", "inputs": {"images": ["3", 0], "filename_prefix": prefix}},
+    }
+
+
+def test_images_to_uint8_matches_per_image_conversion():
+    images = torch.rand((3, 5, 7, 3)) * 1.2 - 0.1
+    expected = [np.clip(255. * image.numpy(), 0, 255).astype(np.uint8) for image in images]
+    converted = image_writer.images_to_uint8(images)
+    assert converted.dtype == np.uint8
+    assert converted.shape == (3, 5, 7, 3)
+    for a, b in zip(converted, expected):
+        assert np.abs(a.astype(int) - b.astype(int)).max() <= 1
+    assert image_writer.images_to_uint8(list(images)).shape == (3, 5, 7, 3)
+
+
+def test_images_to_uint8_converts_large_batches_in_chunks(monkeypatch):
+    monkeypatch.setattr(image_writer, "CPU_CHUNK_ELEMENTS", 1000)
+    latent = torch.rand((2, 33, 17, 3)) * 2.4 - 1.2
+    # The latent preview conversion, -1..1 to 0..255
+    expected = (((latent + 1.0) / 2.0).clamp(0, 1).mul(0xFF)).to(torch.uint8).numpy()
+    converted = image_writer.images_to_uint8(latent, value_range=(-1.0, 1.0))
+    assert np.abs(converted.astype(int) - expected.astype(int)).max() <= 1
+    assert image_writer.images_to_uint8(latent[:, :, :, :0]).shape == (2, 33, 17, 0)
+
+
+def test_writes_are_complete_when_the_prompt_is_done(output_directory):
+    e = execution.PromptExecutor(FakeServer())
+    e.execute(save_prompt("saved"), "saved", {}, ["2", "4"])
+    assert e.success
+
+    # The second save counts the files of the first one although they may not be written yet
+    files = sorted(os.listdir(output_directory))
+    assert files == ["saved_00001_.png", "saved_00002_.png", "saved_00003_.png", "saved_00004_.png"]
+    colors = []
+    for name in files:
+        with Image.open(output_directory / name) as img:
+            assert img.size == (8, 4)
+            assert "prompt" in img.info
+            colors.append(img.getpixel((0, 0)))
+    assert len(set(colors)) == 2
+    assert (0x33, 0x66, 0x99) in colors
+    assert image_writer.writer.pending_write(str(output_directory / files[0])) is None
+
+
+def test_failed_writes_are_execution_errors(output_directory, monkeypatch):
+    def fail(self, image, path, *args):
+        raise OSError("disk full")
+    monkeypatch.setattr(execution.nodes.SaveImage, "write_image", fail)
+
+    e = execution.PromptExecutor(FakeServer())
+    e.execute(save_prompt("failing"), "failing", {}, ["2", "4"])
+    assert not e.success
+    errors = [data for event, data in e.status_messages if event == "execution_error"]
+    assert len(errors) == 1
+    assert errors[0]["node_id"] in ("2", "4")
+    assert errors[0]["exception_message"] == "disk full"
+    assert not any(event == "execution_success" for event, _ in e.status_messages)
+
+
+@pytest.mark.parametrize("image_format,extension", [("jpeg", "jpg"), ("webp", "webp")])
+def test_lossy_formats_store_metadata_as_exif_and_xmp(output_directory, image_format, extension):
+    e = execution.PromptExecutor(FakeServer())
+    prompt = save_prompt("lossy", format=image_format, quality=80, effort="slowest")
+    e.execute(prompt, "lossy", {"extra_pnginfo": {"workflow": {"nodes": []}}}, ["2"])
+    assert e.success
+
+    files = sorted(os.listdir(output_directory))
+    assert files == ["lossy_00001_.{}".format(extension), "lossy_00002_.{}".format(extension)]
+    with Image.open(output_directory / files[0]) as img:
+        assert img.format == image_format.upper()
+        assert img.size == (8, 4)
+        exif = img.getexif()
+        assert exif[0x0110].startswith("prompt:")
+        assert exif[0x010f] == 'workflow:{"nodes": []}'
+        assert b"comfy:workflow=" in img.info["xmp"]
+
+
+def test_metadata_can_be_left_out(output_directory):
+    e = execution.PromptExecutor(FakeServer())
+    e.execute(save_prompt("plain", effort="fastest", metadata=False), "plain", {}, ["2"])
+    assert e.success
+    with Image.open(output_directory / "plain_00001_.png") as img:
+        assert "prompt" not in img.info
+
+
+def test_encode_images_returns_bytes_without_files(output_directory):
+    images = torch.rand((2, 6, 10, 3))
+    encoded = execution.nodes.SaveImage().encode_images(images, format="webp", quality=100, prompt={"1": {}})
+    assert len(encoded) == 2
+    assert os.listdir(output_directory) == []
+    with Image.open(io.BytesIO(encoded[1])) as img:
+        assert img.format == "WEBP"
+        # Lossless at quality 100
+        assert np.array_equal(np.asarray(img.convert("RGB")), image_writer.images_to_uint8(images)[1])
@@ -0,0 +1,84 @@
+import pytest
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # See embedded_test.py: importing execution puts comfy/ on sys.path, so import at run time.
+    global execution, nodes
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    import nodes
+
+
+PROMPT = {
+    "1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 1, "color": 0}},
+    "2": {"class_type": "ImageScale", "inputs": {"image": ["1", 0], "upscale_method": "bilinear", "width": 16, "height": 16, "crop": "disabled"}},
+    "3": {"class_type": "SaveImage", "inputs": {"images": ["2", 0], "filename_prefix": "test"}},
+    "4": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 1, "color": 0}},
+    "5": {"class_type": "PreviewImage", "inputs": {"images": ["4", 0]}},
+}
+
+
+def test_registration_runs_full_validation():
+    template = execution.PromptTemplate(PROMPT)
+    assert template.valid[0] is True
+    assert sorted(template.outputs) == ["3", "5"]
+    assert sorted(template.dependent_outputs["1"]) == ["3"]
+
+    invalid = execution.PromptTemplate({"1": {"class_type": "EmptyImage", "inputs": {}}})
+    assert invalid.valid[0] is False
+
+
+def test_overrides_are_validated_and_converted():
+    template = execution.PromptTemplate(PROMPT)
+    valid, prompt = template.validate({"2": {"width": "32"}})
+    assert valid[0] is True
+    assert sorted(valid[2]) == ["3", "5"]
+    assert prompt["2"]["inputs"]["width"] == 32
+    assert template.prompt["2"]["inputs"]["width"] == 16
+
+
+def test_invalid_override_only_fails_dependent_outputs():
+    template = execution.PromptTemplate(PROMPT)
+    valid, _ = template.validate({"1": {"width": -1}})
+    assert valid[0] is True
+    assert valid[2] == ["5"]
+    assert valid[3]["1"]["errors"][0]["type"] == "value_smaller_than_min"
+    assert valid[3]["1"]["dependent_outputs"] == ["3"]
+
+    valid, _ = template.validate({"1": {"width": -1}, "4": {"width": -1}})
+    assert valid[0] is False
+    assert valid[1]["type"] == "prompt_outputs_failed_validation"
+
+
+def test_untouched_nodes_do_not_call_input_types(monkeypatch):
+    template = execution.PromptTemplate(PROMPT)
+    calls = []
+    original = nodes.EmptyImage.INPUT_TYPES
+    monkeypatch.setattr(nodes.EmptyImage, "INPUT_TYPES", classmethod(lambda cls: calls.append(cls) or original()))
+
+    valid, _ = template.validate({"2": {"height": 64}, "1": {"color": 255}})
+    assert valid[0] is True
+    assert calls == []
+
+
+def test_stale_choices_are_refreshed(monkeypatch):
+    template = execution.PromptTemplate(PROMPT)
+    monkeypatch.setattr(nodes.ImageScale, "upscale_methods", nodes.ImageScale.upscale_methods + ["new-method"])
+    valid, _ = template.validate({"2": {"upscale_method": "new-method"}})
+    assert valid[0] is True
+    valid, _ = template.validate({"2": {"upscale_method": "missing"}})
+    assert valid[3]["2"]["errors"][0]["type"] == "value_not_in_list"
+
+
+def test_link_overrides_and_unknown_nodes():
+    template = execution.PromptTemplate(PROMPT)
+    valid, prompt = template.validate({"3": {"images": ["4", 0]}})
+    assert valid[0] is True
+    assert prompt["3"]["inputs"]["images"] == ["4", 0]
+
+    valid, prompt = template.validate({"99": {"width": 1}})
+    assert valid[0] is False
+    assert prompt is None
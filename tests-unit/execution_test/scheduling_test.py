@@ -0,0 +1,122 @@
+import pytest
+
+from comfy_execution.scheduling import FairShareScheduler, QueueFull
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # See embedded_test.py, nodes can only be imported once the other test modules are collected.
+    global execution
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+
+
+class FakeServer:
+    def queue_updated(self):
+        pass
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_queue(scheduler=None):
+    q = execution.PromptQueue(FakeServer())
+    if scheduler is not None:
+        q.scheduler = scheduler
+    return q
+
+
+def item(number, tenant, priority=None):
+    extra_data = {"tenant": tenant}
+    if priority is not None:
+        extra_data["priority"] = priority
+    return (number, "{}-{}".format(tenant, number), {}, extra_data, [])
+
+
+def drain(q):
+    out = []
+    while True:
+        queue_item = q.get(timeout=0)
+        if queue_item is None:
+            return out
+        out.append(queue_item[0][1])
+        q.task_done(queue_item[1], {}, None)
+
+
+def test_tenants_share_the_queue():
+    q = make_queue()
+    for i in range(6):
+        q.put(item(i, "heavy"))
+    q.put(item(6, "light"))
+    q.put(item(7, "light"))
+    assert drain(q)[:4] == ["heavy-0", "light-6", "heavy-1", "light-7"]
+
+
+def test_front_prompts_run_first():
+    q = make_queue()
+    q.put(item(0, "a"))
+    q.put(item(1, "a"))
+    q.put(item(-2, "b"))
+    assert drain(q) == ["b--2", "a-0", "a-1"]
+
+
+def test_priority_classes_are_weighted():
+    q = make_queue()
+    for i in range(8):
+        q.put(item(i, "a", "low"))
+    for i in range(8, 16):
+        q.put(item(i, "b", "high"))
+    order = drain(q)
+    # "high" gets 16 times the share of "low": 16 of b's prompts would run before the first of a's.
+    assert order == ["b-{}".format(i) for i in range(8, 16)] + ["a-{}".format(i) for i in range(8)]
+
+
+def test_max_queued_per_tenant():
+    q = make_queue(FairShareScheduler(max_queued=2))
+    q.put(item(0, "a"))
+    q.put(item(1, "a"))
+    with pytest.raises(QueueFull):
+        q.put(item(2, "a"))
+    q.put(item(3, "b"))
+
+    q.delete_queue_item(lambda x: x[1] == "a-0")
+    q.put(item(4, "a"))
+
+
+def test_max_running_per_tenant():
+    q = make_queue(FairShareScheduler(max_running=1))
+    q.put(item(0, "a"))
+    q.put(item(1, "a"))
+    q.put(item(2, "b"))
+    first = q.get(timeout=0)
+    second = q.get(timeout=0)
+    assert (first[0][1], second[0][1]) == ("a-0", "b-2")
+    assert q.get(timeout=0) is None
+
+    q.task_done(first[1], {}, None)
+    assert q.get(timeout=0)[0][1] == "a-1"
+
+
+def test_estimated_waits():
+    clock = FakeClock()
+    q = make_queue(FairShareScheduler(clock=clock))
+    for i in range(3):
+        q.put(item(i, "a"))
+    assert q.get_estimated_waits() == {"a-1": None, "a-2": None, "a-0": None}
+
+    running = q.get(timeout=0)
+    clock.now = 10.0
+    q.task_done(running[1], {}, None)
+    running = q.get(timeout=0)
+    clock.now = 14.0
+    assert q.get_estimated_waits() == {"a-2": 6.0}
+
+    q.worker_count = 2
+    assert q.get_estimated_waits() == {"a-2": 3.0}
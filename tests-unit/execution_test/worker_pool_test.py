@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # See embedded_test.py, nodes can only be imported once the other test modules are collected.
+    global args, execution, WorkerPool
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    from comfy_execution.worker_pool import WorkerPool
+
+
+class WorkerPid:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {}}
+
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    def run(self):
+        import comfy.utils
+        pbar = comfy.utils.ProgressBar(2)
+        for _ in range(2):
+            time.sleep(0.5)
+            pbar.update(1)
+        return {"ui": {"pid": [os.getpid()]}}
+
+
+def run_prompts(q, server):
+    # A minimal main.prompt_worker + main.hijack_progress, runs in the worker processes.
+    import comfy.utils
+    import execution
+    import nodes
+    nodes.NODE_CLASS_MAPPINGS["WorkerPid"] = WorkerPid
+
+    def hook(value, total, preview_image):
+        server.send_sync("progress", {"value": value, "max": total, "prompt_id": server.last_prompt_id}, server.client_id)
+    comfy.utils.set_progress_bar_global_hook(hook)
+
+    e = execution.PromptExecutor(server)
+    while True:
+        queue_item = q.get(timeout=1000)
+        if queue_item is not None:
+            item, item_id = queue_item
+            server.last_prompt_id = item[1]
+            e.execute(item[2], item[1], item[3], item[4])
+            q.task_done(item_id, e.history_result,
+                        status=execution.PromptQueue.ExecutionStatus(
+                            status_str='success' if e.success else 'error',
+                            completed=e.success,
+                            messages=e.status_messages))
+        q.get_flags()
+
+
+class RecordingServer:
+    def __init__(self):
+        self.client_id = None
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        with self.lock:
+            self.messages.append((event, data))
+
+
+def item(number, models):
+    prompt = {str(i): {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": m}} for i, m in enumerate(models)}
+    return (number, "prompt-{}".format(number), prompt, {}, [])
+
+
+def test_get_prefers_prompts_with_loaded_models():
+    q = execution.PromptQueue(RecordingServer())
+    q.put(item(0, ["a.safetensors"]))
+    q.put(item(1, ["b.safetensors"]))
+    q.put(item(2, ["a.safetensors"]))
+
+    has_b = lambda i: "b.safetensors" in [n["inputs"]["ckpt_name"] for n in i[2].values()]
+    assert q.get(affinity=has_b)[0][1] == "prompt-1"
+    assert q.get(affinity=has_b)[0][1] == "prompt-0"
+    assert q.get()[0][1] == "prompt-2"
+
+
+def test_get_affinity_does_not_starve_the_head():
+    q = execution.PromptQueue(RecordingServer())
+    q.put(item(0, ["a.safetensors"]))
+    for i in range(1, 10):
+        q.put(item(i, ["b.safetensors"]))
+
+    has_b = lambda i: "b.safetensors" in [n["inputs"]["ckpt_name"] for n in i[2].values()]
+    taken = [q.get(affinity=has_b)[0][1] for _ in range(execution.AFFINITY_MAX_SKIPS + 1)]
+    assert taken[-1] == "prompt-0"
+    assert "prompt-0" not in taken[:-1]
+
+
+def test_pool_runs_prompts_in_two_processes():
+    server = RecordingServer()
+    q = execution.PromptQueue(server)
+    disable_all_custom_nodes = args.disable_all_custom_nodes
+    args.disable_all_custom_nodes = True
+    pool = WorkerPool(q, server, 2, run_prompts)
+    try:
+        pool.start()
+        assert pool.wait_ready(timeout=300)
+        prompt_ids = ["prompt-0", "prompt-1"]
+        for i, prompt_id in enumerate(prompt_ids):
+            q.put((i, prompt_id, {"1": {"class_type": "WorkerPid", "inputs": {}}}, {}, ["1"]))
+
+        deadline = time.time() + 120
+        while q.get_tasks_remaining() > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        history = q.get_history()
+    finally:
+        pool.stop()
+        args.disable_all_custom_nodes = disable_all_custom_nodes
+
+    pids = {p: history[p]["outputs"]["1"]["pid"][0] for p in prompt_ids}
+    assert all(history[p]["status"]["completed"] for p in prompt_ids)
+    assert set(pids.values()) == set(w.pid for w in pool.workers)
+    assert len(set(pids.values())) == 2
+
+    progress = [data for event, data in server.messages if event == "progress"]
+    assert sorted(set(p["prompt_id"] for p in progress)) == prompt_ids
+    for event, data in server.messages:
+        if event == "executed":
+            assert data["output"]["pid"] == [pids[data["prompt_id"]]]
@@ -0,0 +1,41 @@
+import hashlib
+import io
+import os
+
+import node_helpers
+from node_helpers import FileHashCache
+
+
+def test_hash_is_reused_until_the_file_changes(tmp_path, monkeypatch):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"a" * 1000)
+    cache = FileHashCache()
+    reads = []
+    hash_file = node_helpers.hash_file
+    monkeypatch.setattr(node_helpers, "hash_file", lambda *args: reads.append(args) or hash_file(*args))
+
+    assert cache.hash(str(path)) == hashlib.sha256(b"a" * 1000).hexdigest()
+    assert cache.hash(str(path)) == hashlib.sha256(b"a" * 1000).hexdigest()
+    assert len(reads) == 1
+
+    path.write_bytes(b"b" * 1000)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache.hash(str(path)) == hashlib.sha256(b"b" * 1000).hexdigest()
+    assert cache.hash(str(path), "md5") == hashlib.md5(b"b" * 1000).hexdigest()
+    assert len(reads) == 3
+
+
+def test_hashes_persist_in_the_database(tmp_path, monkeypatch):
+    path = tmp_path / "audio.wav"
+    path.write_bytes(b"sound")
+    db = str(tmp_path / "hashes.db")
+    FileHashCache(db).hash(str(path))
+
+    monkeypatch.setattr(node_helpers, "hash_file", None)
+    assert FileHashCache(db).hash(str(path)) == hashlib.sha256(b"sound").hexdigest()
+
+
+def test_hash_file_object():
+    f = io.BytesIO(b"x" * (3 * 1024 * 1024 + 5))
+    assert node_helpers.hash_file(f, "sha1", chunk_size=1024 * 1024) == hashlib.sha1(f.getvalue()).hexdigest()
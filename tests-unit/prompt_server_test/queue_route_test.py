@@ -0,0 +1,182 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # Importing server loads nodes, which puts comfy/ on sys.path and shadows the top level utils
+    # package. Import at run time so the other test modules are already collected.
+    global execution, server
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    import server
+
+
+@pytest.fixture
+def prompt_server():
+    s = server.PromptServer(asyncio.new_event_loop())
+    execution.PromptQueue(s)
+    s.add_routes()
+    return s
+
+
+def queue_prompts(q, count):
+    for i in range(count):
+        prompt = {"1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 1, "color": i}}}
+        q.put((i, "prompt-{}".format(i), prompt, {"client_id": "c"}, ["1"]))
+
+
+@pytest.mark.asyncio
+async def test_queue_returns_items_and_etag(aiohttp_client, prompt_server):
+    q = prompt_server.prompt_queue
+    queue_prompts(q, 3)
+    running = q.get()
+    client = await aiohttp_client(prompt_server.app)
+
+    resp = await client.get("/queue")
+    assert resp.status == 200
+    data = await resp.json()
+    assert [x[1] for x in data["queue_running"]] == ["prompt-0"]
+    assert sorted(x[1] for x in data["queue_pending"]) == ["prompt-1", "prompt-2"]
+    assert data["queue_pending"][0][2]["1"]["class_type"] == "EmptyImage"
+
+    etag = resp.headers["ETag"]
+    resp = await client.get("/queue", headers={"If-None-Match": etag})
+    assert resp.status == 304
+
+    q.task_done(running[1], {}, None)
+    resp = await client.get("/queue", headers={"If-None-Match": etag})
+    assert resp.status == 200
+    assert (await resp.json())["queue_running"] == []
+
+
+@pytest.mark.asyncio
+async def test_queue_summary(aiohttp_client, prompt_server):
+    queue_prompts(prompt_server.prompt_queue, 3)
+    client = await aiohttp_client(prompt_server.app)
+
+    resp = await client.get("/queue?summary=1")
+    data = await resp.json()
+    assert data["queue_running"] == []
+    assert data["queue_pending"] == [{"number": i, "prompt_id": "prompt-{}".format(i)} for i in range(3)]
+
+    # The full queue is another representation
+    resp = await client.get("/queue", headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status == 200
+    assert len((await resp.json())["queue_pending"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_queue_etag_follows_the_estimated_wait(aiohttp_client, prompt_server):
+    q = prompt_server.prompt_queue
+    queue_prompts(q, 3)
+    client = await aiohttp_client(prompt_server.app)
+    resp = await client.get("/queue")
+    assert (await resp.json())["estimated_wait"] == {"prompt-{}".format(i): None for i in range(3)}
+
+    # The first finished prompt gives the estimates, the queue itself is the same
+    q.scheduler.average_duration = 10.0
+    resp = await client.get("/queue", headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status == 200
+    assert sorted((await resp.json())["estimated_wait"].values()) == [0, 10, 20]
+    resp = await client.get("/queue", headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status == 304
+
+
+def test_queue_changes_are_coalesced(prompt_server):
+    q = prompt_server.prompt_queue
+    queue_prompts(q, 3)
+    q.get()
+    prompt_server.loop.run_until_complete(asyncio.sleep(server.STATUS_INTERVAL * 3))
+
+    messages = []
+    while not prompt_server.messages.empty():
+        messages.append(prompt_server.messages.get_nowait())
+    assert [m[0] for m in messages] == ["queue_delta", "status"]
+    changes = messages[0][1]["changes"]
+    assert [(c["type"], c["prompt_id"]) for c in changes] == [
+        ("added", "prompt-0"), ("added", "prompt-1"), ("added", "prompt-2"), ("started", "prompt-0")]
+    assert messages[0][1]["version"] == q.version
+    assert messages[1][1]["status"]["exec_info"]["queue_remaining"] == 3
+
+
+class BlockedSocket:
+    def __init__(self):
+        self.sent = []
+        self.unblock = asyncio.Event()
+
+    async def send_str(self, message):
+        await self.unblock.wait()
+        self.sent.append(message)
+
+
+@pytest.mark.asyncio
+async def test_slow_socket_collapses_and_overflows():
+    ws = BlockedSocket()
+    sender = server.SocketSender(ws)
+    assert sender.put("executing", "first")
+    await asyncio.sleep(0)
+    for i in range(10):
+        assert sender.put("progress", "progress {}".format(i))
+    for i in range(server.SOCKET_QUEUE_SIZE - 1):
+        assert sender.put("executed", "executed {}".format(i))
+    assert not sender.put("executed", "one too many")
+
+    ws.unblock.set()
+    while len(sender.messages) > 0:
+        await asyncio.sleep(0)
+    sender.close()
+    assert ws.sent[:2] == ["first", "progress 9"]
+    assert len(ws.sent) == server.SOCKET_QUEUE_SIZE + 1
+
+
+@pytest.mark.asyncio
+async def test_slow_socket_keeps_the_order_of_messages():
+    ws = BlockedSocket()
+    sender = server.SocketSender(ws)
+    sender.put("executing", "executing A")
+    await asyncio.sleep(0)
+    sender.put("progress", "progress A")
+    sender.put("status", "status 1")
+    sender.put("executing", "executing B")
+    sender.put("progress", "progress B")
+    sender.put("status", "status 2")
+
+    ws.unblock.set()
+    while len(sender.messages) > 0:
+        await asyncio.sleep(0)
+    sender.close()
+    assert ws.sent == ["executing A", "executing B", "progress B", "status 2"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fields", [{"client_id": {}}, {"priority": {}}, {"priority": "urgent"}, {"priority": "high"}, {"extra_data": []}])
+async def test_prompt_scheduling_fields_are_checked(aiohttp_client, prompt_server, fields):
+    client = await aiohttp_client(prompt_server.app)
+    prompt = {"1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 1, "color": 0}}}
+    resp = await client.post("/prompt", json={"prompt": prompt, **fields})
+    assert resp.status == 400
+    assert prompt_server.prompt_queue.get_tasks_remaining() == 0
+
+
+@pytest.mark.asyncio
+async def test_prompt_tenant_comes_from_the_server(aiohttp_client, prompt_server, monkeypatch):
+    from comfy.cli_args import args
+    monkeypatch.setattr(args, "allow_prompt_priority", True)
+    client = await aiohttp_client(prompt_server.app)
+    prompt = {"1": {"class_type": "EmptyImage", "inputs": {"width": 8, "height": 8, "batch_size": 1, "color": 0}},
+              "2": {"class_type": "PreviewImage", "inputs": {"images": ["1", 0]}}}
+    resp = await client.post("/prompt", json={"prompt": prompt, "client_id": "c", "priority": "high", "extra_data": {"tenant": "someone else"}})
+    assert resp.status == 200
+    extra_data = prompt_server.prompt_queue.get_current_queue()[1][0][3]
+    assert extra_data == {"client_id": "c", "priority": "high"}
+
+
+def test_prompt_numbers_are_unique_across_threads(prompt_server):
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        numbers = list(pool.map(lambda _: prompt_server.next_prompt_number(), range(1000)))
+    assert sorted(numbers) == list(range(1000))
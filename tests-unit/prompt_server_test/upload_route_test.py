@@ -0,0 +1,128 @@
+import asyncio
+import os
+
+import aiohttp
+import pytest
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # See queue_route_test.py, server can only be imported once the other test modules are collected.
+    global execution, server, folder_paths, args
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    import folder_paths
+    import server
+
+
+@pytest.fixture
+def prompt_server(tmp_path, monkeypatch):
+    input_directory = folder_paths.get_input_directory()
+    folder_paths.set_input_directory(str(tmp_path))
+    s = server.PromptServer(asyncio.new_event_loop())
+    execution.PromptQueue(s)
+    s.add_routes()
+    yield s
+    folder_paths.set_input_directory(input_directory)
+
+
+def upload_form(content, filename="temp.png", **fields):
+    data = aiohttp.FormData()
+    data.add_field("image", content, filename=filename, content_type="image/png")
+    for k, v in fields.items():
+        data.add_field(k, v)
+    return data
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content_addressed", [False, True])
+async def test_duplicate_uploads_keep_their_name(aiohttp_client, prompt_server, tmp_path, monkeypatch, content_addressed):
+    monkeypatch.setattr(args, "content_addressed_uploads", content_addressed)
+    client = await aiohttp_client(prompt_server.app)
+
+    names = []
+    for content in (b"first", b"first", b"second"):
+        resp = await client.post("/upload/image", data=upload_form(content))
+        assert resp.status == 200
+        names.append((await resp.json())["name"])
+    assert names[0] == names[1] == "temp.png"
+    assert names[2] != "temp.png"
+    assert (tmp_path / names[2]).read_bytes() == b"second"
+
+
+@pytest.mark.asyncio
+async def test_upload_size_limit(aiohttp_client, prompt_server, tmp_path):
+    prompt_server.max_upload_size = 1000
+    client = await aiohttp_client(prompt_server.app)
+    resp = await client.post("/upload/image", data=upload_form(b"x" * 2000))
+    assert resp.status == 413
+    assert not (tmp_path / "temp.png").exists()
+
+    resp = await client.post("/upload/image", data=upload_form(b"x" * 500, subfolder="sub"))
+    assert resp.status == 200
+    assert (await resp.json())["subfolder"] == "sub"
+    assert (tmp_path / "sub" / "temp.png").read_bytes() == b"x" * 500
+
+
+@pytest.mark.asyncio
+async def test_mask_upload_sets_the_alpha_channel(aiohttp_client, prompt_server, tmp_path):
+    import io
+    import json
+    from PIL import Image
+    Image.new("RGB", (4, 4), (255, 0, 0)).save(tmp_path / "original.png")
+    mask = io.BytesIO()
+    Image.new("RGBA", (4, 4), (0, 0, 0, 7)).save(mask, format="PNG")
+
+    client = await aiohttp_client(prompt_server.app)
+    original_ref = json.dumps({"filename": "original.png", "type": "input"})
+    resp = await client.post("/upload/mask", data=upload_form(mask.getvalue(), filename="masked.png", original_ref=original_ref))
+    assert resp.status == 200
+    with Image.open(tmp_path / "masked.png") as image:
+        assert image.getpixel((0, 0)) == (255, 0, 0, 7)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content_addressed", [False, True])
+async def test_concurrent_uploads_get_their_own_name(aiohttp_client, prompt_server, tmp_path, monkeypatch, content_addressed):
+    monkeypatch.setattr(args, "content_addressed_uploads", content_addressed)
+    client = await aiohttp_client(prompt_server.app)
+
+    async def upload(content):
+        resp = await client.post("/upload/image", data=upload_form(content, filename="temp.jpg"))
+        assert resp.status == 200
+        return (await resp.json())["name"]
+
+    contents = [b"upload %d" % i * 1000 for i in range(8)]
+    names = await asyncio.gather(*[upload(content) for content in contents])
+    assert len(set(names)) == len(contents)
+    for name, content in zip(names, contents):
+        assert (tmp_path / name).read_bytes() == content
+    assert not any(".tmp" in name or name.startswith(".upload-") for name in os.listdir(tmp_path))
+
+
+@pytest.mark.asyncio
+async def test_mask_upload_leaves_linked_uploads_alone(aiohttp_client, prompt_server, tmp_path, monkeypatch):
+    import io
+    import json
+    from PIL import Image
+    monkeypatch.setattr(args, "content_addressed_uploads", True)
+    original = io.BytesIO()
+    Image.new("RGB", (4, 4), (255, 0, 0)).save(original, format="PNG")
+    mask = io.BytesIO()
+    Image.new("RGBA", (4, 4), (0, 0, 0, 7)).save(mask, format="PNG")
+
+    client = await aiohttp_client(prompt_server.app)
+    for name in ("original.png", "copy.png"):
+        resp = await client.post("/upload/image", data=upload_form(original.getvalue(), filename=name))
+        assert resp.status == 200
+    assert os.path.samefile(tmp_path / "original.png", tmp_path / "copy.png")
+
+    # Written over the name of an upload that shares its blob
+    original_ref = json.dumps({"filename": "original.png", "type": "input"})
+    resp = await client.post("/upload/mask", data=upload_form(mask.getvalue(), filename="original.png", original_ref=original_ref, overwrite="true"))
+    assert resp.status == 200
+    with Image.open(tmp_path / "original.png") as image:
+        assert image.getpixel((0, 0)) == (255, 0, 0, 7)
+    assert (tmp_path / "copy.png").read_bytes() == original.getvalue()
@@ -0,0 +1,88 @@
+import asyncio
+import io
+import os
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture(scope="module", autouse=True)
+def comfy_modules():
+    # See queue_route_test.py, server can only be imported once the other test modules are collected.
+    global execution, server, folder_paths
+    from comfy.cli_args import args
+    args.cpu = True
+
+    import execution
+    import folder_paths
+    import server
+
+
+@pytest.fixture
+def prompt_server(tmp_path):
+    output_directory = folder_paths.get_output_directory()
+    temp_directory = folder_paths.get_temp_directory()
+    folder_paths.set_output_directory(str(tmp_path / "output"))
+    folder_paths.set_temp_directory(str(tmp_path / "temp"))
+    os.makedirs(tmp_path / "output")
+    Image.new("RGBA", (16, 8), (10, 20, 30, 40)).save(tmp_path / "output" / "image.png")
+
+    s = server.PromptServer(asyncio.new_event_loop())
+    execution.PromptQueue(s)
+    s.add_routes()
+    yield s
+    folder_paths.set_output_directory(output_directory)
+    folder_paths.set_temp_directory(temp_directory)
+
+
+def open_image(body):
+    img = Image.open(io.BytesIO(body))
+    img.load()
+    return img
+
+
+@pytest.mark.asyncio
+async def test_preview_is_cached_and_revalidated(aiohttp_client, prompt_server):
+    client = await aiohttp_client(prompt_server.app)
+    resp = await client.get("/view?filename=image.png&preview=jpeg;80")
+    assert resp.status == 200
+    assert resp.headers["Content-Type"] == "image/jpeg"
+    img = open_image(await resp.read())
+    assert (img.format, img.mode, img.size) == ("JPEG", "RGB", (16, 8))
+
+    etag = resp.headers["ETag"]
+    resp = await client.get("/view?filename=image.png&preview=jpeg;80", headers={"If-None-Match": etag})
+    assert resp.status == 304
+
+    resp = await client.get("/view?filename=image.png&preview=jpeg;80", headers={"Range": "bytes=0-9"})
+    assert resp.status == 206
+    assert len(await resp.read()) == 10
+
+
+@pytest.mark.asyncio
+async def test_channels(aiohttp_client, prompt_server):
+    client = await aiohttp_client(prompt_server.app)
+    resp = await client.get("/view?filename=image.png&channel=rgb")
+    assert open_image(await resp.read()).getpixel((0, 0)) == (10, 20, 30)
+
+    resp = await client.get("/view?filename=image.png&channel=a")
+    assert open_image(await resp.read()).getpixel((0, 0)) == (0, 0, 0, 40)
+
+    resp = await client.get("/view?filename=image.png")
+    assert resp.headers["Content-Type"] == "image/png"
+    assert open_image(await resp.read()).getpixel((0, 0)) == (10, 20, 30, 40)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_transcode(aiohttp_client, prompt_server, monkeypatch):
+    from app import view_cache
+    calls = []
+    transcode_image = view_cache.transcode_image
+    monkeypatch.setattr(view_cache, "transcode_image", lambda *args: calls.append(args) or transcode_image(*args))
+
+    client = await aiohttp_client(prompt_server.app)
+    responses = await asyncio.gather(*[client.get("/view?filename=image.png&preview=webp;50") for _ in range(5)])
+    assert all(resp.status == 200 for resp in responses)
+    resp = await client.get("/view?filename=image.png&preview=webp;50")
+    assert resp.status == 200
+    assert len(calls) == 1